@@ -0,0 +1,146 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from db_handler import MyDatabase, guild_database
+from metrics import metrics
+from sqlalchemy.exc import OperationalError, ProgrammingError
+
+# MyDatabase methods which only read, run on the read replica when one is configured
+READ_METHODS = frozenset((
+    'select_lobbies', 'select_deadlines', 'select_participant_ids', 'select_board'
+))
+
+# the member whose command is running, reads of a member who just wrote stay on the primary
+actor = contextvars.ContextVar('database_actor', default=None)
+
+
+class AsyncDatabase():
+    """
+        Run MyDatabase work on a bounded thread pool so queries never block the event loop.
+        Every call opens its own short-lived handler inside the worker thread (sessions are not
+        thread safe) and closes it again before the result is handed back to the coroutine.
+        Calls take the guild (anything with an id and a name) whose data should be used,
+        "storage" decides which database and guild_id that maps to (see guild_database).
+
+            lobbies = await db.run(guild, 'select_lobbies', member=member_id)
+            await db.call(guild, lambda con: con.delete_lobby(lobby_id))
+
+        With a "replica" in the database settings, run sends READ_METHODS to the replica and
+        everything else to the primary. A member who wrote reads from the primary for the next
+        "sticky" seconds, so their own changes never vanish because the replica lags behind;
+        commands name their member with act_as. Reads fall back to the primary whenever the
+        replica fails, e.g. before it has caught up with a new database.
+    """
+
+    def __init__(self, db_settings, storage=None, max_workers=8):
+        self.db_settings = dict(db_settings)
+        self.replica = self.db_settings.pop('replica', None) or None
+        self.sticky = float((self.replica or dict()).get('sticky', 5))
+        self.storage = storage or dict()
+        self.executor = ThreadPoolExecutor(
+            max_workers=int(max_workers),
+            thread_name_prefix='database'
+        )
+        self.written = dict() # (guild id, member id) -> monotonic time of the last write
+        self.guild_written = dict() # guild id -> monotonic time of the last write by anyone
+        self.reads = {'primary': 0, 'replica': 0, 'fallback': 0}
+
+    def _call(self, guild, func, args, kwargs, read_only=False):
+        statements = metrics.thread_sql_count()
+        started = time.perf_counter()
+        # guilds of different shards use separate connection pools of the shared database
+        partition = getattr(guild, 'shard_id', None) if self.storage.get('mode') == 'shared' else None
+        with MyDatabase(**{
+            **self.db_settings, **guild_database(self.storage, guild), 'partition': partition,
+            'replica': self.replica, 'read_only': read_only
+        }) as con:
+            result = func(con, *args, **kwargs)
+        return result, time.perf_counter() - started, metrics.thread_sql_count() - statements
+
+    async def call(self, guild, func, *args, read_only=False, **kwargs):
+        """
+            Await func(con, *args, **kwargs) executed in the thread pool against the data of guild,
+            on the replica if "read_only" and one is configured.
+        """
+        loop = asyncio.get_running_loop()
+        result, seconds, statements = await loop.run_in_executor(
+            self.executor,
+            functools.partial(self._call, guild, func, args, kwargs, read_only)
+        )
+        metrics.record_db(seconds, statements)
+        return result
+
+    async def run(self, guild, method, *args, **kwargs):
+        """
+            Await the MyDatabase method named "method" executed in the thread pool, reads on the
+            replica unless the current member wrote recently.
+        """
+        def call_method(con, *args, **kwargs):
+            return getattr(con, method)(*args, **kwargs)
+        logging.debug('Queueing %s for %s', method, guild.name)
+        if method not in READ_METHODS:
+            try:
+                return await self.call(guild, call_method, *args, **kwargs)
+            finally:
+                self.wrote(guild)
+        if self.replica is None or self.is_sticky(guild):
+            self.reads['primary'] += 1
+            return await self.call(guild, call_method, *args, **kwargs)
+        try:
+            result = await self.call(guild, call_method, *args, read_only=True, **kwargs)
+        except (OperationalError, ProgrammingError) as err:
+            logging.warning('Reading %s of %s from the replica failed, using the primary: %s', method, guild.name, err.orig)
+            self.reads['fallback'] += 1
+            return await self.call(guild, call_method, *args, **kwargs)
+        self.reads['replica'] += 1
+        return result
+
+    def act_as(self, member_id):
+        """
+            Name the member whose command is running, returns a token for reset
+        """
+        return actor.set(member_id)
+
+    def reset(self, token):
+        actor.reset(token)
+
+    def wrote(self, guild):
+        """
+            Keep the reads of the current member, and cache fills of guild, on the primary for "sticky" seconds
+        """
+        if self.replica is None:
+            return
+        now = time.monotonic()
+        self.guild_written[guild.id] = now
+        member_id = actor.get()
+        if member_id is not None:
+            self.written[(guild.id, member_id)] = now
+        if len(self.written) > 10000: # forget writes which stopped mattering
+            self.written = dict((key, at) for key, at in self.written.items() if at > now - self.sticky)
+            self.guild_written = dict((key, at) for key, at in self.guild_written.items() if at > now - self.sticky)
+
+    def is_sticky(self, guild):
+        written = self.written.get((guild.id, actor.get()))
+        return written is not None and time.monotonic() - written < self.sticky
+
+    def may_be_stale(self, guild):
+        """
+            Whether a read of guild from the replica might miss a recent write; such results
+            should not be cached
+        """
+        written = self.guild_written.get(guild.id)
+        return written is not None and time.monotonic() - written < self.sticky
+
+    def stats(self):
+        return dict(('reads_%s' % (target), count) for target, count in self.reads.items())
+
+    def shutdown(self, wait=True):
+        """
+            Stop accepting work and wait for queued queries to finish
+        """
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,94 @@
+#! /usr/bin/env python3
+"""
+    Micro-benchmark of the date parser of --create (timemachine.py).
+
+    Dates of every supported format are parsed with an empty memo (every input new), with a warm
+    memo (the same inputs again, as during a raid sign-up where everyone types "tomorrow 20:00")
+    and, for the compact format, with the strptime based parser it replaced.
+
+    Run from the repository root:
+
+        python3 -m benchmarks.bench_dates
+        python3 -m benchmarks.bench_dates --parses 20000 --timezone Europe/Stockholm
+"""
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.bench_names import percentile
+from timemachine import TimeMachine, compile_date, resolve_date
+
+
+def strptime_parse(text):
+    """
+        The former parser: strip separators, then try both strptime formats
+    """
+    stripped = re.sub(r'\W+', '', text)
+    try:
+        return datetime.strptime(stripped, '%y%m%d%H%M')
+    except ValueError:
+        return datetime.strptime(stripped, '%Y%m%d%H%M')
+
+
+def random_inputs(now):
+    date = now + timedelta(days=random.randint(1, 60), minutes=random.randint(0, 1439))
+    hour, minute = random.randint(0, 23), random.choice((0, 15, 30, 45))
+    return {
+        'compact': date.strftime('%Y%m%d%H%M'),
+        'iso': date.strftime('%Y-%m-%d %H:%M'),
+        'day first': date.strftime('%d.%m.%Y %H:%M'),
+        'time': '%02d:%02d' % (hour, minute),
+        'day': '%s %02d:%02d' % (random.choice(('tomorrow', 'friday', 'sat')), hour, minute),
+        'offset': '+%sh%sm' % (random.randint(1, 48), minute),
+    }
+
+
+def timed(parse, texts):
+    samples = list()
+    for text in texts:
+        started = time.perf_counter()
+        parse(text)
+        samples.append((time.perf_counter() - started) * 1000000)
+    return {'p50_us': percentile(samples, 0.5), 'p99_us': percentile(samples, 0.99)}
+
+
+def benchmark(arguments):
+    time_machine = TimeMachine(timezone=arguments.timezone)
+    now = datetime.now()
+    inputs = [random_inputs(now) for _ in range(arguments.parses)]
+    rows = dict()
+    for kind in inputs[0]:
+        texts = [row[kind] for row in inputs]
+        parse = lambda text: time_machine.parse(text, now=now)
+        compile_date.cache_clear()
+        resolve_date.cache_clear()
+        rows[kind] = {'cold': timed(parse, texts), 'warm': timed(parse, texts)}
+        if kind == 'compact':
+            rows[kind]['strptime'] = timed(strptime_parse, texts)
+    return rows
+
+
+def print_report(report):
+    print('\n%-10s %22s %22s %22s' % ('format', 'cold p50/p99 us', 'warm p50/p99 us', 'strptime p50/p99 us'))
+    for kind, row in report.items():
+        print('%-10s %s' % (kind, ' '.join(
+            '%22s' % ('%.1f/%.1f' % (row[column]['p50_us'], row[column]['p99_us']) if column in row else '-')
+            for column in ('cold', 'warm', 'strptime')
+        )))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmark of the --create date parser')
+    parser.add_argument('--parses', type=int, default=2000, help='dates parsed per format, beyond 4096 the memo is too small')
+    parser.add_argument('--timezone', help='time zone the dates are read in, the server time by default')
+    parser.add_argument('--seed', type=int, default=0)
+    arguments = parser.parse_args()
+    random.seed(arguments.seed)
+    print_report(benchmark(arguments))
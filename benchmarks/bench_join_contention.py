@@ -0,0 +1,156 @@
+#! /usr/bin/env python3
+"""
+    Load test of --join under contention.
+
+    Hundreds of members join one popular lobby at the same moment, first through the Lobbies cog
+    and then straight against the database from many threads (bypassing the per-lobby lock of
+    the cog), and one member joins and creates many lobbies at once. The test fails if any lobby
+    ends up with more participants than its size or the member in more lobbies than allowed.
+
+    Run from the repository root:
+
+        python3 -m benchmarks.bench_join_contention
+        python3 -m benchmarks.bench_join_contention --joins 1000 --size 12 --workers 32 --mysql
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+from collections import Counter
+from datetime import datetime, timedelta
+
+# the benchmark changes into a scratch directory, keep the repository importable
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.bench_lobbies import QueryCounter, percentile, populate
+from benchmarks.fakes import FakeBot, FakeContext, FakeGuild
+from benchmarks.runner import run
+
+
+def seated(db_settings, storage, guild, lobby_ids):
+    """
+        Participants per lobby and lobbies per member, as stored in the database
+    """
+    from db_handler import MyDatabase, Participants, guild_database
+
+    with MyDatabase(**{**db_settings, **guild_database(storage, guild)}) as con:
+        rows = con.session.query(Participants.lobbyid, Participants.memid).filter(
+            Participants.guild_id == con.guild_id, Participants.lobbyid.in_(lobby_ids)
+        ).all()
+    return Counter(lobby_id for lobby_id, _ in rows), Counter(member_id for _, member_id in rows)
+
+
+async def timed(coroutine):
+    started = time.perf_counter()
+    result = await coroutine
+    return result, (time.perf_counter() - started) * 1000
+
+
+def summary(statuses, latencies):
+    latencies = sorted(latencies)
+    return {
+        'statuses': dict(Counter(statuses)),
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'max_ms': latencies[-1]
+    }
+
+
+async def benchmark(arguments, db_settings, storage):
+    from async_db import AsyncDatabase
+    from cogs.lobbies import Lobbies
+    from lobby_cache import LobbyCache
+    from write_queue import WriteBehindQueue
+
+    counter = QueryCounter()
+    start_date = datetime.now() + timedelta(days=30)
+    guild = FakeGuild('JoinGuild', arguments.joins + 1)
+    populate(db_settings, storage, guild, arguments.limit * 3, 1, start_date)
+
+    db = AsyncDatabase(db_settings, storage, max_workers=arguments.workers)
+    bot = FakeBot([guild], db, LobbyCache(), WriteBehindQueue(db))
+    cog = Lobbies(bot)
+    cog.task_clean_lobbies.cancel()
+    await asyncio.sleep(0)
+    max_lobbies = cog.lobby_settings['max_lobbies_per_member']
+    leader, joiners = guild.members[0], guild.members[1:]
+    report = dict()
+
+    # every member joins the same lobby through the command
+    await cog.create.callback(cog, FakeContext(guild, leader), 'popular', start_date.strftime('%Y%m%d%H%M'), str(arguments.size))
+    lobby_id = next(iter(await cog.select_lobbies(guild, name='popular')))
+    statements = counter.count
+    results = await asyncio.gather(*(
+        timed(cog.join_lobby.callback(cog, FakeContext(guild, member), 'popular')) for member in joiners
+    ))
+    report['command'] = summary(
+        ['joined' if 'I added you' in member.sent[-1].content else 'refused' for member in joiners],
+        [latency for _, latency in results]
+    )
+    report['command']['queries_per_join'] = (counter.count - statements) / len(joiners)
+
+    # the same against the database from many threads at once, without the lock of the cog
+    await cog.create.callback(cog, FakeContext(guild, leader), 'raw', start_date.strftime('%Y%m%d%H%M'), str(arguments.size))
+    raw_id = next(iter(await cog.select_lobbies(guild, name='raw')))
+    results = await asyncio.gather(*(
+        timed(db.run(guild, 'join_lobby', raw_id, member.id, member.name, max_lobbies)) for member in joiners
+    ))
+    report['database'] = summary([status for status, _ in results], [latency for _, latency in results])
+
+    # one member joins every lobby of the guild and creates as many lobbies as allowed at once
+    greedy = random.choice(joiners)
+    lobby_ids = list(await cog.select_lobbies(guild))
+    creates = [
+        cog.create.callback(cog, FakeContext(guild, greedy), 'greedy%s' % (number), start_date.strftime('%Y%m%d%H%M'), '6')
+        for number in range(max_lobbies)
+    ]
+    results = await asyncio.gather(*(
+        timed(db.run(guild, 'join_lobby', other_id, greedy.id, greedy.name, max_lobbies)) for other_id in lobby_ids
+    ), *(timed(create) for create in creates))
+    statuses = [status for status, _ in results[:len(lobby_ids)]] + [
+        'created' if 'I created' in message.content else 'refused' for message in greedy.sent[-len(creates):]
+    ]
+    report['member_limit'] = summary(statuses, [latency for _, latency in results])
+    lobby_ids = list(await db.run(guild, 'select_lobbies'))
+
+    cog.scheduler.stop()
+    db.shutdown()
+
+    per_lobby, per_member = seated(db_settings, storage, guild, lobby_ids)
+    report['overbooked'] = dict((key, per_lobby[key]) for key in (lobby_id, raw_id) if per_lobby[key] > arguments.size)
+    report['seated'] = {'popular': per_lobby[lobby_id], 'raw': per_lobby[raw_id], 'size': arguments.size}
+    report['greedy_member_lobbies'] = per_member[greedy.id]
+    report['ok'] = not report['overbooked'] and per_member[greedy.id] <= max_lobbies
+    return report
+
+
+def print_report(report):
+    print('\n%-14s %9s %9s %9s %9s  %s' % ('phase', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms', 'statuses'))
+    for phase in ('command', 'database', 'member_limit'):
+        row = report[phase]
+        print('%-14s %9.2f %9.2f %9.2f %9.2f  %s' % (
+            phase, row['p50_ms'], row['p95_ms'], row['p99_ms'], row['max_ms'], row['statuses']
+        ))
+    print('\nqueries per join (command): %.1f' % (report['command']['queries_per_join']))
+    print('seated: %s' % (report['seated']))
+    print('lobbies of the greedy member: %s' % (report['greedy_member_lobbies']))
+    print('overbooked: %s' % (report['overbooked'] or 'none'))
+    print('OK' if report['ok'] else 'FAILED')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test of concurrent joins')
+    parser.add_argument('--joins', type=int, default=300, help='members joining at the same time')
+    parser.add_argument('--size', type=int, default=6, help='size of the contended lobby')
+    parser.add_argument('--limit', type=int, default=10, help='lobbies are generated for 3 times this many joins')
+    parser.add_argument('--workers', type=int, default=16, help='database threads')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mysql', action='store_true', help='use the database section of ./settings.json')
+    parser.add_argument('--json', help='also write the report to this file')
+    arguments = parser.parse_args()
+    random.seed(arguments.seed)
+    run(benchmark, print_report, arguments, {'lobbies': {'max_lobbies_per_member': arguments.limit}})
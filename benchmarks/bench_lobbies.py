@@ -0,0 +1,230 @@
+#! /usr/bin/env python3
+"""
+    Offline benchmark of the Lobbies cog.
+
+    Synthetic guilds with thousands of members and lobbies are written to SQLite files in a
+    temporary directory (or to the MySQL server configured in ./settings.json with --mysql),
+    then create, list, leave and the cleanup task are driven through fake discord objects.
+    Latency percentiles and SQL statements per operation are printed at the end, together with
+    the statement count of select_lobbies for growing guilds, which has to stay constant.
+
+    Run from the repository root:
+
+        python3 -m benchmarks.bench_lobbies
+        python3 -m benchmarks.bench_lobbies --guilds 4 --members 5000 --lobbies 2000 --rounds 500
+        python3 -m benchmarks.bench_lobbies --mysql
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import threading
+import time
+
+from datetime import datetime, timedelta
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# the benchmark changes into a scratch directory, keep the repository importable
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fakes import FakeBot, FakeContext, FakeGuild, snowflakes
+from benchmarks.runner import run
+
+
+def typo(name):
+    """
+        Swap two neighbouring characters of a name
+    """
+    index = random.randrange(len(name) - 1)
+    return name[:index] + name[index + 1] + name[index] + name[index + 2:]
+
+
+class QueryCounter():
+    """
+        Count every SQL statement sent by any engine of the process
+    """
+    def __init__(self):
+        self.count = 0
+        self.lock = threading.Lock()
+        event.listen(Engine, 'before_cursor_execute', self.on_execute)
+
+    def on_execute(self, *args):
+        with self.lock:
+            self.count += 1
+
+
+class Recorder():
+    def __init__(self, counter):
+        self.counter = counter
+        self.samples = dict() # operation -> [(seconds, statements)]
+
+    async def measure(self, operation, coroutine):
+        statements = self.counter.count
+        started = time.perf_counter()
+        result = await coroutine
+        self.samples.setdefault(operation, list()).append(
+            (time.perf_counter() - started, self.counter.count - statements)
+        )
+        return result
+
+    def report(self):
+        rows = dict()
+        for operation, samples in self.samples.items():
+            latencies = sorted(seconds * 1000 for seconds, _ in samples)
+            rows[operation] = {
+                'count': len(samples),
+                'p50_ms': percentile(latencies, 50),
+                'p95_ms': percentile(latencies, 95),
+                'p99_ms': percentile(latencies, 99),
+                'max_ms': latencies[-1],
+                'queries_per_op': sum(statements for _, statements in samples) / len(samples)
+            }
+        return rows
+
+
+def percentile(ordered, pct):
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def populate(db_settings, storage, guild, lobby_count, participants_per_lobby, date):
+    """
+        Write the members of a fake guild and "lobby_count" lobbies straight into its database.
+        Returns (member, lobby name) pairs of members partaking in a lobby.
+    """
+    from db_handler import MyDatabase, Lobby, Participants, guild_database
+
+    memberships = list()
+    with MyDatabase(**{**db_settings, **guild_database(storage, guild)}) as con:
+        con.sync_members([(member.id, member.name) for member in guild.members])
+        lobbies, participants = list(), list()
+        for number in range(lobby_count):
+            lobby_id = next(snowflakes)
+            lobby_name = 'raid%s' % (number)
+            lobbies.append({
+                'guild_id': con.guild_id, 'id': lobby_id, 'name': lobby_name, 'date': date, 'size': 6
+            })
+            for seat, member in enumerate(random.sample(guild.members, participants_per_lobby)):
+                participants.append({
+                    'guild_id': con.guild_id,
+                    'memid': member.id,
+                    'lobbyid': lobby_id,
+                    'leader': member.id if seat == 0 else None
+                })
+                memberships.append((member, lobby_name))
+        for offset in range(0, len(lobbies), 500):
+            con.upsert(Lobby, lobbies[offset:offset + 500])
+        for offset in range(0, len(participants), 500):
+            con.upsert(Participants, participants[offset:offset + 500])
+        con.session.commit()
+    return memberships
+
+
+async def benchmark(arguments, db_settings, storage):
+    from async_db import AsyncDatabase
+    from cogs.lobbies import Lobbies
+    from cogs.members import MemberSync
+    from lobby_cache import LobbyCache
+    from write_queue import WriteBehindQueue
+
+    counter = QueryCounter()
+    recorder = Recorder(counter)
+    start_date = datetime.now() + timedelta(days=30)
+
+    guilds = [FakeGuild('BenchGuild%s' % (number), arguments.members) for number in range(arguments.guilds)]
+    memberships = dict()
+    for guild in guilds:
+        started = time.perf_counter()
+        memberships[guild.id] = populate(
+            db_settings, storage, guild, arguments.lobbies, arguments.participants, start_date
+        )
+        print('populated %s with %s members and %s lobbies in %.1f s' % (
+            guild.name, arguments.members, arguments.lobbies, time.perf_counter() - started
+        ))
+
+    db = AsyncDatabase(db_settings, storage)
+    bot = FakeBot(guilds, db, LobbyCache(), WriteBehindQueue(db))
+    cog = Lobbies(bot)
+    cog.task_clean_lobbies.cancel() # the sweep is driven explicitly below
+    bot.add_cog(MemberSync(bot))
+    bot.add_cog(cog)
+    await asyncio.sleep(0)
+    await recorder.measure('warm-up', bot.warmup.on_ready(guilds))
+
+    for _ in range(arguments.rounds):
+        guild = random.choice(guilds)
+        member = random.choice(guild.members)
+
+        ctx = FakeContext(guild, member)
+        await recorder.measure('create', cog.create.callback(
+            cog, ctx, 'bench%s' % (next(snowflakes)), start_date.strftime('%Y%m%d%H%M'), '6'
+        ))
+        await recorder.measure('list', cog.list_lobbies.callback(cog, FakeContext(guild, member)))
+        await recorder.measure('list me', cog.list_lobbies.callback(cog, FakeContext(guild, member), 'me'))
+        await recorder.measure('list member (typo)', cog.list_lobbies.callback(
+            cog, FakeContext(guild, member), typo(random.choice(guild.members).name)
+        ))
+        bot.lobby_cache.invalidate(guild.id)
+        await recorder.measure('list (cold cache)', cog.list_lobbies.callback(cog, FakeContext(guild, member)))
+
+        if memberships[guild.id]:
+            leaver, lobby_name = memberships[guild.id].pop(random.randrange(len(memberships[guild.id])))
+            await recorder.measure('leave', cog.leave_lobby.callback(cog, FakeContext(guild, leaver), lobby_name))
+
+    # concurrent creates share write transactions
+    ctxs = [FakeContext(guild, random.choice(guild.members)) for guild in guilds for _ in range(arguments.burst)]
+    await recorder.measure('create burst of %s' % (len(ctxs)), asyncio.gather(*(
+        cog.create.callback(cog, ctx, 'burst%s' % (next(snowflakes)), start_date.strftime('%Y%m%d%H%M'), '6')
+        for ctx in ctxs
+    )))
+
+    await recorder.measure('task_clean_lobbies', cog.task_clean_lobbies.coro(cog))
+    cog.scheduler.stop()
+
+    # select_lobbies has to send the same number of statements regardless of the guild size
+    scaling = dict()
+    for lobby_count in (10, 100, 1000):
+        guild = FakeGuild('ScaleGuild%s' % (lobby_count), 200)
+        populate(db_settings, storage, guild, lobby_count, arguments.participants, start_date)
+        statements = counter.count
+        await bot.db.run(guild, 'select_lobbies')
+        scaling[lobby_count] = counter.count - statements
+
+    bot.db.shutdown()
+    return {
+        'operations': recorder.report(),
+        'select_lobbies_statements': scaling,
+        'cache': bot.lobby_cache.stats(),
+        'write_queue': bot.writes.stats(),
+        'ok': len(set(scaling.values())) == 1
+    }
+
+
+def print_report(report):
+    print('\n%-22s %7s %9s %9s %9s %9s %9s' % ('operation', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms', 'queries'))
+    for operation, row in report['operations'].items():
+        print('%-22s %7d %9.2f %9.2f %9.2f %9.2f %9.1f' % (
+            operation, row['count'], row['p50_ms'], row['p95_ms'], row['p99_ms'], row['max_ms'], row['queries_per_op']
+        ))
+    print('\nselect_lobbies statements by lobby count: %s' % (report['select_lobbies_statements']))
+    print('lobby cache: %s' % (report['cache']))
+    print('write queue: %s' % (report['write_queue']))
+    print('OK' if report['ok'] else 'FAILED: select_lobbies statements grow with the guild')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Offline benchmark of the Lobbies cog')
+    parser.add_argument('--guilds', type=int, default=2)
+    parser.add_argument('--members', type=int, default=2000)
+    parser.add_argument('--lobbies', type=int, default=1000)
+    parser.add_argument('--participants', type=int, default=4, help='participants per generated lobby')
+    parser.add_argument('--rounds', type=int, default=200)
+    parser.add_argument('--burst', type=int, default=50, help='concurrent creates per guild')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--mysql', action='store_true', help='use the database section of ./settings.json')
+    parser.add_argument('--json', help='also write the report to this file')
+    arguments = parser.parse_args()
+    random.seed(arguments.seed)
+    run(benchmark, print_report, arguments)
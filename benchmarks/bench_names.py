@@ -0,0 +1,94 @@
+#! /usr/bin/env python3
+"""
+    Benchmark of the member and lobby name index (name_index.py).
+
+    Indexes of growing guilds are built from random names, then looked up with the exact name,
+    the name in another case, a prefix and a name with a typo. Build time, memory and lookup
+    latency percentiles are printed; lookups have to stay well below a millisecond.
+
+    Run from the repository root:
+
+        python3 -m benchmarks.bench_names
+        python3 -m benchmarks.bench_names --names 1000 10000 50000 --lookups 2000
+        python3 -m benchmarks.bench_names --names 10000 --typo-limit 5000   # the memory of a capped index
+"""
+import argparse
+import os
+import random
+import string
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.bench_lobbies import typo
+from name_index import NameIndex
+
+
+def random_name():
+    return ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(random.randint(4, 16)))
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(pct * (len(ordered) - 1))))]
+
+
+QUERIES = {
+    'exact': lambda name: name,
+    'case': lambda name: name.swapcase(),
+    'prefix': lambda name: name[:max(3, len(name) // 2)],
+    'typo': typo,
+}
+
+
+def benchmark(arguments):
+    rows = dict()
+    for count in arguments.names:
+        names = [random_name() for _ in range(count)]
+        tracemalloc.start()
+        started = time.perf_counter()
+        index = NameIndex(arguments.max_distance, arguments.prefix_length, arguments.typo_limit)
+        index.update(enumerate(names))
+        build_ms = (time.perf_counter() - started) * 1000
+        memory_mb = tracemalloc.get_traced_memory()[0] / 1024 / 1024
+        tracemalloc.stop()
+
+        row = {'build_ms': build_ms, 'memory_mb': memory_mb}
+        for kind, make_query in QUERIES.items():
+            samples = list()
+            found = 0
+            for name in random.sample(names, min(arguments.lookups, count)):
+                query = make_query(name)
+                started = time.perf_counter()
+                matches = index.match(query)
+                samples.append((time.perf_counter() - started) * 1000)
+                found += any(match == name for match, _ in matches)
+            row[kind] = {'p50_ms': percentile(samples, 0.5), 'p99_ms': percentile(samples, 0.99), 'found': found / len(samples)}
+        rows[count] = row
+    return rows
+
+
+def print_report(report):
+    print('\n%8s %10s %10s   %s' % ('names', 'build ms', 'memory MB', '  '.join(
+        '%-24s' % ('%s p50/p99 ms found' % (kind)) for kind in QUERIES
+    )))
+    for count, row in report.items():
+        print('%8s %10.1f %10.1f   %s' % (count, row['build_ms'], row['memory_mb'], '  '.join(
+            '%-24s' % ('%.3f/%.3f %3d%%' % (row[kind]['p50_ms'], row[kind]['p99_ms'], row[kind]['found'] * 100))
+            for kind in QUERIES
+        )))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of the name index')
+    parser.add_argument('--names', type=int, nargs='+', default=[1000, 10000], help='names per index')
+    parser.add_argument('--lookups', type=int, default=1000, help='lookups per kind of query')
+    parser.add_argument('--max-distance', type=int, default=2)
+    parser.add_argument('--prefix-length', type=int, default=5)
+    parser.add_argument('--typo-limit', type=int, default=0, help='names beyond which typos are not indexed, 0 for no limit')
+    parser.add_argument('--seed', type=int, default=0)
+    arguments = parser.parse_args()
+    random.seed(arguments.seed)
+    print_report(benchmark(arguments))
@@ -0,0 +1,125 @@
+#! /usr/bin/env python3
+"""
+    Benchmark of lobby rendering with and without the fragment cache of the Lobbies cog.
+
+    Guilds with thousands of lobbies are written to SQLite and loaded through the lobby cache,
+    then rendered into board pages: without the fragment cache, with a cold cache, with a warm
+    cache, after the lobby cache reloaded the guild unchanged and right after one lobby changed
+    (the case of a board refresh). The lobby cache runs
+    with its default settings, guilds beyond its "max_lobbies" are not memoized at all.
+
+    Run from the repository root:
+
+        python3 -m benchmarks.bench_render
+        python3 -m benchmarks.bench_render --lobbies 1000 5000 20000 --repeat 20
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+from datetime import datetime, timedelta
+
+# the benchmark changes into a scratch directory, keep the repository importable
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.bench_lobbies import populate
+from benchmarks.fakes import FakeBot, FakeGuild
+from benchmarks.runner import run
+
+
+def timed_render(cog, lobbies, repeat):
+    """
+        Best time of "repeat" renders in milliseconds, and the pages rendered
+    """
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        pages = cog.render_pages(lobbies)
+        elapsed = (time.perf_counter() - started) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, pages
+
+
+async def benchmark(arguments, db_settings, storage):
+    from async_db import AsyncDatabase
+    from cogs.lobbies import Lobbies
+    from lobby_cache import FragmentCache, LobbyCache
+    from write_queue import WriteBehindQueue
+
+    start_date = datetime.now() + timedelta(days=30)
+    guilds = [FakeGuild('RenderGuild%s' % (count), arguments.members) for count in arguments.lobbies]
+    db = AsyncDatabase(db_settings, storage)
+    bot = FakeBot(guilds, db, LobbyCache(), WriteBehindQueue(db))
+    cog = Lobbies(bot)
+    cog.task_clean_lobbies.cancel()
+    await asyncio.sleep(0)
+
+    rows = dict()
+    for guild, lobby_count in zip(guilds, arguments.lobbies):
+        populate(db_settings, storage, guild, lobby_count, arguments.participants, start_date)
+        lobbies = await cog.select_lobbies(guild)
+
+        cog.fragments = FragmentCache(max_fragments=0)
+        uncached, expected = timed_render(cog, lobbies, arguments.repeat)
+
+        cog.fragments = FragmentCache(max_fragments=max(arguments.lobbies) * 2)
+        cold, pages = timed_render(cog, lobbies, 1)
+        warm, pages = timed_render(cog, lobbies, arguments.repeat)
+        assert pages == expected, 'cached rendering differs'
+
+        # the cached guild expired (or was invalidated) and got reloaded without any lobby changing
+        bot.lobby_cache.invalidate(guild.id)
+        lobbies = await cog.select_lobbies(guild)
+        after_reload, pages = timed_render(cog, lobbies, 1)
+        assert pages == expected, 'rendering after a reload differs'
+
+        # one join, as a board refresh after a write would see it
+        lobby_id = random.choice(list(lobbies))
+        member = random.choice(guild.members)
+        bot.lobby_cache.add_participant(guild.id, lobby_id, member.id, member.name)
+        lobbies = await cog.select_lobbies(guild)
+        started = time.perf_counter()
+        cog.render_pages(lobbies)
+        after_write = (time.perf_counter() - started) * 1000
+
+        rows[lobby_count] = {
+            'pages': len(pages),
+            'uncached_ms': uncached,
+            'cold_ms': cold,
+            'warm_ms': warm,
+            'after_reload_ms': after_reload,
+            'after_write_ms': after_write,
+            'speedup': uncached / warm if warm else float('inf'),
+            'fragment_cache': cog.fragments.stats()
+        }
+
+    cog.scheduler.stop()
+    db.shutdown()
+    return rows
+
+
+def print_report(report):
+    print('\n%8s %6s %12s %10s %10s %15s %14s %8s %10s' % (
+        'lobbies', 'pages', 'uncached ms', 'cold ms', 'warm ms', 'after reload ms', 'after write ms', 'speedup', 'fragments'
+    ))
+    for lobby_count, row in report.items():
+        print('%8s %6d %12.2f %10.2f %10.2f %15.2f %14.2f %7.1fx %10d' % (
+            lobby_count, row['pages'], row['uncached_ms'], row['cold_ms'], row['warm_ms'],
+            row['after_reload_ms'], row['after_write_ms'], row['speedup'], row['fragment_cache']['fragments']
+        ))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark of memoized lobby rendering')
+    parser.add_argument('--lobbies', type=int, nargs='+', default=[1000, 5000, 6000], help='lobby counts of the guilds, beyond the "max_lobbies" of the lobby cache nothing is memoized')
+    parser.add_argument('--members', type=int, default=2000)
+    parser.add_argument('--participants', type=int, default=4, help='participants per generated lobby')
+    parser.add_argument('--repeat', type=int, default=10, help='renders per measurement, the best one counts')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='also write the report to this file')
+    arguments = parser.parse_args()
+    random.seed(arguments.seed)
+    run(benchmark, print_report, arguments)
@@ -0,0 +1,143 @@
+"""
+    Stand-ins for the discord objects the cogs touch, so commands can be driven without a gateway.
+    Only the attributes and coroutines used by the cogs are implemented.
+"""
+import asyncio
+import itertools
+
+from name_index import GuildNames
+from reaction_router import ReactionRouter
+from sharding import ShardGuilds
+from startup import Warmup
+
+snowflakes = itertools.count(10 ** 17)
+direct_messages = list() # every message the bot sent to a user, newest last
+raw_reaction_listeners = list() # on_raw_reaction_add listeners of every FakeBot
+
+
+class FakeMessage():
+    def __init__(self, author, content, channel=None):
+        self.id = next(snowflakes)
+        self.author = author
+        self.content = content
+        self.channel = channel
+        self.reactions = list()
+
+    async def add_reaction(self, emoji):
+        """
+            The recipient of a direct message picks the first reaction the bot adds
+        """
+        self.reactions.append(emoji)
+        if len(self.reactions) == 1 and getattr(self, 'recipient', None) is not None:
+            for listener in raw_reaction_listeners:
+                asyncio.ensure_future(listener(FakeReactionPayload(self, emoji, self.recipient)))
+
+    async def edit(self, content=None, **kwargs):
+        self.content = content
+
+
+class FakeUser():
+    def __init__(self, name, guild=None, user_id=None):
+        self.id = user_id or next(snowflakes)
+        self.name = name
+        self.guild = guild
+        self.bot = False
+        self.sent = list()
+
+    async def send(self, content=None, **kwargs):
+        message = FakeMessage(FAKE_BOT_USER, content)
+        message.recipient = self
+        self.sent.append(message)
+        direct_messages.append(message)
+        del direct_messages[:-100]
+        return message
+
+
+FAKE_BOT_USER = FakeUser('eventplanner-bot')
+
+
+class FakeChannel():
+    def __init__(self, guild):
+        self.id = next(snowflakes)
+        self.guild = guild
+        self.sent = list()
+
+    async def send(self, content=None, **kwargs):
+        message = FakeMessage(FAKE_BOT_USER, content, self)
+        self.sent.append(message)
+        return message
+
+
+class FakeGuild():
+    def __init__(self, name, member_count):
+        self.id = next(snowflakes)
+        self.shard_id = 0
+        self.name = name
+        self.members = [FakeUser('member%s' % (number), self) for number in range(member_count)]
+        self.members_by_id = dict((member.id, member) for member in self.members)
+        self.channel = FakeChannel(self)
+
+    def get_member(self, member_id):
+        return self.members_by_id.get(member_id)
+
+
+class FakeContext():
+    def __init__(self, guild, author):
+        self.guild = guild
+        self.author = author
+        self.message = FakeMessage(author, '', guild.channel)
+        self.channel = guild.channel
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+
+class FakeBot():
+    """
+        Holds the shared state main.py attaches to the real bot (db, lobby_cache, names, writes, sweep,
+        shard_guilds, reactions, warmup) and the cogs added to it.
+        Reaction menus are answered by their recipient with the first reaction, see FakeMessage.
+    """
+    def __init__(self, guilds, db, lobby_cache, writes=None):
+        self.guilds = guilds
+        self.shard_guilds = ShardGuilds(guilds)
+        self.db = db
+        self.lobby_cache = lobby_cache
+        self.names = GuildNames()
+        self.writes = writes
+        self.sweep = True
+        self.user = FAKE_BOT_USER
+        self.dispatched = list() # names of the custom events dispatched, newest last
+        self.loop = asyncio.get_event_loop()
+        self.reactions = ReactionRouter()
+        self.reactions.install(self)
+        self.cogs = dict()
+        self.warmup = Warmup()
+        self.warmup.install(self)
+
+    def dispatch(self, event, *args, **kwargs):
+        self.dispatched.append(event)
+        del self.dispatched[:-100]
+
+    def get_guild(self, guild_id):
+        return next((guild for guild in self.guilds if guild.id == guild_id), None)
+
+    def add_cog(self, cog):
+        self.cogs[type(cog).__name__] = cog
+
+    def get_cog(self, name):
+        return self.cogs.get(name)
+
+    def before_invoke(self, coro):
+        return coro
+
+    def add_listener(self, func, name=None):
+        if (name or func.__name__) == 'on_raw_reaction_add':
+            raw_reaction_listeners.append(func)
+
+
+class FakeReactionPayload():
+    def __init__(self, message, emoji, user):
+        self.message_id = message.id
+        self.user_id = user.id
+        self.emoji = emoji
@@ -0,0 +1,48 @@
+"""
+    The command line part shared by the benchmarks which drive the cogs against a database.
+"""
+import asyncio
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+
+def run(benchmark, print_report, arguments, settings=None):
+    """
+        Run the coroutine function benchmark(arguments, db_settings, storage) in a scratch
+        directory and print its report with print_report. The databases are SQLite files in the
+        scratch directory, or the database section of ./settings.json with --mysql; the cogs read
+        their settings.json there too, "settings" adds sections to it. The report is written to
+        the file of --json and the scratch directory is removed once done. Exits non-zero if the
+        report has a false "ok".
+    """
+    if arguments.json:
+        arguments.json = os.path.abspath(arguments.json)
+    if getattr(arguments, 'mysql', False):
+        with open('settings.json', 'r') as settings_file:
+            db_settings = json.loads(settings_file.read())['database']
+
+    workdir = tempfile.mkdtemp(prefix='eventplanner-bench-')
+    if not getattr(arguments, 'mysql', False):
+        db_settings = {'driver': 'sqlite', 'directory': workdir}
+    storage = {'mode': 'per_guild'}
+    previous_dir = os.path.abspath(os.curdir)
+    try:
+        with open(os.path.join(workdir, 'settings.json'), 'w') as settings_file:
+            settings_file.write(json.dumps({'database': db_settings, 'storage': storage, **(settings or {})}))
+        os.chdir(workdir)
+
+        loop = asyncio.get_event_loop()
+        report = loop.run_until_complete(benchmark(arguments, db_settings, storage))
+    finally:
+        os.chdir(previous_dir)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(report)
+    if arguments.json:
+        with open(arguments.json, 'w') as report_file:
+            report_file.write(json.dumps(report, indent=4))
+    if not report.get('ok', True):
+        sys.exit(1)
@@ -0,0 +1,150 @@
+import asyncio
+import hashlib
+import os
+import json
+import logging
+
+import discord
+from discord.ext import commands
+
+
+class Board(commands.Cog):
+    """
+        An opt-in board of every lobby of a guild, kept as a set of messages in one channel which
+        are edited in place. Lobby writes dispatch a "lobby_change" event; changes arriving within
+        "debounce" seconds of each other are coalesced into one update, and a page is only edited
+        when the hash of its rendered content differs from what was last sent.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+
+        WORKING_DIR = os.path.abspath(os.curdir)
+        settings_file = open(os.path.join(WORKING_DIR, 'settings.json'), 'r')
+        settings = json.loads(settings_file.read())
+        settings_file.close()
+        self.board_settings = {
+            'debounce': 2.0, # seconds of changes coalesced into one update
+            **settings.get('board', {})
+        }
+
+        self.boards = dict() # guild id -> {"channel_id", "pages": [(message id, digest)]}, None without a board
+        self.dirty = set() # guilds changed since their last update started
+        self.pending = dict() # guild id -> update task
+        self.sent = 0
+        self.edited = 0
+        self.unchanged = 0
+
+    def cog_unload(self):
+        for task in self.pending.values():
+            task.cancel()
+
+    async def board(self, guild):
+        if guild.id not in self.boards:
+            self.boards[guild.id] = await self.bot.db.run(guild, 'select_board')
+        return self.boards[guild.id]
+
+    #----- listeners -----
+    @commands.Cog.listener()
+    async def on_lobby_change(self, guild):
+        if await self.board(guild) is None:
+            return
+        self.dirty.add(guild.id)
+        if guild.id not in self.pending:
+            self.pending[guild.id] = self.bot.loop.create_task(self.update_later(guild))
+
+    async def update_later(self, guild):
+        """
+            Update the board once the changes to it paused for "debounce" seconds,
+            changes made during an update trigger another one
+        """
+        try:
+            while guild.id in self.dirty:
+                await asyncio.sleep(self.board_settings['debounce'])
+                self.dirty.discard(guild.id)
+                try:
+                    await self.update(guild)
+                except Exception:
+                    logging.exception('Updating the board of %s failed', guild.name)
+        finally:
+            self.pending.pop(guild.id, None)
+
+    #----- rendering -----
+    async def render(self, guild):
+        lobbies_cog = self.bot.get_cog('Lobbies')
+        lobbies = await lobbies_cog.select_lobbies(guild)
+        if not lobbies:
+            return ['```Well actually there are no lobbies yet :(```']
+        return lobbies_cog.render_pages(lobbies, ':space_invader: Lobbies of %s :space_invader:' % (guild.name))
+
+    async def update(self, guild):
+        board = self.boards.get(guild.id)
+        if board is None:
+            return
+        channel = guild.get_channel(board['channel_id'])
+        if channel is None:
+            logging.warning('Board channel %s of %s is gone', board['channel_id'], guild.name)
+            return
+
+        pages = list()
+        for index, content in enumerate(await self.render(guild)):
+            digest = hashlib.sha1(content.encode('utf-8')).hexdigest()
+            if index < len(board['pages']):
+                message_id, sent_digest = board['pages'][index]
+                if digest == sent_digest:
+                    self.unchanged += 1
+                    pages.append((message_id, digest))
+                    continue
+                try:
+                    await channel.get_partial_message(message_id).edit(content=content)
+                    self.edited += 1
+                    pages.append((message_id, digest))
+                    continue
+                except discord.NotFound: # deleted by someone, send it again
+                    pass
+            message = await channel.send(content)
+            self.sent += 1
+            pages.append((message.id, digest))
+        await self.delete_messages(channel, board['pages'][len(pages):])
+
+        if pages != board['pages']:
+            self.boards[guild.id] = {'channel_id': board['channel_id'], 'pages': pages}
+            await self.bot.db.run(guild, 'save_board', board['channel_id'], pages)
+        logging.debug('Updated board of %s: %s pages', guild.name, len(pages))
+
+    async def delete_messages(self, channel, pages):
+        for message_id, _ in pages:
+            try:
+                await channel.get_partial_message(message_id).delete()
+            except discord.NotFound:
+                pass
+
+    def stats(self):
+        return {'sent': self.sent, 'edited': self.edited, 'unchanged': self.unchanged}
+
+    #----- command functions -----
+    @commands.command(
+        name='board',
+        description='Keep a board of every lobby in this channel, updated as lobbies change. "off" removes it.',
+    )
+    @commands.has_permissions(manage_guild=True)
+    async def board_command(self, ctx, state='on'):
+        guild = ctx.message.channel.guild
+        board = await self.board(guild)
+        if board is not None and (state == 'off' or board['channel_id'] != ctx.message.channel.id):
+            old_channel = guild.get_channel(board['channel_id'])
+            if old_channel is not None:
+                await self.delete_messages(old_channel, board['pages'])
+            self.boards[guild.id] = board = None
+            await self.bot.db.run(guild, 'save_board', ctx.message.channel.id, [])
+
+        if state == 'off':
+            await ctx.message.author.send('```The lobby board of %s is removed```' % (guild.name))
+            return
+        if board is None:
+            self.boards[guild.id] = {'channel_id': ctx.message.channel.id, 'pages': []}
+        await self.on_lobby_change(guild)
+
+
+def setup(bot):
+    bot.add_cog(Board(bot))
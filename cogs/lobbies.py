@@ -1,28 +1,27 @@
+import asyncio
 import os
-import re
 import json
-import random
+import time
 import discord
 
-from db_handler import DataForm
+from datetime import datetime, timedelta
+from db_handler import DataForm, LimitError, form_writes, guild_database
 from discord.ext import commands, tasks
-from db_handler import MyDatabase
-from timemachine import TimeMachine
+from lobby_cache import FragmentCache, filter_lobbies
+from log_setup import bind, log_context
+from metrics import metrics
+from name_index import rank_groups
+from scheduler import DeadlineScheduler
+from snowflake import lobby_ids
+from timemachine import DateError, TimeMachine
 
 from pprint import pprint
 import emojis
 
 import logging
 
-logging.basicConfig(
-        level=logging.DEBUG,
-        filename='backend_logs.log', 
-        format='%(asctime)s - %(process)s - %(module)s -  %(levelname)s - %(message)s'
-    )
-
 # New - The Cog class must extend the commands.Cog class
 class Lobbies(commands.Cog):
-    # TODO: a member cannot partake in more than 10 lobbies
     # TODO: a lobby cannot have a timedelta more than 6 hours
     # TODO: a lobby must be destroyed if no members partake in it.
         
@@ -33,22 +32,43 @@ class Lobbies(commands.Cog):
         settings_file = open(os.path.join(WORKING_DIR, 'settings.json'), 'r')
         self.settings = json.loads(settings_file.read())
         settings_file.close()
-        self.task_clean_lobbies.start(guilds=self.bot.guilds)
+        self.db = bot.db
+        self.cache = bot.lobby_cache
+        self.fragments = FragmentCache(**self.settings.get('render_cache', {}))
+        self.time_machine = TimeMachine(**self.settings.get('dates', {}))
+        self.join_locks = dict() # (guild id, lobby id) -> [asyncio.Lock, joins waiting for it, found full]
+        self.lobby_settings = {
+            'sweep_interval': 3600, # seconds between safety sweeps over every guild
+            'reminder_lead': 900, # seconds before a lobby starts to remind its participants, 0 to disable
+            'max_lobbies_per_member': 10, # joins and creates beyond this are refused
+            'deadline_chunk': 10000, # deadlines of a guild loaded at a time
+            **self.settings.get('lobbies', {})
+        }
 
-    def connect_to_db(self, ctx):
-        # TODO: Maybe this is not an optimal way of communicating with the database
-        # Because this way has a tendancy of creating maaany connections; one for each method command.
-        """
-            Use ctx object to connect to database and return connection object
-        """
-        try:
-            guild_name = re.sub(r' ', '', ctx.message.channel.guild.name) # remove whitespaces from database names
-        except AttributeError:
-            guild_name = ctx
-        con = MyDatabase(
-            **{**self.settings['database'], "db_name": guild_name}
-        )
-        return con
+        # lobbies expire (and get reminded) through the deadline scheduler, the loop is only a safety net;
+        # deadlines of a guild are loaded when it is warmed (see startup.py)
+        self.scheduler = DeadlineScheduler(self.on_deadlines)
+        self.scheduler.start()
+        if self.bot.sweep: # otherwise maintenance.py sweeps in a process of its own
+            self.task_clean_lobbies.change_interval(seconds=self.lobby_settings['sweep_interval'])
+            self.task_clean_lobbies.start()
+
+    def cog_unload(self):
+        self.scheduler.stop()
+        self.task_clean_lobbies.cancel()
+
+    async def cog_before_invoke(self, ctx):
+        ctx.log_token = bind(guild=ctx.message.channel.guild.id, command=ctx.command.name)
+        ctx.db_token = self.db.act_as(ctx.message.author.id)
+        ctx.metrics_tracker = metrics.start('command.%s' % (ctx.command.name))
+
+    async def cog_after_invoke(self, ctx):
+        metrics.finish(ctx.metrics_tracker)
+        logging.info('Finished command %s', ctx.command.name, extra={
+            'duration_ms': round((time.perf_counter() - ctx.metrics_tracker.started) * 1000, 2)
+        })
+        self.db.reset(ctx.db_token)
+        log_context.reset(ctx.log_token)
 
     # @commands.Cog.listener()
     # async def on_command_error(self, ctx, err):
@@ -56,44 +76,334 @@ class Lobbies(commands.Cog):
 
     #----- background tasks -----
     @tasks.loop(seconds=60)
-    async def task_clean_lobbies(self, guilds):
+    async def task_clean_lobbies(self):
+        """
+            Delete lobbies without a leader and lobbies whose date has passed, with one bulk
+            operation per guild. Only the guilds of the shards of this process which have data are
+            swept, warm or not (sweeping the others would create their databases); shards are swept
+            concurrently and the guilds of a shard one after another.
+        """
+        warmup = self.bot.warmup
+        with metrics.track('task.clean_lobbies'):
+            await self.add_archive_partitions([guild for guild in self.bot.shard_guilds.all() if warmup.has_data(guild)])
+            await asyncio.gather(*(
+                self.clean_shard(shard_id, [guild for guild in guilds if warmup.has_data(guild)])
+                for shard_id, guilds in self.bot.shard_guilds.items()
+            ))
+        logging.debug('Lobby cache: %s' % (self.cache.stats()))
+
+    async def add_archive_partitions(self, guilds):
+        """
+            The partitions of the coming months are added before lobbies of a new month get
+            archived, once per database (see MyDatabase.add_archive_partitions)
+        """
+        databases = dict((guild_database(self.db.storage, guild)['db_name'], guild) for guild in guilds)
+        for db_name, guild in databases.items():
+            try:
+                await self.db.run(guild, 'add_archive_partitions')
+            except Exception:
+                logging.exception('Adding archive partitions to %s failed', db_name)
+
+    async def clean_shard(self, shard_id, guilds):
+        started = time.perf_counter()
+        for guild in guilds:
+            try:
+                await self.clean_guild(guild)
+            except Exception:
+                logging.exception('Cleaning %s failed', guild.name)
+        logging.debug('Swept %s guilds of shard %s in %.1f ms',
+            len(guilds), shard_id, (time.perf_counter() - started) * 1000
+        )
+
+    async def clean_guild(self, guild):
+        started = time.perf_counter()
+        report = await self.db.run(guild, 'clean_lobbies')
+        metrics.observe('task.clean_guild.wall_ms', (time.perf_counter() - started) * 1000)
+        if report['lobby_ids']:
+            self.cache.remove_lobbies(guild.id, report['lobby_ids'])
+            for lobby_id in report['lobby_ids']:
+                self.bot.names.lobbies(guild.id).remove(lobby_id)
+            self.bot.dispatch('lobby_change', guild)
+        self.unschedule_lobbies(guild, report['lobby_ids'])
+        duration_ms = (time.perf_counter() - started) * 1000
+        logging.info('Cleaned %s: %s leaderless and %s expired lobbies, %s participants in %.1f ms',
+            guild.name, report['leaderless'], report['expired'], report['participants'], duration_ms,
+            extra={'guild': guild.id, 'command': 'clean_lobbies', 'duration_ms': round(duration_ms, 2)}
+        )
+        return report
+
+    #----- deadlines -----
+    # scheduler keys are (kind, guild id, lobby id) tuples, kinds are:
+    #   expire  the date of the lobby has passed
+    #   vacate  the leader left the lobby
+    #   remind  the lobby starts in "reminder_lead" seconds
+    #   load    the next chunk of deadlines of the guild is due, the lobby id is the (date, lobby id) loaded last
+    async def load_deadlines(self, guilds, after=None):
         """
-            Delete empty lobbies if no leader is found
+            Schedule the lobbies which are due next in every guild, "deadline_chunk" of them per
+            guild. When a guild has more, the next chunk (after the (date, lobby id) loaded last)
+            is loaded in time for the reminders of its lobbies.
         """
+        chunk = self.lobby_settings['deadline_chunk']
         for guild in guilds:
-            con = self.connect_to_db(guild.name)
-            lobbies = con.select_lobbies()
-            for lobby_id in lobbies.keys():
-                if con.has_no_leader(lobby_id):
-                    con.delete_lobby(lobby_id)
-        con.session.close()
-    
+            deadlines = await self.db.run(guild, 'select_deadlines', chunk, after)
+            for lobby_id, date in deadlines:
+                self.schedule_lobby(guild, lobby_id, date)
+            if len(deadlines) == chunk:
+                lobby_id, date = deadlines[-1]
+                self.scheduler.schedule(
+                    ('load', guild.id, (date, lobby_id)), date - timedelta(seconds=self.lobby_settings['reminder_lead'])
+                )
+        logging.debug('Loaded %s deadlines' % (len(self.scheduler)))
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        self.cache.invalidate(guild.id)
+        self.bot.names.drop(guild.id)
+
+    def schedule_lobby(self, guild, lobby_id, date):
+        self.scheduler.schedule(('expire', guild.id, lobby_id), date)
+        if self.lobby_settings['reminder_lead']:
+            remind_at = date - timedelta(seconds=self.lobby_settings['reminder_lead'])
+            if remind_at > datetime.now():
+                self.scheduler.schedule(('remind', guild.id, lobby_id), remind_at)
+
+    def unschedule_lobbies(self, guild, lobby_ids):
+        for lobby_id in lobby_ids:
+            for kind in ('expire', 'vacate', 'remind'):
+                self.scheduler.cancel((kind, guild.id, lobby_id))
+
+    async def on_deadlines(self, keys):
+        """
+            Called by the scheduler with every key which is due
+        """
+        guilds_to_clean = dict()
+        for kind, guild_id, lobby_id in keys:
+            guild = self.bot.get_guild(guild_id)
+            if guild is None:
+                continue
+            if kind == 'remind':
+                await self.remind_participants(guild, lobby_id)
+            elif kind == 'load':
+                await self.load_deadlines([guild], after=lobby_id)
+            else:
+                guilds_to_clean[guild.id] = guild
+        for guild in guilds_to_clean.values():
+            await self.clean_guild(guild)
+
+    async def remind_participants(self, guild, lobby_id):
+        lobbies = await self.db.run(guild, 'select_lobbies', lobby_id=lobby_id)
+        if lobby_id not in lobbies:
+            return
+        lobby = lobbies[lobby_id]
+        message_to_render = self.render_message_attributes(
+            name=lobby['name'], date=lobby['date'], size=lobby['size'], server=guild.name
+        )
+        message_to_render.insert(0, ':space_invader: Get ready guardian, your lobby starts soon! :space_invader:')
+        for member_id in await self.db.run(guild, 'select_participant_ids', lobby_id):
+            member = guild.get_member(member_id)
+            if member is not None:
+                await member.send(''.join(message_to_render))
+
     #----- helper functions -----
+    async def select_lobbies(self, guild, member=False, name=False):
+        """
+            Same as MyDatabase.select_lobbies but served from the lobby cache when possible
+        """
+        lobbies = self.cache.get(guild.id)
+        if lobbies is None:
+            generation = self.cache.generation(guild.id)
+            lobbies = await self.db.run(guild, 'select_lobbies')
+            if self.db.may_be_stale(guild): # a lagging replica could miss the latest writes, do not keep them
+                return filter_lobbies(lobbies, member, name)
+            await self.index_lobbies(guild, lobbies, generation)
+            self.cache.put(guild.id, lobbies, generation)
+        return filter_lobbies(lobbies, member, name)
+
+    async def index_lobbies(self, guild, lobbies, generation):
+        """
+            Bring the lobby name index in line with lobbies loaded from database, unless a write
+            raced with the load. The first index of a guild is built off the event loop.
+        """
+        names = self.bot.names
+        items = [(lobby_id, lobby['name']) for lobby_id, lobby in lobbies.items()]
+        if not names.has(guild.id, 'lobbies'):
+            index = await self.bot.loop.run_in_executor(None, names.build, items)
+            if self.cache.generation(guild.id) == generation:
+                names.set(guild.id, 'lobbies', index)
+        elif self.cache.generation(guild.id) == generation:
+            names.lobbies(guild.id).update(items)
+
+    def match_lobbies(self, guild, lobbies, name):
+        """
+            The lobbies among "lobbies" with the best matching name for "name": the exact name,
+            the name in another case, names starting with it, then names with a typo or two.
+            Lobbies missing from the index (not built yet, evicted or behind) are found by exact name.
+        """
+        for group in rank_groups(self.bot.names.lobbies(guild.id).match(name, limit=50)):
+            matched = dict((lobby_id, lobby) for lobby_id, lobby in lobbies.items() if lobby['name'] in group)
+            if matched:
+                return matched
+        return filter_lobbies(lobbies, name=name)
+
+    async def leave(self, guild, lobby_id, member_id):
+        """
+            Remove a member from a lobby in database and cache, returns the number of rows removed
+            and the member leading the lobby in place of the member (None if it was not the leader
+            or nobody is left)
+        """
+        deleted, successor = await self.db.run(guild, 'leave_lobby', lobby_id, member_id)
+        if deleted:
+            self.forget_participant(guild, lobby_id, member_id, successor)
+            self.bot.dispatch('lobby_change', guild)
+        else:
+            self.cache.remove_participant(guild.id, lobby_id, member_id, successor)
+        return deleted, successor
+
+    async def remove_member(self, guild, member, lobby_ids, successors):
+        """
+            Follow up on a member who left the guild (see MyDatabase.delete_member) the way leave
+            does: the member is taken out of the cached lobbies of "lobby_ids", the participants of
+            the lobbies it led learn about their new leader ("successors"), lobbies left without
+            anyone are cleaned up right away.
+        """
+        for lobby_id in lobby_ids:
+            self.forget_participant(guild, lobby_id, member.id, successors.get(lobby_id))
+        for lobby_id, successor in successors.items():
+            if successor is None:
+                self.schedule_vacated(guild, lobby_id)
+                continue
+            lobby = (await self.db.run(guild, 'select_lobbies', lobby_id=lobby_id)).get(lobby_id)
+            if lobby is not None:
+                await self.announce_leader(guild, lobby_id, lobby, member, successor)
+        if lobby_ids:
+            self.bot.dispatch('lobby_change', guild)
+
+    def forget_participant(self, guild, lobby_id, member_id, successor):
+        """
+            Take a member the database removed from a lobby out of the cache, the lobby has a free slot again
+        """
+        self.cache.remove_participant(guild.id, lobby_id, member_id, successor)
+        join_lock = self.join_locks.get((guild.id, lobby_id))
+        if join_lock is not None:
+            join_lock[2] = False
+
+    def schedule_vacated(self, guild, lobby_id):
+        """
+            A lobby whose leader left as its last participant is cleaned up right away
+        """
+        self.scheduler.schedule(('vacate', guild.id, lobby_id), datetime.now())
+
+    async def announce_leader(self, guild, lobby_id, lobby, member, successor):
+        """
+            Tell the participants left in a lobby that its leader left and who leads it now
+        """
+        leader = guild.get_member(successor)
+        message_to_render = self.render_message_attributes(
+            name=lobby['name'], date=lobby['date'], size=lobby['size'], server=guild.name
+        )
+        message_to_render.insert(0, ':space_invader: %s left the following lobby, %s leads it from now on: :space_invader:' % (
+            member.name, leader.name if leader is not None else 'the next guardian in line'
+        ))
+        for member_id in await self.db.run(guild, 'select_participant_ids', lobby_id):
+            participant = guild.get_member(member_id)
+            if participant is not None:
+                await participant.send(''.join(message_to_render))
+
+    async def choose_lobby(self, ctx, lobbies, question, confirm=False):
+        """
+            Let the author pick one of several lobbies through a reaction menu in a direct message.
+            A single lobby is picked right away, unless "confirm" asks for a menu anyway. returns
+            (lobby id, member, menu message), the message is None without a menu.
+        """
+        if len(lobbies) == 1 and not confirm:
+            return next(iter(lobbies)), ctx.message.author, None
+
+        lobby_index = dict()
+        for id_num, lobby_id in enumerate(list(lobbies)[:len(emojis.numbers)]): # one emoji per lobby; limit = 11
+            lobby_index[id_num] = lobby_id
+            lobbies[lobby_id]['leave_id'] = id_num
+
+        render_text = self.render_lobby_layout(dict((lobby_id, lobbies[lobby_id]) for lobby_id in lobby_index.values()))
+        render_text.insert(0, 'Use the reactions to answer.')
+        render_text.insert(0, question)
+
+        bot_answer = await ctx.message.author.send(''.join(render_text))
+        lobby_id, _ = await self.bot.reactions.ask(
+            bot_answer,
+            dict((emojis.numbers[id_num], lobby_id) for id_num, lobby_id in lobby_index.items()),
+            ctx.message.author.id
+        )
+        if lobby_id is None:
+            await bot_answer.edit(content='```This menu has expired, run the command again to pick a lobby```')
+            return None, None, bot_answer
+        return lobby_id, ctx.message.author, bot_answer
+
+    async def reply(self, ctx, bot_answer, content):
+        """
+            Answer in place of the menu message if there was one, otherwise with a new direct message
+        """
+        if bot_answer is not None:
+            await bot_answer.edit(content=content)
+        else:
+            await ctx.message.author.send(content)
+
+    def render_lobby(self, lobby):
+        """
+            Render the slots of one lobby, a fragment of render_lobby_layout.
+            Fragments are memoized per lobby version, see FragmentCache.
+        """
+        return self.fragments.render(lobby, self.render_fragment, lobby.get('leave_id'))
+
+    def render_fragment(self, lobby):
+        if 'leave_id' in lobby:
+            render_text = [
+                '\n< ID: %s - %s at %s has the following members >\n' % (lobby['leave_id'], lobby['name'], lobby['date'])
+            ]
+        else:
+            render_text = [
+                '\n< %s at %s has the following members >\n' % (lobby['name'], lobby['date'])
+            ]
+        leader_id = lobby.get('leader_id')
+        for index, participant in enumerate(lobby['participant']):
+            if leader_id is not None and lobby['participant_ids'][index] == leader_id:
+                participant = '%s 👑' % (participant) # love that unicode babeeeeey
+            render_text.append(' - %s. %s\n' % (index + 1, participant))
+        for slot_number in range(len(render_text), lobby['size'] + 1):
+            render_text.append(' - %s. -\n' % (slot_number))
+        return ''.join(render_text)
+
     def render_lobby_layout(self, lobby_objects):
         render_text = [
                 '```javascript\n', 
             ]
         for lobby in lobby_objects.values():
-            lobby_layout_slots = dict((x,y) for x,y in ((z, '-') for z in range(1,lobby['size']+1)))
-
-            if 'leave_id' in lobby:
-                render_text.append(
-                    '\n< ID: %s - %s at %s has the following members >\n' % (lobby['leave_id'], lobby['name'], lobby['date'])
-                )
-            else:
-                render_text.append(
-                    '\n< %s at %s has the following members >\n' % (lobby['name'], lobby['date'])
-                )
-            for index, participant in enumerate(lobby['participant']):
-                if participant == lobby['leader']:
-                    participant = '%s 👑' % (participant) # love that unicode babeeeeey
-                lobby_layout_slots[index + 1] = '%s' % (participant)
-
-            for slot_number, slot_value in lobby_layout_slots.items():
-                render_text.append(' - %s. %s\n' % (slot_number, slot_value))
+            render_text.append(self.render_lobby(lobby))
         render_text.append('```')
         return render_text
 
+    def render_pages(self, lobby_objects, header='', limit=2000):
+        """
+            Render lobbies as a list of messages of at most "limit" characters (the discord limit).
+            Lobbies are never split across messages, "header" goes on top of the first one.
+        """
+        pages = list()
+        page = [header, '```javascript\n']
+        length = len(header) + len('```javascript\n```')
+        for lobby in lobby_objects.values():
+            fragment = self.render_lobby(lobby)
+            if len(fragment) > limit - len('```javascript\n```'): # a huge lobby gets cut off
+                fragment = fragment[:limit - len('```javascript\n...\n```')] + '...\n'
+            if length + len(fragment) > limit and len(page) > 2:
+                page.append('```')
+                pages.append(''.join(page))
+                page, length = ['```javascript\n'], len('```javascript\n```')
+            page.append(fragment)
+            length += len(fragment)
+        page.append('```')
+        pages.append(''.join(page))
+        return pages
+
     def render_message_attributes(self, name, date, size, server):
         return [
             '```javascript\n',
@@ -111,20 +421,48 @@ class Lobbies(commands.Cog):
         aliases=['c']
     )
     async def create(self, ctx, lobby_name, date, size):
-        date = TimeMachine(date).convert() # will raise and error if invalid format
+        """
+            Create a lobby led by the member. The date is read in the time zone of the guild,
+            see TimeMachine for the formats; wrap dates with spaces in quotes. Members partaking
+            in "max_lobbies_per_member" lobbies already cannot create another one.
+        """
+        try:
+            date = self.time_machine.parse(date, ctx.message.channel.guild.id)
+        except DateError as err:
+            await ctx.message.author.send('```Sorry guardian, %s```' % (err))
+            return
 
-        con = self.connect_to_db(ctx)
-        lobby_id = random.getrandbits(64)
+        lobby_id = lobby_ids.next_id() # time ordered, new lobbies are appended to the primary key
         create_settings = DataForm(method='create')
         create_settings.lobbyid = lobby_id
         create_settings.lobby = lobby_name
         create_settings.lobby_size = int(size)
         create_settings.date = date
+        create_settings.memid = ctx.message.author.id
+        create_settings.member = ctx.message.author.name
         create_settings.participation_member = ctx.message.author.id
         create_settings.participation_lobby = lobby_id
         data = create_settings.render()
-        
-        con.transact(data)
+
+        # the member limit is checked in the transaction of the insert, see MyDatabase.refuse_over_limit
+        limit = ('limit', {'memid': ctx.message.author.id, 'max_lobbies': self.lobby_settings['max_lobbies_per_member']})
+        try:
+            await self.bot.writes.submit(ctx.message.channel.guild, form_writes(data) + [limit])
+        except LimitError as err:
+            await ctx.message.author.send('```Sorry guardian, %s```' % (err))
+            return
+        self.bot.names.lobbies(ctx.message.channel.guild.id).add(lobby_id, lobby_name)
+        self.cache.add_lobby(ctx.message.channel.guild.id, lobby_id, {
+            'name':lobby_name,
+            'date':date,
+            'participant':[ctx.message.author.name],
+            'participant_ids':[ctx.message.author.id],
+            'size':int(size),
+            'leader':ctx.message.author.name,
+            'leader_id':ctx.message.author.id
+        })
+        self.schedule_lobby(ctx.message.channel.guild, lobby_id, date)
+        self.bot.dispatch('lobby_change', ctx.message.channel.guild)
 
         message_to_render = self.render_message_attributes(
             **{
@@ -148,26 +486,104 @@ class Lobbies(commands.Cog):
         aliases=['l']
     )
     async def list_lobbies(self, ctx, scope='[ membername ] | me'):
-        con = self.connect_to_db(ctx)
-
+        """
+            List every lobby, the lobbies of the author ("me") or of a member. Member names are
+            looked up in the name index, so a prefix, another case or a typo find the member too;
+            several equally good matches are offered as suggestions instead.
+        """
         existing_lobbies = list()
+        header = ':space_invader: I have gathered the following information for you! :space_invader:'
 
+        guild = ctx.message.channel.guild
         if scope == '[ membername ] | me':
-            existing_lobbies = con.select_lobbies()
+            existing_lobbies = await self.select_lobbies(guild)
         elif scope == 'me':
-            existing_lobbies = con.select_lobbies(ctx.message.author.id)
+            existing_lobbies = await self.select_lobbies(guild, ctx.message.author.id)
         elif scope:
-            member = con.select_member(scope)
-            if member:
-                existing_lobbies = con.select_lobbies(member.id)            
+            members = await self.bot.get_cog('MemberSync').member_names(guild)
+            groups = rank_groups(members.match(scope))
+            if groups and len(groups[0]) > 1:
+                await ctx.message.channel.send('```Did you mean one of: %s?```' % (', '.join(groups[0])))
+                return
+            if groups:
+                existing_lobbies = dict()
+                for member_id in members.keys(groups[0][0]):
+                    existing_lobbies.update(await self.select_lobbies(guild, member_id))
+                if groups[0][0] != scope:
+                    header = ':space_invader: Lobbies of %s: :space_invader:' % (groups[0][0])
 
         if existing_lobbies:
-            render_text = self.render_lobby_layout(existing_lobbies)
-            render_text.insert(0, ':space_invader: I have gathered the following information for you! :space_invader:')
-            await ctx.message.channel.send(content=''.join(render_text))
+            for page in self.render_pages(existing_lobbies, header):
+                await ctx.message.channel.send(content=page)
         else:
             await ctx.message.channel.send('```Well actually nothing was found :(```')
 
+    @commands.command(
+        name='join',
+        description='Join a lobby. A lobby cannot hold more members than its size.',
+        aliases=['j']
+    )
+    async def join_lobby(self, ctx, lobby_name):
+        """
+            Join a lobby by name. If more than one lobby is found the member picks one from a list
+            in a direct message. Whether the lobby has a free slot and whether the member partakes in
+            too many lobbies already is decided by the database, atomically with the insert.
+        """
+        guild = ctx.message.channel.guild
+        existing_lobbies = await self.select_lobbies(guild, name=lobby_name)
+        if not existing_lobbies:
+            await ctx.message.author.send('```Sorry guardian, I could not find any matches for %s in server %s```'
+                % (lobby_name, guild.name)
+            )
+            return
+
+        lobby_id, member, bot_answer = await self.choose_lobby(
+            ctx, existing_lobbies, ':space_invader: Found multiple matches, which one would you like to join? :space_invader:'
+        )
+        if lobby_id is None:
+            return
+
+        # joins of one lobby wait here rather than holding a database thread while waiting for the row lock
+        # joins queued behind one which found the lobby full are refused without a query, until someone leaves
+        join_lock = self.join_locks.setdefault((guild.id, lobby_id), [asyncio.Lock(), 0, False])
+        join_lock[1] += 1
+        try:
+            async with join_lock[0]:
+                if join_lock[2]:
+                    status = 'full'
+                else:
+                    status = await self.db.run(
+                        guild, 'join_lobby', lobby_id, member.id, member.name, self.lobby_settings['max_lobbies_per_member']
+                    )
+                    join_lock[2] = status == 'full'
+        finally:
+            join_lock[1] -= 1
+            if not join_lock[1]:
+                self.join_locks.pop((guild.id, lobby_id), None)
+
+        lobby = existing_lobbies[lobby_id]
+        if status == 'joined':
+            self.cache.add_participant(guild.id, lobby_id, member.id, member.name)
+            self.bot.dispatch('lobby_change', guild)
+            header = ':space_invader: I added you to the following lobby: :space_invader:'
+        elif status == 'already':
+            header = ':space_invader: You already partake in the following lobby: :space_invader:'
+        elif status == 'full':
+            header = ':space_invader: Sorry guardian, the following lobby is full: :space_invader:'
+        elif status == 'limit':
+            header = ':space_invader: Sorry guardian, you cannot partake in more than %s lobbies: :space_invader:' % (
+                self.lobby_settings['max_lobbies_per_member']
+            )
+        else: # removed since it was listed
+            self.cache.invalidate(guild.id)
+            header = ':space_invader: Sorry guardian, the following lobby does not exist anymore: :space_invader:'
+
+        message_to_render = self.render_message_attributes(
+            name=lobby['name'], date=lobby['date'], size=lobby['size'], server=guild.name
+        )
+        message_to_render.insert(0, header)
+        await self.reply(ctx, bot_answer, ''.join(message_to_render))
+
     @commands.command(
         name='leave',
         description='Leave a lobby. If lobby is left without any participants it will be removed.',
@@ -178,81 +594,42 @@ class Lobbies(commands.Cog):
             Leave a lobby which the member is partaking in. If more than one lobby is found
             then the user will get the choice of leaving one of the lobbies in a list. The bot directly
             communicates the with the member through direct messaging.
+            The name does not need to be exact, see match_lobbies; a lobby found by another case,
+            a prefix or a typo is only left once the member confirmed it in the list.
         """
-        def create_lobby_attrs_as_dict(lobby):
-            attr_dict = {
-                'name':lobby['name'],
-                'date':lobby['date'],
-                'size':lobby['size'],
-                'server':ctx.message.channel.guild.name
-            }
-            return attr_dict
-
-        con = self.connect_to_db(ctx)
         # See if any lobby matches the user
-        existing_lobbies = con.select_lobbies(member=ctx.message.author.id, name=lobby_name)
+        existing_lobbies = self.match_lobbies(
+            ctx.message.channel.guild,
+            await self.select_lobbies(ctx.message.channel.guild, member=ctx.message.author.id),
+            lobby_name
+        )
         if existing_lobbies:
-            if len(list(existing_lobbies.keys())) > 1:  # more than one lobby is found
-                
-                leave_lobby_index = dict()
-                for id_num, lobby in enumerate(existing_lobbies.items()):
-                    leave_lobby_index[id_num] = lobby[0]
-                    lobby[1]['leave_id'] = id_num
-                    existing_lobbies[lobby[0]] = lobby[1]
-
-                render_text = self.render_lobby_layout(existing_lobbies)
-                render_text.insert(0, 'Use the reactions to answer.')
-                render_text.insert(0, ':space_invader: Found multiple matches, which one would you like to leave? :space_invader:')
-
-                bot_answer = await ctx.message.author.send(''.join(render_text))
-                for id_num in leave_lobby_index: # Add an equal amount of emojis as to the matched lobbies; limit = 10
-                    await bot_answer.add_reaction(emojis.numbers[id_num])
-
-                def check(reaction, user):
-                    """
-                        Check if the reactions match the same lobby as the latest rendered one. And if the 
-                        reacted emoji only is part of the ones the bot added. Returns a boolean.
-                    """
-                    print('checking reaction')
-                    result = reaction.message.id == bot_answer.id and str(reaction.emoji) in emojis.numbers.values() and user.id != bot_answer.author.id
-                    return result
-                    
-                reaction, user = await self.bot.wait_for('reaction_add', check=check)
-                if reaction and user:
-                    lobby_index_key = next(key for key, value in emojis.numbers.items() if value == reaction.emoji)
-
-                    lobby_id=leave_lobby_index[lobby_index_key]
-                    member_id=user.id
-                    if con.delete_particiant_from_lobby(lobby_id, member_id): # perform deletion here
-                        lobby_attrs = create_lobby_attrs_as_dict(existing_lobbies[lobby_id])
-                        message_to_render = self.render_message_attributes(
-                            **lobby_attrs
-                        )
-                        message_to_render.insert(0, ':space_invader: I deleted you from the following lobby: :space_invader:')
-                        await bot_answer.edit(
-                            content=''.join(message_to_render)
-                        ) # then edit the message that the bot rendered earlier
+            inexact = any(lobby['name'] != lobby_name for lobby in existing_lobbies.values())
+            if len(existing_lobbies) > 1:
+                question = ':space_invader: Found multiple matches, which one would you like to leave? :space_invader:'
             else:
-                lobby_id = list(existing_lobbies.keys())[0]
-                member_id = ctx.message.author.id
-                lobby_attrs = create_lobby_attrs_as_dict(list(existing_lobbies.values())[0])
+                question = ':space_invader: Did you mean the following lobby? React to leave it: :space_invader:'
+            lobby_id, member, bot_answer = await self.choose_lobby(ctx, existing_lobbies, question, confirm=inexact)
+            if lobby_id is None:
+                return
+            deleted, successor = await self.leave(ctx.message.channel.guild, lobby_id, member.id) # perform deletion here
+            if deleted:
+                lobby = existing_lobbies[lobby_id]
+                if successor is None:
+                    if lobby.get('leader_id') == member.id:
+                        self.schedule_vacated(ctx.message.channel.guild, lobby_id)
+                else:
+                    await self.announce_leader(ctx.message.channel.guild, lobby_id, lobby, member, successor)
                 message_to_render = self.render_message_attributes(
-                        **lobby_attrs
-                    )
-
-                con.delete_particiant_from_lobby(
-                    lobby_id, member_id
+                    name=lobby['name'], date=lobby['date'], size=lobby['size'], server=ctx.message.channel.guild.name
                 )
                 message_to_render.insert(0, ':space_invader: I deleted you from the following lobby: :space_invader:')
-                await ctx.message.author.send(''.join(message_to_render))
+                await self.reply(ctx, bot_answer, ''.join(message_to_render))
         else:
             await ctx.message.author.send('```Sorry guardian, I could not find any matches for %s in server %s```'
                 % (lobby_name, ctx.message.channel.guild.name)
             )
 
-        # await ctx.message.author.send(ctx, existing_lobbies)
-        # print(list(existing_lobbies.keys()))
-        
 def setup(bot):
     bot.add_cog(Lobbies(bot))
     # Adds the Basic commands to the bot
@@ -0,0 +1,101 @@
+import time
+import logging
+
+from discord.ext import commands
+
+
+class MemberSync(commands.Cog):
+    """
+        Keep the members table of every guild database up to date.
+        A full (bulk) sync runs once per guild per process when the guild is warmed (see
+        startup.py), after that the member events below keep the table current so reconnects
+        do not need a resync. Events of guilds which are not synced yet are left to that sync.
+        The member name index (see name_index.py) follows the table.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.db = bot.db
+        self.synced_guilds = set()
+
+    async def sync_guild(self, guild, force=False):
+        """
+            Upsert every new or renamed member of a guild into its database
+        """
+        if guild.id in self.synced_guilds and not force:
+            return
+        started = time.perf_counter()
+        members = [(member.id, member.name) for member in guild.members]
+        report = await self.db.run(guild, 'sync_members', members)
+        names = await self.bot.loop.run_in_executor(None, self.bot.names.build, members)
+        self.bot.names.set(guild.id, 'members', names)
+        self.synced_guilds.add(guild.id)
+        logging.info('Synced members of %s: %s new, %s renamed, %s unchanged in %.1f ms' % (
+            guild.name, report['inserted'], report['renamed'], report['unchanged'],
+            (time.perf_counter() - started) * 1000
+        ))
+
+    async def member_names(self, guild):
+        """
+            The member name index of a guild, rebuilt from the member list if it was evicted
+        """
+        names = self.bot.names
+        if not names.has(guild.id, 'members'):
+            members = [(member.id, member.name) for member in guild.members]
+            names.set(guild.id, 'members', await self.bot.loop.run_in_executor(None, names.build, members))
+        return names.members(guild.id)
+
+    async def upsert_member(self, guild, member, renamed=True):
+        """
+            Store a new or renamed member. A member who just joined partakes in no lobby, only
+            the cached lobbies of a renamed member need its new name.
+        """
+        if guild.id not in self.synced_guilds: # the full sync on first use picks the change up
+            return
+        await self.db.run(guild, 'sync_members', [(member.id, member.name)])
+        self.bot.names.members(guild.id).add(member.id, member.name)
+        if renamed and self.bot.lobby_cache.rename_member(guild.id, member.id, member.name):
+            self.bot.dispatch('lobby_change', guild)
+
+    #----- listeners -----
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        self.synced_guilds.discard(guild.id)
+        self.bot.names.drop(guild.id)
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        await self.upsert_member(member.guild, member, renamed=False)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before, after):
+        if before.name != after.name:
+            await self.upsert_member(after.guild, after)
+
+    @commands.Cog.listener()
+    async def on_user_update(self, before, after):
+        """
+            Username changes are user wide, update every guild the user is a member of
+        """
+        if before.name == after.name:
+            return
+        for guild in self.bot.shard_guilds.all():
+            if guild.get_member(after.id) is not None:
+                await self.upsert_member(guild, after)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        if member.guild.id not in self.synced_guilds: # nothing stored yet, do not create its database
+            return
+        lobby_ids, successors = await self.db.run(member.guild, 'delete_member', member.id)
+        self.bot.names.members(member.guild.id).remove(member.id)
+        lobbies = self.bot.get_cog('Lobbies')
+        if lobbies is not None:
+            await lobbies.remove_member(member.guild, member, lobby_ids, successors)
+        elif lobby_ids:
+            self.bot.lobby_cache.invalidate(member.guild.id)
+            self.bot.dispatch('lobby_change', member.guild)
+
+
+def setup(bot):
+    bot.add_cog(MemberSync(bot))
@@ -0,0 +1,104 @@
+import os
+import json
+import logging
+
+from discord.ext import commands, tasks
+from metrics import metrics
+
+
+class Stats(commands.Cog):
+    """
+        Expose the rolling metrics of metrics.py, through the owner-only --stats command and a
+        metrics file in the prometheus text format which is rewritten every "interval" seconds.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+
+        WORKING_DIR = os.path.abspath(os.curdir)
+        settings_file = open(os.path.join(WORKING_DIR, 'settings.json'), 'r')
+        settings = json.loads(settings_file.read())
+        settings_file.close()
+        self.metric_settings = {
+            'file': os.path.join(WORKING_DIR, 'metrics.prom'),
+            'interval': 60,
+            **settings.get('metrics', {})
+        }
+
+        metrics.install_sql_counter()
+        metrics.install_discord_timer(self.bot)
+        if self.metric_settings['file']:
+            self.task_write_metrics.change_interval(seconds=self.metric_settings['interval'])
+            self.task_write_metrics.start()
+
+    def cog_unload(self):
+        self.task_write_metrics.cancel()
+
+    def gauges(self):
+        gauges = {'guilds': len(self.bot.guilds)}
+        for shard_id, guilds in self.bot.shard_guilds.items():
+            gauges['shard_%s_guilds' % (shard_id)] = len(guilds)
+        for name, value in self.bot.lobby_cache.stats().items():
+            gauges['lobby_cache_%s' % (name)] = value
+        for name, value in self.bot.reactions.stats().items():
+            gauges['menus_%s' % (name)] = value
+        for name, value in self.bot.names.stats().items():
+            gauges['name_index_%s' % (name)] = value
+        for name, value in self.bot.warmup.stats().items():
+            gauges['guilds_%s' % (name)] = value
+        for name, value in self.bot.db.stats().items():
+            gauges['db_%s' % (name)] = value
+        lobbies = self.bot.get_cog('Lobbies')
+        if lobbies is not None:
+            for name, value in lobbies.fragments.stats().items():
+                gauges['render_cache_%s' % (name)] = value
+        board = self.bot.get_cog('Board')
+        if board is not None:
+            for name, value in board.stats().items():
+                gauges['board_messages_%s' % (name)] = value
+        return gauges
+
+    @tasks.loop(seconds=60)
+    async def task_write_metrics(self):
+        """
+            Write the metrics file atomically so a scraper never reads half of it
+        """
+        path = self.metric_settings['file']
+        with open(path + '.tmp', 'w') as metrics_file:
+            metrics_file.write(metrics.prometheus(self.gauges()))
+        os.replace(path + '.tmp', path)
+        logging.debug('Wrote metrics to %s' % (path))
+
+    def render_stats(self):
+        snapshot = metrics.snapshot()
+        render_text = [
+            '```javascript\n',
+            'Uptime'.ljust(20, ' ') + '%d s\n' % (snapshot['uptime_s']),
+            'SQL statements'.ljust(20, ' ') + '%s\n' % (snapshot['sql_statements']),
+        ]
+        for name, value in self.gauges().items():
+            render_text.append(name.ljust(20, ' ') + '%s\n' % (value))
+        render_text.append('\n%s %8s %8s %8s %8s\n' % ('histogram'.ljust(38, ' '), 'count', 'p50', 'p95', 'p99'))
+        for name, summary in sorted(snapshot['histograms'].items()):
+            if 'p50' not in summary:
+                continue
+            render_text.append('%s %8d %8.1f %8.1f %8.1f\n' % (
+                name.ljust(38, ' ')[:38], summary['count'], summary['p50'], summary['p95'], summary['p99']
+            ))
+        render_text.append('```')
+        return render_text
+
+    @commands.command(
+        name='stats',
+        description='Show command latency, database and discord api timings. Bot owner only.',
+    )
+    @commands.is_owner()
+    async def stats(self, ctx):
+        content = ''.join(self.render_stats())
+        if len(content) > 2000: # discord message limit
+            content = content[:1993] + '\n...```'
+        await ctx.message.author.send(content)
+
+
+def setup(bot):
+    bot.add_cog(Stats(bot))
@@ -1,171 +1,624 @@
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, DateTime, create_engine, ForeignKey, Boolean, Sequence
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, create_engine, ForeignKeyConstraint, Boolean, Sequence, Index, and_, or_, text
+from sqlalchemy import DDL, case, event, extract, func, insert, literal, select
+from sqlalchemy.orm import sessionmaker, aliased
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 from sqlalchemy_utils import create_database, database_exists
-from sqlalchemy.exc import IntegrityError, InvalidRequestError
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from collections import OrderedDict
+from datetime import datetime
+from snowflake import snowflake_at
 
+import collections
+import glob
 import logging
-
-logging.basicConfig(
-        level=logging.DEBUG,
-        filename='backend_logs.log', 
-        format='%(asctime)s - %(process)s - %(module)s -  %(levelname)s - %(message)s'
-    )
+import os
+import re
+import threading
+import time
 
 Base = declarative_base()
 
+# Every table is keyed by guild_id first. In the default "per_guild" storage mode every guild
+# has its own database and guild_id is always 0; in "shared" mode all guilds live in one
+# database and guild_id holds the guild snowflake. Member, channel and message ids are discord
+# snowflakes and lobby ids time ordered snowflakes of our own (see snowflake.py), all stored as BIGINT.
+
 class Members( Base ):
     __tablename__ = 'members'
+    __table_args__ = (
+        Index('ix_members_name', 'guild_id', 'name'),
+        {'mysql_engine': 'InnoDB'}
+    )
 
-    id = Column(String(64), primary_key=True)
+    guild_id = Column(BigInteger(), primary_key=True, autoincrement=False, default=0, server_default='0')
+    id = Column(BigInteger(), primary_key=True, autoincrement=False)
     name = Column(String(50))
-    mysql_engine = 'InnoDB'
 
 class Lobby( Base ):
     __tablename__ = 'lobby'
+    __table_args__ = (
+        Index('ix_lobby_name', 'guild_id', 'name'),
+        Index('ix_lobby_date', 'guild_id', 'date'),
+        {'mysql_engine': 'InnoDB'}
+    )
 
-    id = Column(String(64), primary_key=True)
+    guild_id = Column(BigInteger(), primary_key=True, autoincrement=False, default=0, server_default='0')
+    id = Column(BigInteger(), primary_key=True, autoincrement=False)
     name = Column(String(50))
     date = Column(DateTime)
     size = Column(Integer())
-    mysql_engine = 'InnoDB'
 
 class Participants( Base ):
     __tablename__ = 'participants'
+    __table_args__ = (
+        ForeignKeyConstraint(
+            ['guild_id', 'memid'], ['members.guild_id', 'members.id'], name='fk_participants_member'
+        ),
+        ForeignKeyConstraint(
+            ['guild_id', 'lobbyid'], ['lobby.guild_id', 'lobby.id'], name='fk_participants_lobby'
+        ),
+        Index('ix_participants_memid', 'guild_id', 'memid'),
+        Index('ix_participants_lobbyid', 'guild_id', 'lobbyid'),
+        Index('uq_participants_memid_lobbyid', 'guild_id', 'memid', 'lobbyid', unique=True),
+        {'mysql_engine': 'InnoDB'}
+    )
+
     row_id = Column(
         Integer(), Sequence('row_id', start=0, increment=1), primary_key=True
     )
-    memid = Column(String(64), ForeignKey('members.id'), nullable=False)
-    lobbyid = Column(String(64), ForeignKey('lobby.id'), nullable=False)
-    leader = Column(String(50))
-    mysql_engine = 'InnoDB'
+    guild_id = Column(BigInteger(), nullable=False, default=0, server_default='0')
+    memid = Column(BigInteger(), nullable=False)
+    lobbyid = Column(BigInteger(), nullable=False)
+    leader = Column(BigInteger()) # member id of the leader on the row of the leader, otherwise NULL
 
-class MyDatabase():
+# Finished lobbies are moved out of the live tables into the archive tables below (see
+# MyDatabase.archive_lobbies). On mysql they are RANGE partitioned by "month" (YYYYMM of the lobby
+# date): a table starts with the catch-all partition p_future which add_archive_partitions splits
+# month by month ahead of time, so old history can be dropped a partition at a time.
+ARCHIVE_PARTITIONING = 'PARTITION BY RANGE (month) (PARTITION p_future VALUES LESS THAN MAXVALUE)'
+
+class LobbyArchive( Base ):
+    __tablename__ = 'lobby_archive'
+    __table_args__ = {'mysql_engine': 'InnoDB'}
+
+    guild_id = Column(BigInteger(), primary_key=True, autoincrement=False, default=0, server_default='0')
+    month = Column(Integer(), primary_key=True, autoincrement=False)
+    id = Column(BigInteger(), primary_key=True, autoincrement=False)
+    name = Column(String(50))
+    date = Column(DateTime)
+    size = Column(Integer())
+    reason = Column(String(16)) # expired, leaderless or deleted
+    archived = Column(DateTime)
+
+class ParticipantArchive( Base ):
+    __tablename__ = 'participant_archive'
+    __table_args__ = (
+        Index('ix_participant_archive_memid', 'guild_id', 'memid'),
+        {'mysql_engine': 'InnoDB'}
+    )
+
+    guild_id = Column(BigInteger(), primary_key=True, autoincrement=False, default=0, server_default='0')
+    month = Column(Integer(), primary_key=True, autoincrement=False)
+    lobbyid = Column(BigInteger(), primary_key=True, autoincrement=False)
+    memid = Column(BigInteger(), primary_key=True, autoincrement=False)
+    name = Column(String(50)) # name of the member when the lobby was archived
+    leader = Column(Boolean())
+
+ARCHIVE_TABLES = (LobbyArchive.__tablename__, ParticipantArchive.__tablename__)
+for archive_table in (LobbyArchive.__table__, ParticipantArchive.__table__):
+    event.listen(archive_table, 'after_create', DDL('ALTER TABLE %(table)s ' + ARCHIVE_PARTITIONING).execute_if(dialect='mysql'))
+
+
+def archive_month(date):
     """
-        Return a database handler object which can be used for working with database entries.
-        If the given database name argument is not found then the database shall be created.
+        The archive partition key of a date, e.g. 202610
     """
+    return date.year * 100 + date.month
+
+
+def next_month(month):
+    return month + 89 if month % 100 == 12 else month + 1
+
+class BoardPage( Base ):
+    """
+        One row per message of the lobby board of a guild, see cogs/board.py
+    """
+    __tablename__ = 'board_pages'
+    __table_args__ = {'mysql_engine': 'InnoDB'}
+
+    guild_id = Column(BigInteger(), primary_key=True, autoincrement=False, default=0, server_default='0')
+    page = Column(Integer(), primary_key=True, autoincrement=False)
+    channel_id = Column(BigInteger(), nullable=False)
+    message_id = Column(BigInteger())
+    digest = Column(String(64)) # hash of the content the message was last sent with
+
+class SchemaVersion( Base ):
+    """
+        One row per migration applied to the database, see migrations.py
+    """
+    __tablename__ = 'schema_version'
+    __table_args__ = {'mysql_engine': 'InnoDB'}
+
+    version = Column(Integer(), primary_key=True, autoincrement=False)
+    description = Column(String(200))
+    applied = Column(DateTime)
 
-    def __init__(self, user, password, ip, port, db_name, debug=False):
-        try:
-            url = "mysql+mysqldb://%s:%s@%s:%s/%s" % (
-                user, password,
-                ip, port,
-                db_name
-            )
-        except Exception as err:
-            logging.exception("Exception occurred: %s" % (err))
 
-        # configure Session class with desired options
-        Session = sessionmaker()
-        # create the url (database) if it does not exist
-        # and associate it with a sql_alchemy engine.
-        if not database_exists(url): 
+class LimitError(Exception):
+    """
+        A write refused because the member partakes in too many lobbies, the message is meant for the member
+    """
+
+
+# attempts of a locking transaction which MySQL aborted because of a deadlock
+LOCK_RETRIES = 3
+
+
+class EngineRegistry():
+    """
+        Process wide registry of sqlalchemy engines, one per database url.
+        Creating an engine probes (and possibly creates and migrates) the database the first time
+        it is used, and the engine together with its connection pool is reused afterwards.
+        Engines are kept in a bounded LRU; the least recently used engine is disposed when the
+        limit is reached and engines which have not been used for "idle_timeout" seconds are
+        disposed on the next lookup.
+    """
+
+    def __init__(self, max_engines=64, pool_size=5, max_overflow=5, pool_recycle=3600, idle_timeout=900):
+        self.engines = OrderedDict() # (url, partition) -> [engine, Session, last_used]
+        self.creating = dict() # (url, partition) -> lock held while its engine is created
+        self.prepared = set() # urls whose database exists and is migrated
+        self.lock = threading.Lock()
+        self.configure(
+            max_engines=max_engines,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_recycle=pool_recycle,
+            idle_timeout=idle_timeout
+        )
+
+    def configure(self, max_engines=None, pool_size=None, max_overflow=None, pool_recycle=None, idle_timeout=None):
+        """
+            Change the registry limits, typically with the "pool" section of settings.json.
+            Only engines created after this call are affected by pool related settings.
+        """
+        if max_engines is not None:
+            self.max_engines = int(max_engines)
+        if pool_size is not None:
+            self.pool_size = int(pool_size)
+        if max_overflow is not None:
+            self.max_overflow = int(max_overflow)
+        if pool_recycle is not None:
+            self.pool_recycle = int(pool_recycle)
+        if idle_timeout is not None:
+            self.idle_timeout = int(idle_timeout)
+
+    def _create_engine(self, url, db_name, prepare=True):
+        """
+            Create the database if it does not exist and associate it with a sql_alchemy engine.
+            Engines of read replicas are created without "prepare": replicas get their databases
+            and schema changes from the primary, never from us.
+        """
+        import migrations # migrations imports the models from this module
+
+        if url.startswith('sqlite'):
+            # sqlite is only used for local benchmarks, every worker thread gets its own connection
+            engine_options = {'connect_args': {'check_same_thread': False, 'timeout': 30}}
+        else:
+            engine_options = {
+                'pool_size': self.pool_size,
+                'max_overflow': self.max_overflow,
+                'pool_recycle': self.pool_recycle,
+                'pool_pre_ping': True
+            }
+        if not prepare or url in self.prepared: # an engine of this database existed before, skip the probes
+            return create_engine(url, **engine_options)
+        if not database_exists(url):
             logging.debug('database not found, creating a new one named: %s' % (db_name))
-            create_database(url)
-            engine = (create_engine(url))
+            create_database(url, encoding='utf8mb4')
+            engine = create_engine(url, **engine_options)
 
             logging.debug('populating %s with tables...' % (db_name))
             Base.metadata.create_all(engine)
+            migrations.stamp(engine)
             logging.debug('done populating %s with tables!' % (db_name))
         else:
-            engine = (create_engine(url))
-            
-        # associate the created engine with our custom Session class
-        Session.configure(bind=engine)
-        # work with the session and make it available to all methods
-        self.session = Session()
+            engine = create_engine(url, **engine_options)
+            migrations.migrate(engine)
+        self.prepared.add(url)
+        return engine
 
-    def transact(self, data):
+    def _evict(self, key):
+        engine = self.engines.pop(key)[0]
+        logging.debug('disposing engine for %s' % (engine.url.database))
+        engine.dispose()
+
+    def evict_idle(self):
         """
-            Translate passed data into sqlalchemy objects and prepare them for further processing.
-            returns a list of objects which can be used by Session().
+            Dispose engines which have been idle for longer than "idle_timeout" seconds.
+            The LRU is ordered by last use, so the scan stops at the first engine still in use.
         """
-        transactions = list()
-        if data['settings']['member']['id']:
-            logging.debug('Preparing member entries...')
-            transactions.append(Members(**data['settings']['member']))
+        with self.lock:
+            deadline = time.monotonic() - self.idle_timeout
+            while self.engines:
+                key, entry = next(iter(self.engines.items()))
+                if entry[2] > deadline:
+                    break
+                self._evict(key)
 
-        if data['settings']['lobby']['id']:
-            logging.debug('Preparing lobby entries...')
-            transactions.append(Lobby(**data['settings']['lobby']))
+    def sessionmaker(self, url, db_name, partition=None, prepare=True):
+        """
+            Return the session factory bound to the (cached) engine of the given url.
+            Every partition of a url gets an engine, and thereby a connection pool, of its own.
+            Engines of different databases are created in parallel, the first user of a
+            database waits for its creation (and migration) while everyone else carries on.
+        """
+        self.evict_idle()
+        key = (url, partition)
+        with self.lock:
+            entry = self.engines.get(key)
+            if entry is not None:
+                self.engines.move_to_end(key)
+                entry[2] = time.monotonic()
+                return entry[1]
+            creating = self.creating.setdefault(key, threading.Lock())
 
-        if data['settings']['participations']['memid'] and data['settings']['participations']['lobbyid']:
-            logging.debug('Preparing participation entries...')
-            transactions.append(Participants(**data['settings']['participations']))
+        with creating:
+            with self.lock:
+                entry = self.engines.get(key)
+            if entry is None:
+                engine = self._create_engine(url, db_name, prepare)
+                entry = [engine, sessionmaker(bind=engine), None]
+                with self.lock:
+                    self.engines[key] = entry
+                    self.creating.pop(key, None)
+                    while len(self.engines) > self.max_engines:
+                        self._evict(next(iter(self.engines)))
+        entry[2] = time.monotonic()
+        return entry[1]
 
-        call_transaction = getattr(self, data['method'])
-        logging.debug('Calling transaction with: %s' % (call_transaction))
-        call_transaction(transactions)
+    def dispose_all(self):
+        """
+            Dispose every engine, closing all pooled connections.
+        """
+        with self.lock:
+            while self.engines:
+                self._evict(next(iter(self.engines)))
+
+
+registry = EngineRegistry()
+
+
+def guild_db_name(guild_name):
+    """
+        Database name used for a guild, whitespaces are not allowed in database names
+    """
+    return re.sub(r' ', '', guild_name)
+
+
+def guild_database(storage, guild):
+    """
+        Return the "db_name" and "guild_id" arguments of MyDatabase for a guild, depending on
+        the "storage" section of settings.json:
+
+            "per_guild" (default)   one database per guild named after the guild, guild_id 0
+            "shared"                every guild in the database named by "database", keyed by guild id
+    """
+    if storage.get('mode', 'per_guild') == 'shared':
+        return {"db_name": storage.get('database', 'eventplanner'), "guild_id": guild.id}
+    return {"db_name": guild_db_name(guild.name), "guild_id": 0}
+
+
+def database_url(user=None, password=None, ip=None, port=None, db_name=None, driver='mysql', directory='.'):
+    """
+        The sqlalchemy url of a database, an empty "db_name" addresses the mysql server itself
+    """
+    if driver == 'sqlite': # a file per database inside "directory", used for offline benchmarks
+        return "sqlite:///%s" % (os.path.join(os.path.abspath(directory), '%s.sqlite' % (db_name)))
+    return "mysql+mysqldb://%s:%s@%s:%s/%s?charset=utf8mb4" % (
+        user, password,
+        ip, port,
+        db_name
+    )
+
+
+# what guild_database needs to know about a guild when no discord guild object is at hand
+Guild = collections.namedtuple('Guild', ('id', 'name'))
 
-    def select_member(self, member_name):
+
+def stored_guilds(db_settings, storage):
+    """
+        Every guild which has data in the database, without creating any database: the guild ids
+        of the shared database in "shared" storage mode, every database holding a lobby table in
+        "per_guild" mode (named after the guild, with guild id 0).
+    """
+    server = dict((key, db_settings.get(key)) for key in ('user', 'password', 'ip', 'port', 'driver', 'directory'))
+    server['driver'] = server['driver'] or 'mysql'
+    server['directory'] = server['directory'] or '.'
+    if storage.get('mode', 'per_guild') == 'shared':
+        shared = guild_database(storage, Guild(0, ''))
+        if not database_exists(database_url(db_name=shared['db_name'], **server)):
+            return list()
+        with MyDatabase(**{**db_settings, **shared}) as con:
+            guild_ids = [guild_id for guild_id, in con.session.query(Lobby.guild_id).distinct()]
+        return [Guild(guild_id, str(guild_id)) for guild_id in guild_ids]
+
+    if server['driver'] == 'sqlite':
+        paths = glob.glob(os.path.join(os.path.abspath(server['directory']), '*.sqlite'))
+        return [Guild(0, os.path.basename(path)[:-len('.sqlite')]) for path in sorted(paths)]
+
+    engine = create_engine(database_url(db_name='', **server))
+    try:
+        with engine.connect() as connection:
+            names = connection.execute(text(
+                "SELECT table_schema FROM information_schema.tables WHERE table_name = 'lobby' ORDER BY table_schema"
+            )).scalars().all()
+    finally:
+        engine.dispose()
+    return [Guild(0, name) for name in names]
+
+
+class MyDatabase():
+    """
+        Return a database handler object which can be used for working with database entries.
+        If the given database name argument is not found then the database shall be created.
+
+        The handler wraps a single short-lived session taken from the process wide engine
+        registry. Use it as a context manager so the connection is always returned to the pool:
+
+            with MyDatabase(**settings) as con:
+                con.select_lobbies()
+
+        Every query is scoped to "guild_id", see guild_database. Handlers of different
+        "partition"s (shards) of the same database draw from separate connection pools.
+
+        A "read_only" handler reads from the "replica" server when one is configured: a dict
+        overriding the connection settings of the primary ("ip", "port", "user", ...), the
+        database names are the same on both. Without a replica it uses the primary.
+    """
+
+    def __init__(self, user=None, password=None, ip=None, port=None, db_name=None, debug=False, guild_id=0,
+            driver='mysql', directory='.', partition=None, replica=None, read_only=False):
+        server = {'user': user, 'password': password, 'ip': ip, 'port': port, 'driver': driver, 'directory': directory}
+        replicated = bool(read_only and replica)
+        if replicated:
+            server.update((key, value) for key, value in replica.items() if key in server)
+        url = database_url(db_name=db_name, **server)
+
+        # work with the session and make it available to all methods
+        Session = registry.sessionmaker(url, db_name, partition, prepare=not replicated)
+        self.session = Session()
+        self.guild_id = int(guild_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.session.rollback()
+        self.close()
+
+    def close(self):
         """
-            Get the member id for a given name
+            Close the session and return its connection to the pool
         """
-        return self.session.query(Members).filter(Members.name == member_name)[0]
-    
-    def has_no_leader(self, lobby_id):
+        self.session.close()
+
+    def transact(self, data):
         """
-            Check if a leader is missing in a single given lobby
+            Translate passed data (a rendered DataForm) into writes and hand them to the method
+            named in the data. returns whatever that method returns.
         """
-        has_no_leader = True
-        result = self.session.query(Participants).filter(
-            Participants.lobbyid == lobby_id 
-        )
-        if result.all():
-            has_no_leader = False
-        return has_no_leader
+        transactions = form_writes(data)
+        call_transaction = getattr(self, data['method'])
+        logging.debug('Calling transaction with: %s', call_transaction)
+        return call_transaction(transactions)
 
-    def select_lobbies(self, member=False, name=False):
+    def select_lobbies(self, member=False, name=False, lobby_id=False, created_since=False):
         """
             Gather all existing lobbies, if member is false then all
-            lobbies are fetched. Else the scope is narrowed down to the member
+            lobbies are fetched. Else the scope is narrowed down to the member.
+            "created_since" (a datetime) keeps the lobbies created since then, lobby ids are time
+            ordered so that is a range scan over the primary key.
+            A lobby, its participants and their member names are fetched in one joined query,
+            regardless of how many lobbies or participants exist.
         """
         existing_lobbies = dict()
+        participant_member = aliased(Members)
+        leader_member = aliased(Members)
 
-        if member and not name: # All lobbies which a member participates in
-            scope = self.session.query(Lobby).filter(
-                Lobby.id == Participants.lobbyid, Participants.memid == member
+        scope = self.session.query(
+            Lobby, participant_member.id, participant_member.name, leader_member.id, leader_member.name
+        ).outerjoin(
+            Participants, and_(Participants.guild_id == Lobby.guild_id, Participants.lobbyid == Lobby.id)
+        ).outerjoin(
+            participant_member, and_(
+                participant_member.guild_id == Participants.guild_id, participant_member.id == Participants.memid
             )
-        elif name and member: # All lobbies which match "name" and which "member" partakes in. 
-            scope = self.session.query(Lobby).filter(
-                Lobby.name == name, Lobby.id == Participants.lobbyid, Participants.memid == member
+        ).outerjoin(
+            leader_member, and_(
+                leader_member.guild_id == Participants.guild_id, leader_member.id == Participants.leader
             )
-        elif not member and not name:
-            scope = self.session.query(Lobby).all()
+        ).filter(
+            Lobby.guild_id == self.guild_id
+        )
+
+        if member: # All lobbies which a member participates in
+            scope = scope.filter(
+                Lobby.id.in_(
+                    self.session.query(Participants.lobbyid).filter(
+                        Participants.guild_id == self.guild_id, Participants.memid == member
+                    )
+                )
+            )
+        if name: # All lobbies which match "name"
+            scope = scope.filter(Lobby.name == name)
+        if lobby_id: # A single lobby
+            scope = scope.filter(Lobby.id == lobby_id)
+        if created_since:
+            scope = scope.filter(Lobby.id >= snowflake_at(created_since))
 
-        if scope:
-            for lobby in scope:
+        rows = scope.order_by(Lobby.id, Participants.row_id)
+        for lobby, participant_id, participant_name, leader_id, leader_name in rows:
+            if lobby.id not in existing_lobbies:
                 existing_lobbies[lobby.id] = {
                     'name':lobby.name,
                     'date':lobby.date,
                     'participant':list(),
+                    'participant_ids':list(),
                     'size':lobby.size
                 }
-                for participant in self.session.query(Participants).filter(Participants.lobbyid == lobby.id):
-                    for leader in self.session.query(Members).filter(Members.id == participant.leader):
-                        existing_lobbies[lobby.id]['leader'] = leader.name
-                    
-                    for member in self.session.query(Members).filter(Members.id == participant.memid):
-                        existing_lobbies[lobby.id]['participant'].append(member.name)
+            if leader_id is not None:
+                existing_lobbies[lobby.id]['leader'] = leader_name
+                existing_lobbies[lobby.id]['leader_id'] = leader_id
+            if participant_id is not None:
+                existing_lobbies[lobby.id]['participant'].append(participant_name)
+                existing_lobbies[lobby.id]['participant_ids'].append(participant_id)
         return existing_lobbies
-                
+
+    def select_deadlines(self, limit=10000, after=None):
+        """
+            Return (lobby id, date) of up to "limit" lobbies which are due next, earliest first.
+            "after" is the (date, lobby id) of the last deadline of the previous call, to page on.
+        """
+        scope = self.session.query(Lobby.id, Lobby.date).filter(
+            Lobby.guild_id == self.guild_id, Lobby.date.isnot(None)
+        )
+        if after:
+            date, lobby_id = after
+            scope = scope.filter(or_(Lobby.date > date, and_(Lobby.date == date, Lobby.id > lobby_id)))
+        return scope.order_by(Lobby.date, Lobby.id).limit(limit).all()
+
+    def select_participant_ids(self, lobby_id):
+        """
+            Return the member ids of everyone partaking in a lobby
+        """
+        return [row.memid for row in self.session.query(Participants.memid).filter(
+            Participants.guild_id == self.guild_id, Participants.lobbyid == lobby_id
+        )]
+
+    def select_board(self):
+        """
+            Return the board of the guild as {"channel_id", "pages": [(message id, digest)]}, None without a board
+        """
+        rows = self.session.query(BoardPage).filter(BoardPage.guild_id == self.guild_id).order_by(BoardPage.page).all()
+        if not rows:
+            return None
+        return {'channel_id': rows[0].channel_id, 'pages': [(row.message_id, row.digest) for row in rows]}
+
+    def save_board(self, channel_id, pages):
+        """
+            Replace the board of the guild by a list of (message id, digest) pages, no pages removes the board
+        """
+        self.session.query(BoardPage).filter(BoardPage.guild_id == self.guild_id).delete(synchronize_session=False)
+        self.upsert(BoardPage, [
+            {'guild_id': self.guild_id, 'page': page, 'channel_id': int(channel_id), 'message_id': message_id, 'digest': digest}
+            for page, (message_id, digest) in enumerate(pages)
+        ])
+        self.session.commit()
+
     def create(self, data):
-        
         """
-            Append data to a database. The argument "db_name" qeuals equals the database which 
-            shall be opened. Tables are appended depending on what fields are True in the passed argument(type dict())
+            Append a list of (kind, row) writes to the database in a single transaction, see apply_writes.
+            Rows which already exist are left untouched (members get their name updated).
+            returns for every write 1 if it inserted a row, 0 if the row existed already.
         """
+        result = self.apply_writes([data])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def existing_keys(self, model, key, rows):
+        """
+            The "key" column values of the rows which exist already in the table of "model", as a set of tuples
+        """
+        columns = [model.__table__.c[column] for column in key]
+        return set(tuple(row) for row in self.session.query(*columns).filter(
+            model.__table__.c.guild_id == self.guild_id, columns[0].in_(set(row[key[0]] for row in rows))
+        ))
+
+    def refuse_over_limit(self, submissions):
+        """
+            The indexes of the submissions whose participant writes would put a member into more
+            lobbies than the "max_lobbies" of their ('limit', {"memid", "max_lobbies"}) write.
+            The member rows are locked by their upsert, the participations are read with a locking
+            read, so concurrent joins and creates of a member queue up behind each other.
+        """
+        limits = [
+            (submission_index, row) for submission_index, submission in enumerate(submissions)
+            for kind, row in submission if kind == 'limit'
+        ]
+        if not limits:
+            return set()
+        joined = collections.Counter(memid for memid, in self.session.query(Participants.memid).filter(
+            Participants.guild_id == self.guild_id, Participants.memid.in_(set(row['memid'] for _, row in limits))
+        ).with_for_update())
+        refused = set()
+        for submission_index, row in limits:
+            added = sum(1 for kind, write in submissions[submission_index] if kind == 'participant' and write['memid'] == row['memid'])
+            if joined[row['memid']] + added > row['max_lobbies']:
+                refused.add(submission_index)
+            else:
+                joined[row['memid']] += added
+        return refused
+
+    def _apply(self, submissions):
+        results = [[0] * len(submission) for submission in submissions]
+        refused = set()
+        for kind in WRITE_ORDER: # parents before children because of the foreign keys
+            if kind == 'lobby': # members are upserted and locked by now
+                refused = self.refuse_over_limit(submissions)
+            model, key, update = WRITE_MODELS[kind]
+            writes = [
+                (submission_index, write_index, {**row, 'guild_id': self.guild_id})
+                for submission_index, submission in enumerate(submissions) if submission_index not in refused
+                for write_index, (write_kind, row) in enumerate(submission) if write_kind == kind
+            ]
+            if not writes:
+                continue
+            # the row counts of upserts tell duplicates apart on sqlite only (mysql counts found rows)
+            seen = self.existing_keys(model, key, [row for _, _, row in writes])
+            for submission_index, write_index, row in writes:
+                row_key = tuple(row[column] for column in key)
+                results[submission_index][write_index] = int(row_key not in seen)
+                seen.add(row_key)
+            logging.debug('Method - CREATE - %s %s rows', len(writes), kind)
+            self.upsert(model, [row for _, _, row in writes], update)
+        for submission_index in refused:
+            max_lobbies = next(row['max_lobbies'] for kind, row in submissions[submission_index] if kind == 'limit')
+            results[submission_index] = LimitError('you cannot partake in more than %s lobbies' % (max_lobbies))
+        return results
 
+    def apply_writes(self, submissions):
+        """
+            Apply several submissions, each a list of (kind, row) writes, in one transaction with
+            one multi-row upsert per kind of write. If that transaction fails every submission is
+            retried in a transaction of its own, so one bad submission cannot take the others down.
+            A submission with a "limit" write is refused with a LimitError instead of exceeding
+            it, see refuse_over_limit. returns one entry per submission: for each of its writes 1
+            if it inserted a row and 0 for a duplicate (found before the insert, or earlier in the
+            batch), or the exception the submission raised.
+        """
         try:
-            for insertion in data:
-                logging.debug('Method - CREATE - object: %s' % (insertion))
-                self.session.add(insertion)
+            results = self._apply(submissions)
+            self.session.commit()
+            return results
+        except Exception as err:
+            self.session.rollback()
+            if len(submissions) == 1:
+                return [err]
+            logging.debug('Batch of %s submissions failed, retrying one by one: %s', len(submissions), err)
+
+        results = list()
+        for submission in submissions:
+            try:
+                results.append(self._apply([submission])[0])
                 self.session.commit()
-        except (IntegrityError, InvalidRequestError) as err:
-            # this might be a bit risky since it catches all IntegrityError and InvalidRequestErrors
-            # this was implemented to avoid crashes when duplicate data is to be transmitted to the database.
-            pass
+            except Exception as err:
+                self.session.rollback()
+                results.append(err)
+        return results
 
     def modify(self, data):
         
@@ -175,26 +628,393 @@ class MyDatabase():
         """
         pass
 
+    def join_lobby(self, lobby_id, member_id, member_name, max_lobbies=10):
+        """
+            Add a member to a lobby unless the lobby is full or the member already partakes in
+            "max_lobbies" lobbies. The checks and the insert happen in one transaction holding the
+            member row and then the lobby row locked, so concurrent joins of the same lobby (or by
+            the same member) queue up behind each other instead of overbooking.
+            returns one of "joined", "missing", "already", "full" or "limit".
+        """
+        for attempt in range(LOCK_RETRIES):
+            try:
+                return self._join_lobby(int(member_id), lobby_id, member_name, max_lobbies)
+            except OperationalError as err:
+                code = err.orig.args[0] if getattr(err.orig, 'args', None) else None
+                if code not in (1205, 1213) or attempt == LOCK_RETRIES - 1: # lock wait timeout, deadlock
+                    raise
+                logging.debug('Retrying join of %s to %s after %s', member_id, lobby_id, err)
+
+    def _join_lobby(self, member_id, lobby_id, member_name, max_lobbies):
+        try:
+            # upserting the member takes its row lock (and the write lock of SQLite) before anything is read
+            self.upsert(Members, [{'guild_id': self.guild_id, 'id': member_id, 'name': member_name}], ('name',))
+            lobby = self.session.query(Lobby.size).filter(
+                Lobby.guild_id == self.guild_id, Lobby.id == lobby_id
+            ).with_for_update().first()
+            if lobby is None:
+                status = 'missing'
+            else:
+                seats = [memid for memid, in self.session.query(Participants.memid).filter(
+                    Participants.guild_id == self.guild_id, Participants.lobbyid == lobby_id
+                ).with_for_update()]
+                joined = len(self.session.query(Participants.row_id).filter(
+                    Participants.guild_id == self.guild_id, Participants.memid == member_id
+                ).with_for_update().all())
+
+                if member_id in seats:
+                    status = 'already'
+                elif len(seats) >= lobby.size:
+                    status = 'full'
+                elif joined >= max_lobbies:
+                    status = 'limit'
+                else:
+                    self.session.add(Participants(
+                        guild_id=self.guild_id, memid=member_id, lobbyid=lobby_id, leader=None
+                    ))
+                    status = 'joined'
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        logging.debug('Join of %s to %s: %s', member_id, lobby_id, status)
+        return status
+
     def delete_particiant_from_lobby(self, lobby_id, member_id):
-        row = self.session.query(Participants).filter(
-            Participants.memid == member_id, Participants.lobbyid == lobby_id
-        )
-        d = row.delete() # return the count of rows matched as returned by the database’s “row count” feature.
-        logging.debug("removing %s from %s" % (member_id, lobby_id))
-        self.session.commit()
-        return d
+        """
+            Remove a member from a lobby, returns the number of rows removed. See leave_lobby.
+        """
+        return self.leave_lobby(lobby_id, member_id)[0]
+
+    def leave_lobby(self, lobby_id, member_id):
+        """
+            Remove a member from a lobby. When the leader leaves, the participant who joined first
+            leads the lobby from then on; a lobby left without participants has no leader and is
+            archived by the next sweep. Returns (rows removed, member id of the new leader or None).
+        """
+        promoted = None
+        try:
+            row = self.session.query(Participants).filter(
+                Participants.guild_id == self.guild_id,
+                Participants.memid == member_id,
+                Participants.lobbyid == lobby_id
+            ).with_for_update().first()
+            if row is not None:
+                was_leader = row.leader is not None
+                self.session.delete(row)
+                self.session.flush()
+                if was_leader:
+                    promoted = self.promote_successors([lobby_id])[lobby_id]
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        logging.debug("removing %s from %s, new leader: %s", member_id, lobby_id, promoted)
+        return int(row is not None), promoted
+
+    def promote_successors(self, lobby_ids):
+        """
+            Make the participant who joined first the leader of every lobby of "lobby_ids", which
+            lost their leader in the transaction of the caller. Returns {lobby id: member id of
+            the new leader, None if nobody is left}.
+        """
+        promoted = dict()
+        for lobby_id in lobby_ids:
+            successor = self.session.query(Participants).filter(
+                Participants.guild_id == self.guild_id, Participants.lobbyid == lobby_id
+            ).order_by(Participants.row_id).with_for_update().first()
+            if successor is not None:
+                successor.leader = successor.memid
+            promoted[lobby_id] = successor.memid if successor is not None else None
+        return promoted
 
     def delete_lobby(self, lobby_id):
         """
-            Delete a lobby from database
+            Move a lobby and its participants to the archive
         """
-        lobby = self.session.query(Lobby).filter(
-            Lobby.id == lobby_id
-        )
-        logging.debug("Deleting lobby %s because it has no leader" % (lobby_id))
-        d_lobby = lobby.delete()
+        logging.debug("Deleting lobby %s", lobby_id)
+        return self.archive_lobbies([lobby_id], 'deleted')
+
+    def archive_lobbies(self, lobby_ids, reason, now=None):
+        """
+            Move lobbies and their participants from the live tables into the archive tables,
+            with one INSERT ... SELECT and one DELETE per table inside a single transaction.
+            "reason" is a string or a sql expression over Lobby. returns the participants moved.
+        """
+        if not lobby_ids:
+            return 0
+        if now is None:
+            now = datetime.now()
+        date = func.coalesce(Lobby.date, now)
+        month = extract('year', date) * 100 + extract('month', date)
+        try:
+            self.session.execute(insert(LobbyArchive).from_select(
+                ['guild_id', 'month', 'id', 'name', 'date', 'size', 'reason', 'archived'],
+                select(
+                    Lobby.guild_id, month, Lobby.id, Lobby.name, Lobby.date, Lobby.size,
+                    literal(reason) if isinstance(reason, str) else reason, literal(now, DateTime)
+                ).where(Lobby.guild_id == self.guild_id, Lobby.id.in_(lobby_ids))
+            ))
+            self.session.execute(insert(ParticipantArchive).from_select(
+                ['guild_id', 'month', 'lobbyid', 'memid', 'name', 'leader'],
+                select(
+                    Participants.guild_id, month, Participants.lobbyid, Participants.memid, Members.name,
+                    Participants.leader.isnot(None)
+                ).select_from(Participants).join(
+                    Lobby, and_(Lobby.guild_id == Participants.guild_id, Lobby.id == Participants.lobbyid)
+                ).outerjoin(
+                    Members, and_(Members.guild_id == Participants.guild_id, Members.id == Participants.memid)
+                ).where(Participants.guild_id == self.guild_id, Participants.lobbyid.in_(lobby_ids))
+            ))
+            participants = self.session.query(Participants).filter(
+                Participants.guild_id == self.guild_id, Participants.lobbyid.in_(lobby_ids)
+            ).delete(synchronize_session=False)
+            self.session.query(Lobby).filter(
+                Lobby.guild_id == self.guild_id, Lobby.id.in_(lobby_ids)
+            ).delete(synchronize_session=False)
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        return participants
+
+    def add_archive_partitions(self, now=None, months_ahead=2):
+        """
+            Split a partition for every month up to "months_ahead" months after the current one
+            off the catch-all partition p_future of the archive tables (mysql only). Months are
+            added right after the last partitioned one, the first time months before the current
+            one go to p_past, so every p<YYYYMM> partition holds exactly its month. Runs ahead of
+            time, once per sweep (see maintenance.py and Lobbies.task_clean_lobbies); archiving
+            never waits for DDL. Partitions a concurrent process added first are skipped.
+        """
+        if self.session.bind.dialect.name != 'mysql':
+            return
+        month = archive_month(now or datetime.now())
+        last = month
+        for _ in range(months_ahead):
+            last = next_month(last)
+
+        tables = dict((table, dict()) for table in ARCHIVE_TABLES)
+        for table, name, bound in self.session.execute(text(
+            'SELECT table_name, partition_name, partition_description FROM information_schema.partitions '
+            'WHERE table_schema = DATABASE() AND table_name IN (%s)' % (', '.join("'%s'" % (table) for table in ARCHIVE_TABLES))
+        )):
+            tables[table][name] = bound
         self.session.commit()
 
+        for table, partitions in tables.items():
+            if 'p_future' not in partitions:
+                continue # not partitioned
+            bounds = [int(bound) for name, bound in partitions.items() if name not in ('p_future', 'p_past')]
+            start = max(bounds) if bounds else month # the bound of a month partition is the month after it
+            months = list()
+            while start <= last:
+                months.append(start)
+                start = next_month(start)
+            if not months:
+                continue
+            added = ['PARTITION p%s VALUES LESS THAN (%s)' % (added_month, next_month(added_month)) for added_month in months]
+            if not bounds:
+                added.insert(0, 'PARTITION p_past VALUES LESS THAN (%s)' % (month))
+            logging.info('Adding archive partitions %s to %s', months, table)
+            try:
+                self.session.execute(text('ALTER TABLE %s REORGANIZE PARTITION p_future INTO (%s, %s)' % (
+                    table, ', '.join(added), 'PARTITION p_future VALUES LESS THAN MAXVALUE'
+                )))
+            except (OperationalError, ProgrammingError) as err:
+                # 1493: bounds not increasing, 1517: duplicate partition, both mean someone else added them
+                self.session.rollback()
+                if getattr(err.orig, 'args', (None,))[0] not in (1493, 1517):
+                    raise
+                logging.info('Archive partitions of %s were added concurrently: %s', table, err.orig)
+            self.session.commit()
+
+    def iter_history(self, since=None, batch_size=1000):
+        """
+            Yield every archived lobby of the guild, oldest month first, as {"id", "name", "date",
+            "size", "reason", "archived", "participants": [{"id", "name", "leader"}]}. "since" (a
+            datetime) skips the months before it. Rows are streamed in batches of "batch_size"
+            (a server side cursor on mysql), the history never has to fit into memory.
+        """
+        query = self.session.query(
+            LobbyArchive, ParticipantArchive.memid, ParticipantArchive.name, ParticipantArchive.leader
+        ).outerjoin(
+            ParticipantArchive, and_(
+                ParticipantArchive.guild_id == LobbyArchive.guild_id,
+                ParticipantArchive.month == LobbyArchive.month,
+                ParticipantArchive.lobbyid == LobbyArchive.id
+            )
+        ).filter(
+            LobbyArchive.guild_id == self.guild_id
+        )
+        if since:
+            query = query.filter(LobbyArchive.month >= archive_month(since))
+        rows = query.order_by(
+            LobbyArchive.month, LobbyArchive.id, ParticipantArchive.memid
+        ).execution_options(stream_results=True).yield_per(batch_size)
+
+        lobby = None
+        for archived, memid, name, leader in rows:
+            if lobby is None or lobby['id'] != archived.id:
+                if lobby is not None:
+                    yield lobby
+                lobby = {
+                    'id': archived.id,
+                    'name': archived.name,
+                    'date': archived.date,
+                    'size': archived.size,
+                    'reason': archived.reason,
+                    'archived': archived.archived,
+                    'participants': list()
+                }
+            if memid is not None:
+                lobby['participants'].append({'id': memid, 'name': name, 'leader': bool(leader)})
+        if lobby is not None:
+            yield lobby
+
+    def upsert(self, model, rows, update=()):
+        """
+            Insert a list of row mappings into the table of "model" with a single statement.
+            Rows clashing with an existing primary or unique key are skipped, or have the
+            columns listed in "update" overwritten. The caller is responsible for committing.
+            returns the row count the driver reports, which does not tell inserted rows from
+            duplicates on mysql (found rows count, updated ones twice), see existing_keys.
+        """
+        if not rows:
+            return 0
+        dialect = self.session.bind.dialect.name
+        if dialect == 'mysql':
+            statement = mysql_insert(model.__table__).values(rows)
+            if update:
+                statement = statement.on_duplicate_key_update(
+                    **{column: statement.inserted[column] for column in update}
+                )
+            else: # a no-op update, unlike INSERT IGNORE this does not swallow foreign key errors
+                column = model.__table__.primary_key.columns.values()[0].name
+                statement = statement.on_duplicate_key_update(**{column: model.__table__.c[column]})
+        elif dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+            statement = sqlite_insert(model.__table__).values(rows)
+            if update:
+                statement = statement.on_conflict_do_update(
+                    index_elements=[column.name for column in model.__table__.primary_key],
+                    set_={column: statement.excluded[column] for column in update}
+                )
+            else:
+                statement = statement.on_conflict_do_nothing()
+        else:
+            for row in rows:
+                self.session.merge(model(**row))
+            return len(rows)
+        return self.session.execute(statement).rowcount
+
+    def sync_members(self, members, batch_size=500):
+        """
+            Bring the members table in line with an iterable of (id, name) pairs.
+            Existing members are read with one query, then only new and renamed members are
+            upserted in batches of "batch_size" rows, one transaction per batch.
+        """
+        members = dict((int(memid), name) for memid, name in members)
+        known = dict(self.session.query(Members.id, Members.name).filter(Members.guild_id == self.guild_id))
+        changed = [
+            {'guild_id': self.guild_id, 'id': memid, 'name': name}
+            for memid, name in members.items() if known.get(memid) != name
+        ]
+        try:
+            for offset in range(0, len(changed), batch_size):
+                self.upsert(Members, changed[offset:offset + batch_size], update=('name',))
+                self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        report = {
+            'inserted': sum(1 for row in changed if row['id'] not in known),
+            'renamed': sum(1 for row in changed if row['id'] in known),
+            'unchanged': len(members) - len(changed)
+        }
+        logging.debug('Synced members: %s' % (report))
+        return report
+
+    def delete_member(self, member_id):
+        """
+            Delete a member and every participation of it from database. The lobbies it led go to
+            their next participant like in leave_lobby. Returns the ids of the lobbies the member
+            partook in and {lobby id: member id of the new leader or None} of those it led.
+        """
+        try:
+            participations = self.session.query(Participants.lobbyid, Participants.leader).filter(
+                Participants.guild_id == self.guild_id, Participants.memid == int(member_id)
+            ).with_for_update().all()
+            self.session.query(Participants).filter(
+                Participants.guild_id == self.guild_id, Participants.memid == int(member_id)
+            ).delete(synchronize_session=False)
+            promoted = self.promote_successors([lobby_id for lobby_id, leader in participations if leader is not None])
+            self.session.query(Members).filter(
+                Members.guild_id == self.guild_id, Members.id == int(member_id)
+            ).delete(synchronize_session=False)
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+        logging.debug("Deleting member %s, new leaders: %s", member_id, promoted)
+        return [lobby_id for lobby_id, _ in participations], promoted
+
+    def clean_lobbies(self, now=None):
+        """
+            Archive every lobby without a leader and every lobby whose date has passed, together with
+            their participants. The doomed lobbies are selected once and moved in bulk, see
+            archive_lobbies. Returns the archived row counts and lobby ids.
+        """
+        if now is None:
+            now = datetime.now()
+        has_leader = self.session.query(Participants.row_id).filter(
+            Participants.guild_id == Lobby.guild_id,
+            Participants.lobbyid == Lobby.id,
+            Participants.leader.isnot(None)
+        ).exists()
+
+        doomed = self.session.query(Lobby.id, Lobby.date < now).filter(
+            Lobby.guild_id == self.guild_id, or_(~has_leader, Lobby.date < now)
+        ).all()
+        report = {
+            'lobby_ids': [lobby_id for lobby_id, _ in doomed],
+            'expired': sum(1 for _, expired in doomed if expired),
+            'leaderless': sum(1 for _, expired in doomed if not expired),
+            'participants': 0
+        }
+        if doomed:
+            report['participants'] = self.archive_lobbies(
+                report['lobby_ids'], case((Lobby.date < now, 'expired'), else_='leaderless'), now
+            )
+        logging.debug('Cleaned lobbies: %s' % (report))
+        return report
+
+
+# kinds of writes accepted by MyDatabase.create and apply_writes: model, the key of a row within
+# its guild and the columns updated on duplicates; "limit" writes are checks, see refuse_over_limit
+WRITE_MODELS = {
+    'member': (Members, ('id',), ('name',)),
+    'lobby': (Lobby, ('id',), ()),
+    'participant': (Participants, ('memid', 'lobbyid'), ()),
+}
+WRITE_ORDER = ('member', 'lobby', 'participant')
+
+
+def form_writes(data):
+    """
+        Turn a rendered DataForm into a list of (kind, row) writes
+    """
+    writes = list()
+    if data['settings']['member']['id']:
+        writes.append(('member', dict(data['settings']['member'])))
+
+    if data['settings']['lobby']['id']:
+        writes.append(('lobby', dict(data['settings']['lobby'])))
+
+    if data['settings']['participations']['memid'] and data['settings']['participations']['lobbyid']:
+        writes.append(('participant', dict(data['settings']['participations'])))
+    return writes
+
 
 class DataForm( object ):
     """
@@ -247,52 +1067,3 @@ class DataForm( object ):
             }
         }
 
-
-if __name__ == '__main__':
-    # Debuging section
-    # TODO: Testing mode, check out assertions
-    from datetime import datetime
-    from pprint import pprint
-
-    #db_name = ''.join(names.get_full_name().split(' '))
-    #print('using db name: %s' % (db_name))
-
-    db_settings = {
-            'ip':'127.0.0.1',
-            'port':'3306',
-            'user':'root',
-            'password':'Syp9393',
-            'db_name':'BotTest',
-            'debug':False
-        }
-
-    db = MyDatabase(**db_settings)
-    db.select()
-
-
-    # create_settings = DataForm('create')
-    # modify_settings = DataForm('modify')
-    # remove_settings = DataForm('delete')
-
-    # # TEST: Adding a new lobby
-    # data = data_form(lobbyid=random.getrandbits(64), lobby='testlobby', date=datetime.now(), method='create')
-    # pprint('TEST - Creating a new lobby: %s' % (data))
-    # db.transact(data)
-
-    # # TEST: Adding member to database
-    # data = data_form(memid='146673512923267274', member='Mirakelsvampen', method='create')
-    # pprint('TEST - Creating a new member: %s' % (data))
-    # db.transact(data)
-
-    # TEST: Create participation entry
-    # create_settings.participation_member = '146673512923267074'
-    # create_settings.participation_lobby = '266541615822941422'
-    # data01 = create_settings.render()
-    # pprint('TEST - Create participation entry: %s' % (data01))
-    # db.transact(data01)
-
-    # TEST: Adding a new member to existing lobby
-
-    # TEST: Deleting a lobby
-
-    # TEST: Promoting a another participant to leader of a lobby
@@ -0,0 +1,9 @@
+-- runs once when the replica container initialises its data directory: follow the "db" service
+-- from its first transaction on, every database the bot creates there is copied over
+CHANGE REPLICATION SOURCE TO
+    SOURCE_HOST='database',
+    SOURCE_USER='root',
+    SOURCE_PASSWORD='Syp9393',
+    SOURCE_AUTO_POSITION=1,
+    GET_SOURCE_PUBLIC_KEY=1;
+START REPLICA;
@@ -0,0 +1,74 @@
+#! /usr/bin/env python3
+"""
+    Export the lobby history of a guild from the archive tables (see MyDatabase.archive_lobbies).
+
+        python3 export_history.py MyGuild > history.jsonl
+        python3 export_history.py MyGuild --format csv --since 2026-01 --output history.csv
+        python3 export_history.py 123456789012345678 --format csv   # a guild id in "shared" storage mode
+
+    JSON Lines get one object per lobby with its participants, CSV one row per participant (lobbies
+    without participants get a row of their own). Lobbies are streamed from the database and written
+    as they arrive, so histories of any size are exported in constant memory.
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+
+from datetime import datetime
+
+from db_handler import Guild, MyDatabase, guild_database
+
+CSV_COLUMNS = ('lobby_id', 'lobby_name', 'date', 'size', 'reason', 'archived', 'member_id', 'member_name', 'leader')
+
+
+def write_jsonl(lobbies, output):
+    count = 0
+    for lobby in lobbies:
+        output.write(json.dumps(lobby, default=str) + '\n')
+        count += 1
+    return count
+
+
+def write_csv(lobbies, output):
+    writer = csv.writer(output)
+    writer.writerow(CSV_COLUMNS)
+    count = 0
+    for lobby in lobbies:
+        row = [lobby['id'], lobby['name'], lobby['date'], lobby['size'], lobby['reason'], lobby['archived']]
+        for participant in lobby['participants'] or [{'id': '', 'name': '', 'leader': ''}]:
+            writer.writerow(row + [participant['id'], participant['name'], participant['leader']])
+        count += 1
+    return count
+
+
+WRITERS = {'jsonl': write_jsonl, 'csv': write_csv}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the archived lobbies of a guild')
+    parser.add_argument('guild', help='guild database name ("per_guild" storage mode) or guild id ("shared" mode)')
+    parser.add_argument('--format', choices=sorted(WRITERS), default='jsonl')
+    parser.add_argument('--since', type=lambda value: datetime.strptime(value, '%Y-%m'), help='first month, e.g. 2026-01')
+    parser.add_argument('--output', help='file to write to, defaults to stdout')
+    parser.add_argument('--batch-size', type=int, default=1000, help='rows fetched from the database at a time')
+    arguments = parser.parse_args()
+
+    settings_file = open(os.path.join(os.path.abspath(os.curdir), 'settings.json'), 'r')
+    settings = json.loads(settings_file.read())
+    settings_file.close()
+    storage = settings.get('storage', {})
+    if storage.get('mode', 'per_guild') == 'shared':
+        guild = Guild(int(arguments.guild), arguments.guild)
+    else:
+        guild = Guild(0, arguments.guild)
+
+    output = open(arguments.output, 'w', newline='') if arguments.output else sys.stdout
+    try:
+        with MyDatabase(**{**settings['database'], **guild_database(storage, guild)}) as con:
+            count = WRITERS[arguments.format](con.iter_history(arguments.since, arguments.batch_size), output)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    sys.stderr.write('Exported %s lobbies of %s\n' % (count, guild.name))
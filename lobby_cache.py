@@ -0,0 +1,214 @@
+import time
+
+from collections import OrderedDict
+
+
+def lobby_version(lobby):
+    """
+        The version of a lobby: everything rendering it depends on, so a lobby keeps its version
+        across reloads for as long as nobody writes to it
+    """
+    return (
+        lobby['name'], lobby['date'], lobby['size'],
+        tuple(lobby['participant']), tuple(lobby['participant_ids']), lobby.get('leader_id')
+    )
+
+
+def filter_lobbies(lobbies, member=False, name=False):
+    """
+        Narrow a dict of lobbies (as returned by MyDatabase.select_lobbies) down the same way
+        select_lobbies does. Every lobby is copied so callers can annotate it freely.
+    """
+    selected = dict()
+    for lobby_id, lobby in lobbies.items():
+        if member and int(member) not in lobby['participant_ids']:
+            continue
+        if name and lobby['name'] != name:
+            continue
+        selected[lobby_id] = dict(lobby)
+    return selected
+
+
+class LobbyCache():
+    """
+        Write-through, in-memory copy of the lobbies of recently used guilds.
+        Guilds are kept in an LRU bounded by "max_guilds"; guilds with more than "max_lobbies"
+        lobbies are not cached at all, and entries older than "ttl" seconds are reloaded so writes
+        made by other processes show up eventually.
+
+        Commands update the cached guild after every write they make. Every write also bumps the
+        generation of the guild, a load which raced with a write is thereby never stored.
+        Every stored lobby carries a "version" which changes with each write to it and survives
+        reloads of unchanged lobbies, see lobby_version and FragmentCache.
+    """
+
+    def __init__(self, max_guilds=256, max_lobbies=5000, ttl=300):
+        self.max_guilds = int(max_guilds)
+        self.max_lobbies = int(max_lobbies)
+        self.ttl = ttl
+        self.guilds = OrderedDict() # guild id -> [lobbies, loaded at]
+        self.generations = dict() # guild id -> number of writes seen
+        self.hits = 0
+        self.misses = 0
+
+    def generation(self, guild_id):
+        """
+            Take before loading a guild from database, pass it to put afterwards
+        """
+        return self.generations.get(guild_id, 0)
+
+    def _written(self, guild_id):
+        self.generations[guild_id] = self.generations.get(guild_id, 0) + 1
+        entry = self.guilds.get(guild_id)
+        return entry[0] if entry is not None else None
+
+    def get(self, guild_id):
+        """
+            Return every cached lobby of a guild, None on a miss
+        """
+        entry = self.guilds.get(guild_id)
+        if entry is None or time.monotonic() - entry[1] > self.ttl:
+            self.misses += 1
+            return None
+        self.guilds.move_to_end(guild_id)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, guild_id, lobbies, generation):
+        """
+            Store every lobby of a guild unless it was written to since "generation" was taken.
+            Only stored lobbies get a version, lobbies of guilds too big to cache are never memoized.
+        """
+        if generation != self.generation(guild_id) or len(lobbies) > self.max_lobbies:
+            self.guilds.pop(guild_id, None)
+            return False
+        for lobby in lobbies.values():
+            lobby['version'] = lobby_version(lobby)
+        self.guilds[guild_id] = [lobbies, time.monotonic()]
+        self.guilds.move_to_end(guild_id)
+        while len(self.guilds) > self.max_guilds:
+            self.guilds.popitem(last=False)
+        return True
+
+    def invalidate(self, guild_id):
+        self._written(guild_id)
+        self.guilds.pop(guild_id, None)
+
+    def add_lobby(self, guild_id, lobby_id, lobby):
+        lobbies = self._written(guild_id)
+        if lobbies is not None:
+            lobby['version'] = lobby_version(lobby)
+            lobbies[lobby_id] = lobby
+            if len(lobbies) > self.max_lobbies:
+                self.guilds.pop(guild_id, None)
+
+    def add_participant(self, guild_id, lobby_id, member_id, member_name):
+        lobbies = self._written(guild_id)
+        if lobbies is None or lobby_id not in lobbies:
+            return
+        lobby = lobbies[lobby_id]
+        if member_id not in lobby['participant_ids']:
+            lobby['participant_ids'] = lobby['participant_ids'] + [member_id]
+            lobby['participant'] = lobby['participant'] + [member_name]
+            lobby['version'] = lobby_version(lobby)
+
+    def remove_participant(self, guild_id, lobby_id, member_id, successor=None):
+        """
+            Remove a member from a cached lobby, "successor" is the member leading it from now on
+            if the member was its leader
+        """
+        lobbies = self._written(guild_id)
+        if lobbies is None or lobby_id not in lobbies:
+            return
+        lobby = lobbies[lobby_id]
+        if member_id in lobby['participant_ids']:
+            index = lobby['participant_ids'].index(member_id)
+            lobby['participant_ids'] = lobby['participant_ids'][:index] + lobby['participant_ids'][index + 1:]
+            lobby['participant'] = lobby['participant'][:index] + lobby['participant'][index + 1:]
+        if lobby.get('leader_id') == member_id:
+            lobby.pop('leader_id')
+            lobby.pop('leader', None)
+            if successor in lobby['participant_ids']:
+                lobby['leader_id'] = successor
+                lobby['leader'] = lobby['participant'][lobby['participant_ids'].index(successor)]
+        lobby['version'] = lobby_version(lobby)
+
+    def rename_member(self, guild_id, member_id, name):
+        """
+            Put the new name of a member into the cached lobbies of a guild. Returns whether
+            lobbies changed, always True if the guild is not cached (they may have).
+        """
+        lobbies = self._written(guild_id)
+        if lobbies is None:
+            return True
+        changed = False
+        for lobby in lobbies.values():
+            if member_id not in lobby['participant_ids']:
+                continue
+            index = lobby['participant_ids'].index(member_id)
+            lobby['participant'] = lobby['participant'][:index] + [name] + lobby['participant'][index + 1:]
+            if lobby.get('leader_id') == member_id:
+                lobby['leader'] = name
+            lobby['version'] = lobby_version(lobby)
+            changed = True
+        return changed
+
+    def remove_lobbies(self, guild_id, lobby_ids):
+        lobbies = self._written(guild_id)
+        if lobbies is not None:
+            for lobby_id in lobby_ids:
+                lobbies.pop(lobby_id, None)
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'guilds': len(self.guilds),
+            'lobbies': sum(len(entry[0]) for entry in self.guilds.values()),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / requests if requests else 0.0
+        }
+
+
+class FragmentCache():
+    """
+        Bounded LRU of rendered lobby fragments keyed by lobby version, so rendering a guild whose
+        lobbies did not change since the last render only concatenates cached text.
+        A "max_fragments" of 0 disables the cache.
+    """
+
+    def __init__(self, max_fragments=20000):
+        self.max_fragments = int(max_fragments)
+        self.fragments = OrderedDict() # (lobby version, variant) -> rendered text
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, lobby, render, variant=None):
+        """
+            Return render(lobby) from cache when the lobby has a version that was rendered before.
+            "variant" tells renderings of the same lobby version apart.
+        """
+        version = lobby.get('version')
+        if version is None or not self.max_fragments:
+            self.misses += 1
+            return render(lobby)
+        key = (version, variant)
+        fragment = self.fragments.get(key)
+        if fragment is not None:
+            self.fragments.move_to_end(key)
+            self.hits += 1
+            return fragment
+        self.misses += 1
+        fragment = self.fragments[key] = render(lobby)
+        while len(self.fragments) > self.max_fragments:
+            self.fragments.popitem(last=False)
+        return fragment
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            'fragments': len(self.fragments),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / requests if requests else 0.0
+        }
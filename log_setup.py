@@ -0,0 +1,148 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+
+TEXT_FORMAT = '%(asctime)s - %(process)s - %(module)s -  %(levelname)s - %(message)s'
+
+# guild and command of the coroutine that is logging, see bind
+log_context = contextvars.ContextVar('log_context', default=None)
+
+
+def bind(**fields):
+    """
+        Attach fields such as guild and command to every record logged from the current context.
+        Returns a token for log_context.reset.
+    """
+    return log_context.set({**(log_context.get() or dict()), **fields})
+
+
+class ContextFilter(logging.Filter):
+    """
+        Copy the fields bound to the current context onto the record
+    """
+    def filter(self, record):
+        for field, value in (log_context.get() or dict()).items():
+            if not hasattr(record, field):
+                setattr(record, field, value)
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """
+        Let at most "burst" records per "period" seconds through from every single call site
+        (file and line) at or below "level". Per-row debug lines of bulk operations thereby cost
+        a dictionary lookup instead of a write; how many lines were dropped is reported with the
+        next record that gets through.
+    """
+    def __init__(self, burst=20, period=1.0, level=logging.DEBUG):
+        super().__init__()
+        self.burst = burst
+        self.period = period
+        self.level = level
+        self.sites = dict() # (pathname, lineno) -> [window start, passed, suppressed]
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > self.level:
+            return True
+        now = time.monotonic()
+        key = (record.pathname, record.lineno)
+        with self.lock:
+            site = self.sites.get(key)
+            if site is None or now - site[0] >= self.period:
+                suppressed = site[2] if site is not None else 0
+                self.sites[key] = [now, 1, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+                return True
+            if site[1] < self.burst:
+                site[1] += 1
+                return True
+            site[2] += 1
+            return False
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+        One json object per line with the structured fields (guild, command, duration_ms, ...)
+    """
+    FIELDS = ('guild', 'command', 'duration_ms', 'suppressed')
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'process': record.process,
+            'module': record.module,
+            'message': record.getMessage(),
+        }
+        for field in self.FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text: # already rendered by StructuredQueueHandler.prepare
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """
+        The classic log format, with the structured fields appended when present
+    """
+    def format(self, record):
+        line = super().format(record)
+        fields = ' '.join(
+            '%s=%s' % (field, getattr(record, field)) for field in StructuredFormatter.FIELDS if hasattr(record, field)
+        )
+        return '%s [%s]' % (line, fields) if fields else line
+
+
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+    """
+        Hand records to the background writer without formatting them in the calling thread;
+        only the message is merged with its arguments so the record can safely cross threads.
+    """
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging(level='DEBUG', file='backend_logs.log', format='text', debug_burst=20, debug_period=1.0,
+        max_bytes=50 * 1024 * 1024, backup_count=5):
+    """
+        Configure the root logger once for the whole process. Records are queued in memory and
+        written to "file" by a background thread, so logging never blocks the event loop.
+    """
+    root = logging.getLogger()
+    if getattr(root, 'queue_listener', None) is not None:
+        return root.queue_listener
+
+    file_handler = logging.handlers.RotatingFileHandler(
+        os.path.abspath(file), maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8'
+    )
+    file_handler.setFormatter(StructuredFormatter() if format == 'json' else TextFormatter(TEXT_FORMAT))
+
+    records = queue.SimpleQueue()
+    queue_handler = StructuredQueueHandler(records)
+    queue_handler.addFilter(RateLimitFilter(burst=debug_burst, period=debug_period))
+    queue_handler.addFilter(ContextFilter())
+
+    root.setLevel(level)
+    root.addHandler(queue_handler)
+
+    listener = logging.handlers.QueueListener(records, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    root.queue_listener = listener
+    return listener
@@ -3,77 +3,96 @@
 import discord
 import random
 import logging
-import re
 import json
 import os
 import inspect
+import argparse
 
 from discord.ext import commands
 
-from db_handler import MyDatabase
-from db_handler import DataForm
+from db_handler import registry
+from async_db import AsyncDatabase
+from lobby_cache import LobbyCache
+from log_setup import setup_logging
+from name_index import GuildNames
+from reaction_router import ReactionRouter
+from sharding import ShardGuilds, parse_shards, shard_settings
+from snowflake import lobby_ids
+from startup import Warmup
+from write_queue import WriteBehindQueue
 
 """ 
     If your bot tracks server members or downloads the entire member list, 
     you may need the server members intent to receive member events and the member list.
     NOTE: Once your bot reaches 100 or more servers, this will require Verification and whitelisting. Read more here
 """
+WORKING_DIR = os.path.abspath(os.curdir)
+settings_file = open(os.path.join(WORKING_DIR, 'settings.json'), 'r')
+settings = json.loads(settings_file.read())
+settings_file.close()
+
 # required permissions for discord bot
 intents = discord.Intents.all()
 
-client = commands.Bot(                                   # Create a new bot
+parser = argparse.ArgumentParser(description='A bot used for creating raid lobbies')
+parser.add_argument('--shard-count', type=int, help='total number of shards over every process')
+parser.add_argument('--shards', type=parse_shards, help='shards run by this process, e.g. 0-3 or 0,2')
+parser.add_argument('--no-sweep', action='store_true', help='leave the lobby sweep to maintenance.py')
+arguments = parser.parse_args()
+
+# sharded bots run the shards of "sharding" in settings.json or of --shard-count/--shards, see sharding.py
+sharding = shard_settings(settings, arguments.shard_count, arguments.shards)
+Bot = commands.AutoShardedBot if sharding else commands.Bot
+
+client = Bot(                                            # Create a new bot
     command_prefix='--',                                 # Set the prefix
     description='A bot used for creating raid lobbies',  # Set a description for the bot
     case_insensitive=True,                               # Make the commands case insensitive
-    intents=intents
+    intents=intents,
+    **sharding
 )
 
-WORKING_DIR = os.path.abspath(os.curdir)
-logging.basicConfig(
-        level=logging.DEBUG, 
-        filename=os.path.join(WORKING_DIR, 'backend_logs.log'), 
-        format='%(asctime)s - %(process)s - %(module)s -  %(levelname)s - %(message)s'
-    )
-
-settings_file = open(os.path.join(WORKING_DIR, 'settings.json'), 'r')
-settings = json.loads(settings_file.read())
-settings_file.close()
+setup_logging(**{'file': os.path.join(WORKING_DIR, 'backend_logs.log'), **settings.get('logging', {})})
 
 logging.debug('Starting with the following settings : %s' % (settings))
+registry.configure(**settings.get('pool', {}))
+# processes creating lobbies in the same database need distinct worker ids, the first shard is unique per process
+lobby_ids.configure(**{'worker_id': (sharding.get('shard_ids') or [0])[0] % 1024, **settings.get('ids', {})})
+client.db = AsyncDatabase(settings['database'], settings.get('storage'), **settings.get('executor', {}))
+client.lobby_cache = LobbyCache(**settings.get('cache', {}))
+client.names = GuildNames(**settings.get('names', {}))
+client.writes = WriteBehindQueue(client.db, **settings.get('write_queue', {}))
+# with --no-sweep (or "sweep": false) the lobby sweep is left to maintenance.py
+client.sweep = settings.get('lobbies', {}).get('sweep', True) and not arguments.no_sweep
+client.shard_guilds = ShardGuilds()
+client.shard_guilds.install(client)
+client.reactions = ReactionRouter(**settings.get('menus', {}))
+client.reactions.install(client)
+client.warmup = Warmup(**settings.get('startup', {}))
+client.warmup.install(client)
 
 db_connections = dict()
 
-cogs = ['cogs.lobbies']
+cogs = ['cogs.stats', 'cogs.members', 'cogs.lobbies', 'cogs.board']
 @client.event
 async def on_ready():
     """
         Performs instructions inside this function when the bot(user) has logged in to the servers.
     """
     logging.debug('Logged on as {0}!'.format(client.user.name))
+    client.shard_guilds.refresh(client.guilds)
+    logging.info('Running shards %s of %s' % (sorted(client.shards) if sharding else [0], client.shard_count or 1))
     logging.debug('I am active in the following servers:')
     logging.debug('Name:'.ljust(20, '_') + 'ID')
 
-    for cog in cogs:
-        client.load_extension(cog)
+    if not client.extensions: # on_ready fires again after reconnects
+        for cog in cogs:
+            client.load_extension(cog)
 
     for guild in client.guilds:
         logging.debug('{0.name}'.format(guild).ljust(20, '_') + '{0.id}'.format(guild))
-        con = MyDatabase(
-                    **{**settings['database'], "db_name": re.sub(r' ', '', guild.name)}
-                )
-
-        print(guild.members)
-        for member in guild.members:
-            logging.debug('Adding %s to database %s' % (member.name, guild.name))
-
-            memid = member.id
-            member_name = member.name.encode('utf-8') # some people use weird names which fuck up my database
-
-            create_settings = DataForm(method='create')
-            create_settings.member = member_name
-            create_settings.memid = memid
-            data = create_settings.render()
 
-            con.transact(data)
+    # guilds with data are warmed here, the others on their first command (see startup.py)
+    await client.warmup.on_ready(client.shard_guilds.all())
 
 client.run(settings['client']['bot_token'], bot=True)
\ No newline at end of file
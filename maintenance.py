@@ -0,0 +1,136 @@
+#! /usr/bin/env python3
+"""
+    Background maintenance without a gateway connection.
+
+    Sweeps the lobbies of every guild (see MyDatabase.clean_lobbies) on a process pool, so big
+    sweeps never add latency to the event loop serving commands. Run it beside the bot and
+    start the bot with --no-sweep (or "sweep": false in the "lobbies" settings):
+
+        python3 maintenance.py              # sweep every "interval" seconds
+        python3 maintenance.py --once       # a single sweep, e.g. from cron
+        python3 maintenance.py --once MyGuild OtherGuild
+
+    Guilds are found in the database: the guild ids of the shared database in "shared"
+    storage mode, every database holding a lobby table in "per_guild" mode.
+    The bot notices the removed lobbies once its lobby cache expires (see "cache": "ttl").
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from db_handler import Guild, MyDatabase, guild_database, registry, stored_guilds
+from log_setup import setup_logging
+
+
+def sweep_guild(db_settings, storage, guild):
+    """
+        Runs in a worker process, every worker keeps its own engines and pools
+    """
+    started = time.perf_counter()
+    with MyDatabase(**{**db_settings, **guild_database(storage, guild)}) as con:
+        report = con.clean_lobbies()
+    report['duration_ms'] = (time.perf_counter() - started) * 1000
+    return report
+
+
+def add_archive_partitions(db_settings, storage, guilds):
+    """
+        Add the archive partitions of the coming months to every database of guilds, once per
+        database (the shared one only once) before its lobbies get archived
+    """
+    databases = dict((guild_database(storage, guild)['db_name'], guild) for guild in guilds)
+    for db_name, guild in databases.items():
+        try:
+            with MyDatabase(**{**db_settings, **guild_database(storage, guild)}) as con:
+                con.add_archive_partitions()
+        except Exception:
+            logging.exception('Adding archive partitions to %s failed', db_name)
+
+
+def init_worker(pool_settings):
+    registry.configure(**pool_settings)
+
+
+def sweep(executor, db_settings, storage, guilds):
+    """
+        Sweep guilds on the process pool, returns the totals
+    """
+    started = time.perf_counter()
+    totals = {'guilds': 0, 'failed': 0, 'expired': 0, 'leaderless': 0, 'participants': 0}
+    futures = dict(
+        (executor.submit(sweep_guild, db_settings, storage, guild), guild) for guild in guilds
+    )
+    for future in as_completed(futures):
+        guild = futures[future]
+        try:
+            report = future.result()
+        except Exception:
+            logging.exception('Sweeping %s failed', guild.name)
+            totals['failed'] += 1
+            continue
+        totals['guilds'] += 1
+        for key in ('expired', 'leaderless', 'participants'):
+            totals[key] += report[key]
+        if report['lobby_ids']:
+            logging.info('Cleaned %s: %s leaderless and %s expired lobbies, %s participants in %.1f ms',
+                guild.name, report['leaderless'], report['expired'], report['participants'], report['duration_ms'],
+                extra={'guild': guild.id, 'command': 'clean_lobbies', 'duration_ms': round(report['duration_ms'], 2)}
+            )
+    totals['duration_ms'] = round((time.perf_counter() - started) * 1000, 2)
+    logging.info('Swept %s guilds: %s', totals['guilds'], totals)
+    return totals
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sweep lobbies of every guild without a gateway connection')
+    parser.add_argument('databases', nargs='*', help='only sweep these guild databases (per_guild storage mode)')
+    parser.add_argument('--once', action='store_true', help='sweep once and exit')
+    parser.add_argument('--workers', type=int, help='worker processes, defaults to the "maintenance" settings')
+    parser.add_argument('--interval', type=int, help='seconds between sweeps, defaults to the "maintenance" settings')
+    arguments = parser.parse_args()
+
+    WORKING_DIR = os.path.abspath(os.curdir)
+    settings_file = open(os.path.join(WORKING_DIR, 'settings.json'), 'r')
+    settings = json.loads(settings_file.read())
+    settings_file.close()
+    maintenance_settings = {
+        'workers': os.cpu_count() or 2,
+        'interval': settings.get('lobbies', {}).get('sweep_interval', 3600),
+        **settings.get('maintenance', {})
+    }
+    workers = arguments.workers or maintenance_settings['workers']
+    interval = arguments.interval or maintenance_settings['interval']
+
+    setup_logging(**{'file': os.path.join(WORKING_DIR, 'maintenance_logs.log'), **settings.get('logging', {})})
+    logging.getLogger().addHandler(logging.StreamHandler())
+    db_settings, storage = settings['database'], settings.get('storage', {})
+
+    # spawned workers do not inherit connections of the engines used for discovery
+    executor = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=init_worker,
+        initargs=(settings.get('pool', {}),)
+    )
+    try:
+        while True:
+            started = time.monotonic()
+            if arguments.databases:
+                guilds = [Guild(0, name) for name in arguments.databases]
+            else:
+                guilds = stored_guilds(db_settings, storage)
+            add_archive_partitions(db_settings, storage, guilds)
+            sweep(executor, db_settings, storage, guilds)
+            if arguments.once:
+                break
+            time.sleep(max(0, interval - (time.monotonic() - started)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        executor.shutdown(wait=True)
+        registry.dispose_all()
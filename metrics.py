@@ -0,0 +1,183 @@
+import contextvars
+import re
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+class RollingHistogram():
+    """
+        Keep the last "window" samples of a measurement, percentiles are computed on demand
+    """
+
+    def __init__(self, window=1024):
+        self.samples = deque(maxlen=window)
+        self.count = 0 # every sample ever observed, not only the ones in the window
+        self.total = 0.0
+
+    def observe(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+
+    def summary(self):
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {'count': self.count, 'sum': self.total}
+        def percentile(pct):
+            return ordered[min(len(ordered) - 1, int(round(pct * (len(ordered) - 1))))]
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'p50': percentile(0.5),
+            'p95': percentile(0.95),
+            'p99': percentile(0.99),
+            'max': ordered[-1]
+        }
+
+
+class Tracker():
+    """
+        Time spent by one command or task invocation, split up by where it went
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.db_seconds = 0.0
+        self.sql_statements = 0
+        self.discord_seconds = 0.0
+        self.token = None
+
+
+class Metrics():
+    """
+        Process wide rolling histograms of command latency and where that time is spent.
+
+        A Tracker is active while a command or task runs (see start/finish and track). Database
+        calls (AsyncDatabase) and discord api requests (install_discord_timer) add their time to
+        the active tracker; SQL statements are counted per thread through engine events since
+        queries run on the database thread pool.
+    """
+
+    def __init__(self, window=1024):
+        self.window = window
+        self.histograms = dict()
+        self.lock = threading.Lock()
+        self.current = contextvars.ContextVar('metrics_tracker', default=None)
+        self.sql_local = threading.local()
+        self.sql_statements = 0
+        self.started = time.time()
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = RollingHistogram(self.window)
+            histogram.observe(value)
+
+    #----- trackers -----
+    def start(self, name):
+        tracker = Tracker(name)
+        tracker.token = self.current.set(tracker)
+        return tracker
+
+    def finish(self, tracker):
+        self.current.reset(tracker.token)
+        self.observe('%s.wall_ms' % (tracker.name), (time.perf_counter() - tracker.started) * 1000)
+        self.observe('%s.db_ms' % (tracker.name), tracker.db_seconds * 1000)
+        self.observe('%s.sql_statements' % (tracker.name), tracker.sql_statements)
+        self.observe('%s.discord_ms' % (tracker.name), tracker.discord_seconds * 1000)
+
+    @contextmanager
+    def track(self, name):
+        tracker = self.start(name)
+        try:
+            yield tracker
+        finally:
+            self.finish(tracker)
+
+    def record_db(self, seconds, statements):
+        self.observe('db.call_ms', seconds * 1000)
+        tracker = self.current.get()
+        if tracker is not None:
+            tracker.db_seconds += seconds
+            tracker.sql_statements += statements
+
+    def record_discord(self, seconds):
+        self.observe('discord.request_ms', seconds * 1000)
+        tracker = self.current.get()
+        if tracker is not None:
+            tracker.discord_seconds += seconds
+
+    #----- sql statements -----
+    def install_sql_counter(self):
+        if not event.contains(Engine, 'before_cursor_execute', self.on_sql):
+            event.listen(Engine, 'before_cursor_execute', self.on_sql)
+
+    def on_sql(self, *args):
+        self.sql_local.count = getattr(self.sql_local, 'count', 0) + 1
+        with self.lock:
+            self.sql_statements += 1
+
+    def thread_sql_count(self):
+        """
+            Statements sent by the calling thread so far, take the difference around a unit of work
+        """
+        return getattr(self.sql_local, 'count', 0)
+
+    #----- discord api -----
+    def install_discord_timer(self, bot):
+        """
+            Time every REST request the bot makes by wrapping its http client
+        """
+        request = bot.http.request
+        if getattr(request, 'timed', False):
+            return
+
+        async def timed_request(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await request(*args, **kwargs)
+            finally:
+                self.record_discord(time.perf_counter() - started)
+        timed_request.timed = True
+        bot.http.request = timed_request
+
+    #----- output -----
+    def snapshot(self):
+        with self.lock:
+            histograms = dict((name, histogram.summary()) for name, histogram in self.histograms.items())
+            statements = self.sql_statements
+        return {'uptime_s': time.time() - self.started, 'sql_statements': statements, 'histograms': histograms}
+
+    def prometheus(self, gauges=None):
+        """
+            Render a snapshot in the prometheus text format, e.g. for the node_exporter textfile collector
+        """
+        snapshot = self.snapshot()
+        lines = [
+            'eventplanner_uptime_seconds %f' % (snapshot['uptime_s']),
+            'eventplanner_sql_statements_total %d' % (snapshot['sql_statements']),
+        ]
+        for name, value in sorted((gauges or dict()).items()):
+            lines.append('eventplanner_%s %s' % (metric_name(name), value))
+        for name, summary in sorted(snapshot['histograms'].items()):
+            name = 'eventplanner_%s' % (metric_name(name))
+            for quantile in ('p50', 'p95', 'p99'):
+                if quantile in summary:
+                    lines.append('%s{quantile="0.%s"} %f' % (name, quantile[1:], summary[quantile]))
+            lines.append('%s_sum %f' % (name, summary['sum']))
+            lines.append('%s_count %d' % (name, summary['count']))
+        return '\n'.join(lines) + '\n'
+
+
+def metric_name(name):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+metrics = Metrics()
@@ -0,0 +1,92 @@
+#! /usr/bin/env python3
+"""
+    One-shot copy of per-guild databases into the shared multi-tenant database.
+
+    Per-guild databases are named after the guild, so the guild id of every database has to
+    be given explicitly, either as arguments or as a json file mapping database names to ids:
+
+        python3 migrate_to_shared.py MyGuild=123456789012345678 OtherGuild=876543210987654321
+        python3 migrate_to_shared.py --map guilds.json
+
+    Rows are streamed in batches and upserted, so the copy can be re-run safely after a failure.
+    Once every guild is copied set "storage": {"mode": "shared"} in settings.json.
+"""
+import argparse
+import json
+import logging
+import os
+import time
+
+from db_handler import MyDatabase, Members, Lobby, LobbyArchive, ParticipantArchive, Participants
+
+
+def stream(con, model, order_by, batch_size):
+    """
+        Yield batches of row mappings of a per-guild table without loading it into memory
+    """
+    columns = [column.name for column in model.__table__.columns if column.name not in ('guild_id', 'row_id')]
+    query = con.session.query(*[getattr(model, column) for column in columns]).filter(
+        model.guild_id == con.guild_id
+    ).order_by(order_by).yield_per(batch_size)
+
+    batch = list()
+    for row in query:
+        batch.append(dict(zip(columns, row)))
+        if len(batch) == batch_size:
+            yield batch
+            batch = list()
+    if batch:
+        yield batch
+
+
+def copy_guild(db_settings, source_db, shared_db, guild_id, batch_size=1000):
+    """
+        Copy members, lobbies, participations and the archived history of one per-guild database
+        into the shared one
+    """
+    report = dict()
+    started = time.perf_counter()
+    with MyDatabase(**{**db_settings, "db_name": source_db}) as source, \
+            MyDatabase(**{**db_settings, "db_name": shared_db, "guild_id": guild_id}) as target:
+        for model, order_by in (
+            (Members, Members.id), (Lobby, Lobby.id), (Participants, Participants.row_id),
+            (LobbyArchive, LobbyArchive.id), (ParticipantArchive, ParticipantArchive.lobbyid)
+        ):
+            report[model.__tablename__] = 0
+            for batch in stream(source, model, order_by, batch_size):
+                for row in batch:
+                    row['guild_id'] = guild_id
+                target.upsert(model, batch)
+                target.session.commit()
+                report[model.__tablename__] += len(batch)
+    logging.info('Copied %s into %s as guild %s: %s in %.1f s' % (
+        source_db, shared_db, guild_id, report, time.perf_counter() - started
+    ))
+    return report
+
+
+if __name__ == '__main__':
+    logging.getLogger().addHandler(logging.StreamHandler())
+    logging.getLogger().setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Copy per-guild databases into the shared database')
+    parser.add_argument('guilds', nargs='*', help='<database name>=<guild id> pairs')
+    parser.add_argument('--map', help='json file mapping database names to guild ids')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    arguments = parser.parse_args()
+
+    settings_file = open(os.path.join(os.path.abspath(os.curdir), 'settings.json'), 'r')
+    settings = json.loads(settings_file.read())
+    settings_file.close()
+
+    guilds = dict()
+    if arguments.map:
+        with open(arguments.map, 'r') as map_file:
+            guilds.update(json.loads(map_file.read()))
+    for pair in arguments.guilds:
+        db_name, guild_id = pair.split('=', 1)
+        guilds[db_name] = guild_id
+
+    shared_db = settings.get('storage', {}).get('database', 'eventplanner')
+    for db_name, guild_id in guilds.items():
+        copy_guild(settings['database'], db_name, shared_db, int(guild_id), arguments.batch_size)
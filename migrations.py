@@ -0,0 +1,348 @@
+#! /usr/bin/env python3
+"""
+    Versioned schema migrations for the guild databases.
+
+    Base.metadata.create_all only runs when a database is created, so schema changes for
+    existing databases are listed here. Every migration has a version number, a description
+    and an upgrade function taking a sqlalchemy connection. The versions applied to a
+    database are recorded in its schema_version table; new databases get stamped with the
+    latest version since create_all already builds the current schema.
+
+    Migrations run automatically the first time the process opens an engine for a database
+    (see EngineRegistry in db_handler.py). They can also be applied up front with:
+
+        python3 migrations.py <database name> [<database name> ...]
+
+    Upgrade functions must only depend on the schema as it was at their version, never on
+    the current models, and should be safe to run against a partially migrated database.
+"""
+import json
+import logging
+import os
+import sys
+
+from datetime import datetime
+from sqlalchemy import BigInteger, Boolean, Column, DateTime, ForeignKeyConstraint, Index, Integer, MetaData, String, Table, inspect, text
+
+from db_handler import ARCHIVE_PARTITIONING, SchemaVersion
+from snowflake import lobby_ids
+
+
+def create_missing_indexes(connection, indexes):
+    """
+        Create the given (table, index name, columns, unique) indexes unless an index
+        with the same name already exists on the table
+    """
+    inspector = inspect(connection)
+    for table, name, columns, unique in indexes:
+        existing = [index['name'] for index in inspector.get_indexes(table)]
+        if name in existing:
+            continue
+        logging.info('Creating index %s on %s(%s)' % (name, table, ', '.join(columns)))
+        connection.execute(text('CREATE %sINDEX %s ON %s (%s)' % (
+            'UNIQUE ' if unique else '', name, table, ', '.join(columns)
+        )))
+
+
+def rebuild_sqlite_tables(connection, tables):
+    """
+        SQLite cannot change the keys or column types of a table in place. Every table of
+        "tables" (snapshots without indexes) replaces the table of the same name and is filled
+        with the columns both have, new columns get their server default. Indexes of the old
+        tables are dropped with them, recreate them with create_missing_indexes.
+    """
+    existing = dict((table.name, [column['name'] for column in inspect(connection).get_columns(table.name)]) for table in tables)
+    for table in tables:
+        connection.execute(text('ALTER TABLE %s RENAME TO %s_old' % (table.name, table.name)))
+    for table in tables:
+        table.create(connection)
+        columns = ', '.join(column.name for column in table.columns if column.name in existing[table.name])
+        connection.execute(text('INSERT INTO %s (%s) SELECT %s FROM %s_old' % (table.name, columns, columns, table.name)))
+    for table in tables:
+        connection.execute(text('DROP TABLE %s_old' % (table.name)))
+
+
+def add_lookup_indexes(connection):
+    # duplicate participations have to go before the unique index can be created,
+    # the derived table is needed because mysql refuses subqueries on the table being deleted from
+    connection.execute(text(
+        'DELETE FROM participants WHERE row_id NOT IN ('
+        'SELECT keep FROM (SELECT MIN(row_id) AS keep FROM participants GROUP BY memid, lobbyid) AS keepers'
+        ')'
+    ))
+    create_missing_indexes(connection, [
+        ('members', 'ix_members_name', ('name',), False),
+        ('lobby', 'ix_lobby_name', ('name',), False),
+        ('lobby', 'ix_lobby_date', ('date',), False),
+        ('participants', 'ix_participants_memid', ('memid',), False),
+        ('participants', 'ix_participants_lobbyid', ('lobbyid',), False),
+        ('participants', 'uq_participants_memid_lobbyid', ('memid', 'lobbyid'), True),
+    ])
+
+
+# the lookup indexes since add_guild_keys
+GUILD_INDEXES = [
+    ('members', 'ix_members_name', ('guild_id', 'name'), False),
+    ('lobby', 'ix_lobby_name', ('guild_id', 'name'), False),
+    ('lobby', 'ix_lobby_date', ('guild_id', 'date'), False),
+    ('participants', 'ix_participants_memid', ('guild_id', 'memid'), False),
+    ('participants', 'ix_participants_lobbyid', ('guild_id', 'lobbyid'), False),
+    ('participants', 'uq_participants_memid_lobbyid', ('guild_id', 'memid', 'lobbyid'), True),
+]
+
+
+def add_mysql_guild_keys(connection):
+    """
+        Put guild_id in front of the keys of add_guild_keys with ALTER TABLE
+    """
+    inspector = inspect(connection)
+    for foreign_key in inspector.get_foreign_keys('participants'):
+        connection.execute(text('ALTER TABLE participants DROP FOREIGN KEY %s' % (foreign_key['name'])))
+
+    # the lookup indexes (and the implicit foreign key indexes) are replaced by guild-leading ones
+    replaced = {
+        'members': [['name']],
+        'lobby': [['name'], ['date']],
+        'participants': [['memid'], ['lobbyid'], ['memid', 'lobbyid']],
+    }
+    for table, column_sets in replaced.items():
+        for index in inspect(connection).get_indexes(table):
+            if index['column_names'] in column_sets:
+                connection.execute(text('DROP INDEX %s ON %s' % (index['name'], table)))
+
+    for table in ('members', 'lobby'):
+        if 'guild_id' not in [column['name'] for column in inspect(connection).get_columns(table)]:
+            connection.execute(text(
+                'ALTER TABLE %s ADD COLUMN guild_id BIGINT NOT NULL DEFAULT 0 FIRST, '
+                'DROP PRIMARY KEY, ADD PRIMARY KEY (guild_id, id)' % (table)
+            ))
+    if 'guild_id' not in [column['name'] for column in inspect(connection).get_columns('participants')]:
+        connection.execute(text(
+            'ALTER TABLE participants ADD COLUMN guild_id BIGINT NOT NULL DEFAULT 0 AFTER row_id'
+        ))
+
+
+def add_guild_keys(connection):
+    if connection.dialect.name == 'sqlite':
+        # snapshots of the tables as of this version, the lookup indexes are recreated below
+        metadata = MetaData()
+        rebuild_sqlite_tables(connection, [
+            Table('members', metadata,
+                Column('guild_id', BigInteger(), primary_key=True, autoincrement=False, server_default='0'),
+                Column('id', String(64), primary_key=True),
+                Column('name', String(50))
+            ),
+            Table('lobby', metadata,
+                Column('guild_id', BigInteger(), primary_key=True, autoincrement=False, server_default='0'),
+                Column('id', String(64), primary_key=True),
+                Column('name', String(50)),
+                Column('date', DateTime),
+                Column('size', Integer())
+            ),
+            Table('participants', metadata,
+                Column('row_id', Integer(), primary_key=True),
+                Column('guild_id', BigInteger(), nullable=False, server_default='0'),
+                Column('memid', String(64), nullable=False),
+                Column('lobbyid', String(64), nullable=False),
+                Column('leader', String(50)),
+                ForeignKeyConstraint(['guild_id', 'memid'], ['members.guild_id', 'members.id'], name='fk_participants_member'),
+                ForeignKeyConstraint(['guild_id', 'lobbyid'], ['lobby.guild_id', 'lobby.id'], name='fk_participants_lobby')
+            ),
+        ])
+    else:
+        add_mysql_guild_keys(connection)
+
+    create_missing_indexes(connection, GUILD_INDEXES)
+    if connection.dialect.name == 'mysql' and not inspect(connection).get_foreign_keys('participants'):
+        connection.execute(text(
+            'ALTER TABLE participants '
+            'ADD CONSTRAINT fk_participants_member FOREIGN KEY (guild_id, memid) REFERENCES members (guild_id, id), '
+            'ADD CONSTRAINT fk_participants_lobby FOREIGN KEY (guild_id, lobbyid) REFERENCES lobby (guild_id, id)'
+        ))
+
+
+def add_board_pages(connection):
+    # a snapshot of the table as of this version, later changes to the model must not leak in
+    Table('board_pages', MetaData(),
+        Column('guild_id', BigInteger(), primary_key=True, autoincrement=False, server_default='0'),
+        Column('page', Integer(), primary_key=True, autoincrement=False),
+        Column('channel_id', String(64), nullable=False),
+        Column('message_id', String(64)),
+        Column('digest', String(64)),
+        mysql_engine='InnoDB'
+    ).create(connection, checkfirst=True)
+
+
+def bigint_keys(connection):
+    if connection.dialect.name == 'mysql':
+        for foreign_key in inspect(connection).get_foreign_keys('participants'):
+            connection.execute(text('ALTER TABLE participants DROP FOREIGN KEY %s' % (foreign_key['name'])))
+
+    lobby_id_type = [column['type'] for column in inspect(connection).get_columns('lobby') if column['name'] == 'id'][0]
+    if not str(lobby_id_type).upper().startswith('BIGINT'):
+        # random 64 bit ids overflow a signed BIGINT, every lobby is given a time ordered id in order of its date;
+        # the updates are committed by the ALTER TABLE below, an interrupted run starts over
+        connection.execute(text(
+            'DELETE FROM participants WHERE NOT EXISTS ('
+            'SELECT 1 FROM lobby WHERE lobby.guild_id = participants.guild_id AND lobby.id = participants.lobbyid'
+            ')'
+        ))
+        lobbies = connection.execute(text('SELECT guild_id, id FROM lobby ORDER BY date, id')).all()
+        for guild_id, old_id in lobbies:
+            new_id = {'guild_id': guild_id, 'old_id': old_id, 'new_id': str(lobby_ids.next_id())}
+            connection.execute(text('UPDATE lobby SET id = :new_id WHERE guild_id = :guild_id AND id = :old_id'), new_id)
+            connection.execute(text(
+                'UPDATE participants SET lobbyid = :new_id WHERE guild_id = :guild_id AND lobbyid = :old_id'
+            ), new_id)
+        logging.info('Gave %s lobbies time ordered ids' % (len(lobbies)))
+    # the leader column holds the member id of the leader on its own participation
+    connection.execute(text('UPDATE participants SET leader = memid WHERE leader IS NOT NULL'))
+
+    if connection.dialect.name == 'sqlite':
+        # snapshots of the tables as of this version, the ids stored as text are converted on the way
+        metadata = MetaData()
+        rebuild_sqlite_tables(connection, [
+            Table('members', metadata,
+                Column('guild_id', BigInteger(), primary_key=True, autoincrement=False, server_default='0'),
+                Column('id', BigInteger(), primary_key=True, autoincrement=False),
+                Column('name', String(50))
+            ),
+            Table('lobby', metadata,
+                Column('guild_id', BigInteger(), primary_key=True, autoincrement=False, server_default='0'),
+                Column('id', BigInteger(), primary_key=True, autoincrement=False),
+                Column('name', String(50)),
+                Column('date', DateTime),
+                Column('size', Integer())
+            ),
+            Table('participants', metadata,
+                Column('row_id', Integer(), primary_key=True),
+                Column('guild_id', BigInteger(), nullable=False, server_default='0'),
+                Column('memid', BigInteger(), nullable=False),
+                Column('lobbyid', BigInteger(), nullable=False),
+                Column('leader', BigInteger()),
+                ForeignKeyConstraint(['guild_id', 'memid'], ['members.guild_id', 'members.id'], name='fk_participants_member'),
+                ForeignKeyConstraint(['guild_id', 'lobbyid'], ['lobby.guild_id', 'lobby.id'], name='fk_participants_lobby')
+            ),
+            Table('board_pages', metadata,
+                Column('guild_id', BigInteger(), primary_key=True, autoincrement=False, server_default='0'),
+                Column('page', Integer(), primary_key=True, autoincrement=False),
+                Column('channel_id', BigInteger(), nullable=False),
+                Column('message_id', BigInteger()),
+                Column('digest', String(64))
+            ),
+        ])
+        create_missing_indexes(connection, GUILD_INDEXES)
+        return
+
+    connection.execute(text('ALTER TABLE members MODIFY id BIGINT NOT NULL'))
+    connection.execute(text('ALTER TABLE lobby MODIFY id BIGINT NOT NULL'))
+    connection.execute(text(
+        'ALTER TABLE participants MODIFY memid BIGINT NOT NULL, MODIFY lobbyid BIGINT NOT NULL, MODIFY leader BIGINT NULL'
+    ))
+    connection.execute(text('ALTER TABLE board_pages MODIFY channel_id BIGINT NOT NULL, MODIFY message_id BIGINT NULL'))
+    connection.execute(text(
+        'ALTER TABLE participants '
+        'ADD CONSTRAINT fk_participants_member FOREIGN KEY (guild_id, memid) REFERENCES members (guild_id, id), '
+        'ADD CONSTRAINT fk_participants_lobby FOREIGN KEY (guild_id, lobbyid) REFERENCES lobby (guild_id, id)'
+    ))
+
+
+def add_archive_tables(connection):
+    # snapshots of the tables as of this version, partitioned by month on mysql
+    metadata = MetaData()
+    Table('lobby_archive', metadata,
+        Column('guild_id', BigInteger(), primary_key=True, autoincrement=False, server_default='0'),
+        Column('month', Integer(), primary_key=True, autoincrement=False),
+        Column('id', BigInteger(), primary_key=True, autoincrement=False),
+        Column('name', String(50)),
+        Column('date', DateTime),
+        Column('size', Integer()),
+        Column('reason', String(16)),
+        Column('archived', DateTime),
+        mysql_engine='InnoDB'
+    )
+    Table('participant_archive', metadata,
+        Column('guild_id', BigInteger(), primary_key=True, autoincrement=False, server_default='0'),
+        Column('month', Integer(), primary_key=True, autoincrement=False),
+        Column('lobbyid', BigInteger(), primary_key=True, autoincrement=False),
+        Column('memid', BigInteger(), primary_key=True, autoincrement=False),
+        Column('name', String(50)),
+        Column('leader', Boolean()),
+        Index('ix_participant_archive_memid', 'guild_id', 'memid'),
+        mysql_engine='InnoDB'
+    )
+    existing = inspect(connection).get_table_names()
+    for table in metadata.sorted_tables:
+        if table.name in existing:
+            continue
+        table.create(connection)
+        if connection.dialect.name == 'mysql':
+            connection.execute(text('ALTER TABLE %s %s' % (table.name, ARCHIVE_PARTITIONING)))
+
+
+MIGRATIONS = [
+    (1, 'indexes on lookup columns, unique participation per member and lobby', add_lookup_indexes),
+    (2, 'guild_id leading primary keys and indexes for the shared storage mode', add_guild_keys),
+    (3, 'board_pages table for the lobby board', add_board_pages),
+    (4, 'BIGINT member, lobby and board message keys, time ordered lobby ids', bigint_keys),
+    (5, 'lobby_archive and participant_archive tables partitioned by month', add_archive_tables),
+]
+
+
+def current_version(connection):
+    """
+        Return the latest version applied to the database, 0 if none
+    """
+    SchemaVersion.__table__.create(connection, checkfirst=True)
+    version = connection.execute(text('SELECT MAX(version) FROM schema_version')).scalar()
+    return version or 0
+
+
+def record_version(connection, version, description):
+    connection.execute(SchemaVersion.__table__.insert().values(
+        version=version, description=description, applied=datetime.now()
+    ))
+
+
+def migrate(engine):
+    """
+        Apply every migration newer than the version of the database, each in its own transaction
+    """
+    with engine.begin() as connection:
+        version = current_version(connection)
+
+    for number, description, upgrade in MIGRATIONS:
+        if number <= version:
+            continue
+        logging.info('Migrating %s to version %s: %s' % (engine.url.database, number, description))
+        with engine.begin() as connection:
+            upgrade(connection)
+            record_version(connection, number, description)
+        version = number
+    return version
+
+
+def stamp(engine):
+    """
+        Mark every migration as applied, used for databases freshly created by create_all
+    """
+    with engine.begin() as connection:
+        version = current_version(connection)
+        for number, description, _ in MIGRATIONS:
+            if number > version:
+                record_version(connection, number, description)
+
+
+if __name__ == '__main__':
+    from db_handler import MyDatabase
+
+    logging.getLogger().addHandler(logging.StreamHandler())
+    logging.getLogger().setLevel(logging.INFO)
+
+    settings_file = open(os.path.join(os.path.abspath(os.curdir), 'settings.json'), 'r')
+    settings = json.loads(settings_file.read())
+    settings_file.close()
+
+    for db_name in sys.argv[1:]:
+        # opening a handler creates (and thereby migrates) the engine of the database
+        MyDatabase(**{**settings['database'], "db_name": db_name}).close()
@@ -0,0 +1,283 @@
+import bisect
+import itertools
+
+from collections import OrderedDict
+
+
+def fold(name):
+    return name.casefold()
+
+
+def edit_distance(first, second, max_distance):
+    """
+        Levenshtein distance counting a swap of two neighbours as one edit, max_distance + 1 once
+        it is certain to exceed max_distance
+    """
+    # a common prefix or suffix does not change the distance
+    start = 0
+    while start < len(first) and start < len(second) and first[start] == second[start]:
+        start += 1
+    end = 0
+    while end < len(first) - start and end < len(second) - start and first[-1 - end] == second[-1 - end]:
+        end += 1
+    first, second = first[start:len(first) - end], second[start:len(second) - end]
+    if abs(len(first) - len(second)) > max_distance:
+        return max_distance + 1
+    if not first or not second:
+        return len(first) or len(second)
+    # only cells within max_distance of the diagonal can stay below the limit
+    over = max_distance + 1
+    previous_row, before = [min(j, over) for j in range(len(second) + 1)], None
+    for i in range(1, len(first) + 1):
+        row = [over] * (len(second) + 1)
+        row[0] = lowest = min(i, over)
+        character = first[i - 1]
+        for j in range(max(1, i - max_distance), min(len(second), i + max_distance) + 1):
+            cell = previous_row[j - 1] if character == second[j - 1] else previous_row[j - 1] + 1
+            if previous_row[j] + 1 < cell:
+                cell = previous_row[j] + 1
+            if row[j - 1] + 1 < cell:
+                cell = row[j - 1] + 1
+            if i > 1 and j > 1 and character == second[j - 2] and first[i - 2] == second[j - 1] and before[j - 2] + 1 < cell:
+                cell = before[j - 2] + 1
+            row[j] = cell if cell < over else over
+            if cell < lowest:
+                lowest = cell
+        if lowest > max_distance:
+            return over
+        before, previous_row = previous_row, row
+    return previous_row[-1]
+
+
+def link(deletes, delete, folded):
+    names = deletes.get(delete)
+    if names is None:
+        deletes[delete] = folded # most deletes lead to a single name, a set costs far more memory
+    elif isinstance(names, str):
+        deletes[delete] = {names, folded}
+    else:
+        names.add(folded)
+
+
+def unlink(deletes, delete, folded):
+    names = deletes[delete]
+    if isinstance(names, str):
+        del deletes[delete]
+        return
+    names.discard(folded)
+    if len(names) == 1:
+        deletes[delete] = names.pop()
+
+
+class NameIndex():
+    """
+        In-memory index of the names of one kind (members or lobbies) of a guild, mapping names to
+        the keys (ids) carrying them. match ranks the names for a query without touching the database:
+
+            0  the exact name
+            1  the same name in another case
+            2  names starting with the query (case-insensitive)
+            3  names within "max_distance" typos (insertions, deletions, substitutions and swaps)
+
+        Typos are found through symmetric delete indexes: every name is stored under each string its
+        first and its last "prefix_length" characters turn into after up to "max_distance" deletions.
+        Only names found through both ends of the query are compared with it, so a lookup costs a
+        few dict probes and a handful of comparisons instead of comparing the query with every name.
+        The delete indexes take most of the memory, beyond "typo_limit" names they are dropped
+        and typos are no longer found (0 indexes typos of any number of names).
+    """
+
+    def __init__(self, max_distance=2, prefix_length=5, typo_limit=5000):
+        self.max_distance = int(max_distance)
+        self.prefix_length = int(prefix_length)
+        self.typo_limit = int(typo_limit)
+        self.typos = True
+        self.names = dict() # key -> name
+        self.folded = dict() # folded name -> {name: set of keys}
+        self.sorted = list() # folded names in order, for prefix lookups
+        self.heads = dict() # delete of the start of a folded name -> folded name, or a set of them
+        self.tails = dict() # the same for the end of a folded name
+
+    def __len__(self):
+        return len(self.names)
+
+    def _deletes(self, part, max_distance):
+        deletes = {part}
+        frontier = {part}
+        for _ in range(max_distance):
+            frontier = set(word[:i] + word[i + 1:] for word in frontier for i in range(len(word)))
+            deletes |= frontier
+        return deletes
+
+    def update(self, items):
+        """
+            Bring the index in line with (key, name) pairs, only keys which changed are touched
+        """
+        names = dict(items)
+        for key in [key for key in self.names if key not in names]:
+            self.remove(key)
+        for key, name in names.items():
+            self.add(key, name)
+
+    def add(self, key, name):
+        previous = self.names.get(key)
+        if previous == name:
+            return
+        if previous is not None:
+            self.remove(key)
+        if not name:
+            return
+        self.names[key] = name
+        folded = fold(name)
+        names = self.folded.get(folded)
+        if names is None:
+            names = self.folded[folded] = dict()
+            bisect.insort(self.sorted, folded)
+            if self.typos and self.typo_limit and len(self.folded) > self.typo_limit:
+                self.typos = False
+                self.heads, self.tails = dict(), dict()
+            if self.typos:
+                for deletes, part in self._ends(folded):
+                    for delete in self._deletes(part, self.max_distance):
+                        link(deletes, delete, folded)
+        names.setdefault(name, set()).add(key)
+
+    def remove(self, key):
+        name = self.names.pop(key, None)
+        if name is None:
+            return
+        folded = fold(name)
+        names = self.folded[folded]
+        names[name].discard(key)
+        if not names[name]:
+            del names[name]
+        if names:
+            return
+        del self.folded[folded]
+        del self.sorted[bisect.bisect_left(self.sorted, folded)]
+        if not self.typos:
+            return
+        for deletes, part in self._ends(folded):
+            for delete in self._deletes(part, self.max_distance):
+                unlink(deletes, delete, folded)
+
+    def _ends(self, folded):
+        return ((self.heads, folded[:self.prefix_length]), (self.tails, folded[-self.prefix_length:]))
+
+    def _candidates(self, folded_query, max_distance):
+        """
+            Folded names sharing a delete with both the start and the end of the query
+        """
+        candidates = None
+        for deletes, part in self._ends(folded_query):
+            found = set()
+            for delete in self._deletes(part, max_distance):
+                names = deletes.get(delete)
+                if names is None:
+                    continue
+                if isinstance(names, str):
+                    found.add(names)
+                else:
+                    found |= names
+            candidates = found if candidates is None else candidates & found
+        return candidates
+
+    def keys(self, name):
+        """
+            The keys carrying exactly this name
+        """
+        return set(self.folded.get(fold(name), dict()).get(name, ()))
+
+    def match(self, query, limit=10):
+        """
+            Return up to "limit" [(name, (rank, distance))] for a query, best first. Short queries
+            allow fewer typos: one per three characters, at most "max_distance".
+        """
+        folded_query = fold(query)
+        if not folded_query:
+            return list()
+        ranked = dict()
+        for name in self.folded.get(folded_query, dict()):
+            ranked[name] = (0, 0) if name == query else (1, 0)
+
+        index = bisect.bisect_left(self.sorted, folded_query)
+        while index < len(self.sorted) and len(ranked) < limit and self.sorted[index].startswith(folded_query):
+            for name in self.folded[self.sorted[index]]:
+                ranked.setdefault(name, (2, len(self.sorted[index]) - len(folded_query)))
+            index += 1
+
+        # typos are only looked for when the name itself is not known; one typo first, two only
+        # when nothing is one typo away: fewer candidates and cheaper comparisons
+        max_typos = min(self.max_distance, len(folded_query) // 3) if self.typos else 0
+        for max_distance in range(1, max_typos + 1):
+            if len(ranked) >= limit or any(rank != 2 for rank, _ in ranked.values()):
+                break
+            for folded in self._candidates(folded_query, max_distance):
+                distance = edit_distance(folded_query, folded, max_distance)
+                if distance <= max_distance:
+                    for name in self.folded[folded]:
+                        ranked.setdefault(name, (3, distance))
+
+        return sorted(ranked.items(), key=lambda item: (item[1], item[0]))[:limit]
+
+
+class GuildNames():
+    """
+        The member and lobby NameIndex of the most recently used guilds, at most "max_guilds".
+        The member index is kept current by MemberSync, the lobby index by the Lobbies cog
+        whenever it loads or writes lobbies. Changes to the index of a guild which is not kept
+        (never built or evicted) are dropped, the index is rebuilt when it is needed again.
+        Big indexes take a while to build, build them off the event loop and set them afterwards:
+
+            index = await loop.run_in_executor(None, names.build, items)
+            names.set(guild.id, 'members', index)
+    """
+
+    def __init__(self, max_distance=2, prefix_length=5, typo_limit=5000, max_guilds=256):
+        self.index_settings = {'max_distance': max_distance, 'prefix_length': prefix_length, 'typo_limit': typo_limit}
+        self.max_guilds = int(max_guilds)
+        self.guilds = OrderedDict() # guild id -> {"members": NameIndex, "lobbies": NameIndex}, least recently used first
+
+    def _index(self, guild_id, kind):
+        indexes = self.guilds.get(guild_id)
+        if indexes is None or kind not in indexes:
+            return NameIndex(**self.index_settings)
+        self.guilds.move_to_end(guild_id)
+        return indexes[kind]
+
+    def has(self, guild_id, kind):
+        return kind in self.guilds.get(guild_id, ())
+
+    def members(self, guild_id):
+        return self._index(guild_id, 'members')
+
+    def lobbies(self, guild_id):
+        return self._index(guild_id, 'lobbies')
+
+    def build(self, items):
+        index = NameIndex(**self.index_settings)
+        index.update(items)
+        return index
+
+    def set(self, guild_id, kind, index):
+        self.guilds.setdefault(guild_id, dict())[kind] = index
+        self.guilds.move_to_end(guild_id)
+        while len(self.guilds) > self.max_guilds:
+            self.guilds.popitem(last=False)
+
+    def drop(self, guild_id):
+        self.guilds.pop(guild_id, None)
+
+    def stats(self):
+        return {
+            'guilds': len(self.guilds),
+            'members': sum(len(indexes.get('members', ())) for indexes in self.guilds.values()),
+            'lobbies': sum(len(indexes.get('lobbies', ())) for indexes in self.guilds.values())
+        }
+
+
+def rank_groups(matches):
+    """
+        Group the names of NameIndex.match by rank, best group first
+    """
+    return [[name for name, _ in group] for _, group in itertools.groupby(matches, key=lambda match: match[1])]
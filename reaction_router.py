@@ -0,0 +1,82 @@
+import asyncio
+import logging
+
+from collections import OrderedDict
+
+
+class Menu():
+    """
+        A message waiting for one of its reactions to be picked
+    """
+
+    def __init__(self, message, choices, user_id):
+        self.message = message
+        self.choices = choices # emoji -> value handed back to the waiting command
+        self.user_id = user_id
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class ReactionRouter():
+    """
+        Route reactions to the interactive menu they belong to with one dict lookup per
+        reaction, instead of running the check of every pending wait_for.
+
+            value, user_id = await router.ask(message, {'1⃣': 'first', '2⃣': 'second'}, user_id)
+
+        Menus expire after "timeout" seconds, at most "max_menus" are outstanding; opening one
+        more expires the oldest. The emojis of a menu are added in the background so the
+        command can wait for an answer right away.
+    """
+
+    def __init__(self, timeout=120, max_menus=1000):
+        self.timeout = timeout
+        self.max_menus = int(max_menus)
+        self.menus = OrderedDict() # message id -> Menu
+
+    def install(self, bot):
+        self.bot = bot
+        bot.add_listener(self.on_raw_reaction_add)
+
+    async def ask(self, message, choices, user_id=None, timeout=None):
+        """
+            Add the "choices" emojis to a message and wait for "user_id" (anyone but the bot when
+            None) to pick one. returns (value, user id), (None, None) when the menu expired.
+        """
+        menu = Menu(message, choices, user_id)
+        self.menus[message.id] = menu
+        while len(self.menus) > self.max_menus:
+            _, oldest = self.menus.popitem(last=False)
+            if not oldest.future.done():
+                oldest.future.set_result((None, None))
+
+        adding = asyncio.ensure_future(self.add_reactions(message, list(choices)))
+        try:
+            return await asyncio.wait_for(menu.future, timeout or self.timeout)
+        except asyncio.TimeoutError:
+            return None, None
+        finally:
+            adding.cancel()
+            if self.menus.get(message.id) is menu:
+                del self.menus[message.id]
+
+    async def add_reactions(self, message, emojis):
+        try:
+            for emoji in emojis: # reactions show up in the order they are added
+                await message.add_reaction(emoji)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logging.exception('Adding reactions to menu %s failed', message.id)
+
+    async def on_raw_reaction_add(self, payload):
+        menu = self.menus.get(payload.message_id)
+        if menu is None or menu.future.done():
+            return
+        if payload.user_id == self.bot.user.id or (menu.user_id is not None and payload.user_id != menu.user_id):
+            return
+        value = menu.choices.get(str(payload.emoji))
+        if value is not None:
+            menu.future.set_result((value, payload.user_id))
+
+    def stats(self):
+        return {'outstanding': len(self.menus)}
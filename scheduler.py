@@ -0,0 +1,93 @@
+import asyncio
+import heapq
+import itertools
+import logging
+
+from datetime import datetime
+
+
+class DeadlineScheduler():
+    """
+        In-process scheduler of deadlines backed by a min-heap.
+        Every entry has a hashable key and a (naive, local) datetime deadline. The runner sleeps
+        until the earliest deadline is due, or until an earlier one is scheduled, and then awaits
+        callback(keys) with every key which is due. Nothing runs while nothing is due.
+
+        Scheduling a key again moves its deadline, cancel removes it. Both are O(log n); stale heap
+        entries are skipped when they reach the top and the heap is compacted when they pile up.
+    """
+
+    def __init__(self, callback, max_sleep=3600):
+        self.callback = callback
+        self.max_sleep = max_sleep # guards against clock changes during long sleeps
+        self.heap = list()
+        self.deadlines = dict() # key -> deadline, the source of truth for the heap
+        self.counter = itertools.count() # tie breaker, keys do not have to be comparable
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def schedule(self, key, deadline):
+        """
+            Schedule (or reschedule) key to be due at deadline
+        """
+        self.deadlines[key] = deadline
+        if not self.heap or deadline < self.heap[0][0]:
+            self.wakeup.set()
+        heapq.heappush(self.heap, (deadline, next(self.counter), key))
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self._compact()
+
+    def cancel(self, key):
+        self.deadlines.pop(key, None)
+
+    def _compact(self):
+        self.heap = [entry for entry in self.heap if self.deadlines.get(entry[2]) == entry[0]]
+        heapq.heapify(self.heap)
+
+    def _pop_due(self, now):
+        """
+            Pop every live key whose deadline has passed, return the keys and the next deadline
+        """
+        due = list()
+        while self.heap:
+            deadline, _, key = self.heap[0]
+            if self.deadlines.get(key) != deadline: # cancelled or rescheduled
+                heapq.heappop(self.heap)
+            elif deadline <= now:
+                heapq.heappop(self.heap)
+                del self.deadlines[key]
+                due.append(key)
+            else:
+                return due, deadline
+        return due, None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    async def _run(self):
+        while True:
+            self.wakeup.clear()
+            due, next_deadline = self._pop_due(datetime.now())
+            if due:
+                try:
+                    await self.callback(due)
+                except Exception as err:
+                    logging.exception('Scheduled callback failed for %s: %s' % (due, err))
+                continue
+
+            timeout = None
+            if next_deadline is not None:
+                timeout = min((next_deadline - datetime.now()).total_seconds(), self.max_sleep)
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,104 @@
+import logging
+
+
+def parse_shards(value):
+    """
+        Turn "0-3", "0,2,5" or "4" into a list of shard ids
+    """
+    shard_ids = list()
+    for part in str(value).split(','):
+        first, _, last = part.strip().partition('-')
+        shard_ids.extend(range(int(first), int(last or first) + 1))
+    return shard_ids
+
+
+def shard_settings(settings, shard_count=None, shard_ids=None):
+    """
+        Combine the "sharding" section of settings.json with the command line, the command line wins:
+
+            ./main.py --shard-count 8 --shards 0-3     # this process runs shards 0 to 3 of 8
+
+        Returns the keyword arguments for AutoShardedBot ({"shard_count", "shard_ids"}),
+        an empty dict runs a single unsharded gateway connection.
+    """
+    sharding = dict(settings.get('sharding', {}))
+    if shard_count is not None:
+        sharding['shard_count'] = shard_count
+    if shard_ids is not None:
+        sharding['shard_ids'] = shard_ids
+    elif isinstance(sharding.get('shard_ids'), str):
+        sharding['shard_ids'] = parse_shards(sharding['shard_ids'])
+
+    if not sharding.get('shard_count') and not sharding.get('auto'):
+        if sharding.get('shard_ids'):
+            raise ValueError('shard_ids need a shard_count')
+        return dict()
+    return {'shard_count': sharding.get('shard_count'), 'shard_ids': sharding.get('shard_ids')}
+
+
+class ShardGuilds():
+    """
+        The guilds owned by this process, grouped by shard. Member sync and the cleanup sweep
+        only ever walk these lists; they are refreshed when a shard becomes ready and kept up
+        to date by the guild join and remove events (see install).
+    """
+
+    def __init__(self, guilds=()):
+        self.shards = dict() # shard id -> {guild id: guild}
+        self.refresh(guilds)
+
+    def install(self, bot):
+        self.bot = bot
+        bot.add_listener(self.on_guild_join)
+        bot.add_listener(self.on_guild_remove)
+        bot.add_listener(self.on_shard_ready)
+        self.refresh(bot.guilds)
+
+    def refresh(self, guilds, shard_id=None):
+        """
+            Replace the guilds of one shard, or of every shard when "shard_id" is None
+        """
+        if shard_id is None:
+            self.shards = dict()
+        else:
+            self.shards.pop(shard_id, None)
+        for guild in guilds:
+            if shard_id is None or self.shard_of(guild) == shard_id:
+                self.add(guild)
+
+    def shard_of(self, guild):
+        return getattr(guild, 'shard_id', None) or 0
+
+    def add(self, guild):
+        self.shards.setdefault(self.shard_of(guild), dict())[guild.id] = guild
+
+    def remove(self, guild):
+        guilds = self.shards.get(self.shard_of(guild))
+        if guilds is not None:
+            guilds.pop(guild.id, None)
+
+    def for_shard(self, shard_id):
+        return list(self.shards.get(shard_id, dict()).values())
+
+    def items(self):
+        """
+            (shard id, guilds) of every shard with guilds
+        """
+        return [(shard_id, list(guilds.values())) for shard_id, guilds in sorted(self.shards.items()) if guilds]
+
+    def all(self):
+        return [guild for guilds in self.shards.values() for guild in guilds.values()]
+
+    def __len__(self):
+        return sum(len(guilds) for guilds in self.shards.values())
+
+    #----- listeners -----
+    async def on_guild_join(self, guild):
+        self.add(guild)
+
+    async def on_guild_remove(self, guild):
+        self.remove(guild)
+
+    async def on_shard_ready(self, shard_id):
+        self.refresh(self.bot.guilds, shard_id)
+        logging.debug('Shard %s owns %s guilds', shard_id, len(self.shards.get(shard_id, ())))
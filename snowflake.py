@@ -0,0 +1,52 @@
+import threading
+import time
+
+# ids are laid out like discord snowflakes: milliseconds since the discord epoch, then a
+# worker id and a per millisecond sequence, so lobby ids sort (and get inserted) by creation time
+DISCORD_EPOCH = 1420070400000
+WORKER_BITS = 10
+SEQUENCE_BITS = 12
+
+
+class SnowflakeGenerator():
+    """
+        Hand out unique, time ordered 63 bit ids. Processes generating ids for the same database
+        need distinct worker ids (0 to 1023), see configure; within a process ids are unique
+        up to 4096 per millisecond, the generator waits for the next millisecond beyond that.
+    """
+
+    def __init__(self, worker_id=0):
+        self.lock = threading.Lock()
+        self.last = 0
+        self.sequence = 0
+        self.configure(worker_id)
+
+    def configure(self, worker_id=0):
+        worker_id = int(worker_id)
+        if not 0 <= worker_id < 1 << WORKER_BITS:
+            raise ValueError('worker_id must be between 0 and %s' % ((1 << WORKER_BITS) - 1))
+        self.worker_id = worker_id
+
+    def next_id(self):
+        with self.lock:
+            now = max(int(time.time() * 1000), self.last) # never go back when the clock does
+            if now == self.last:
+                self.sequence = (self.sequence + 1) & ((1 << SEQUENCE_BITS) - 1)
+                if self.sequence == 0: # sequence exhausted, borrow the next millisecond
+                    now += 1
+            else:
+                self.sequence = 0
+            self.last = now
+            return ((now - DISCORD_EPOCH) << (WORKER_BITS + SEQUENCE_BITS)) | (self.worker_id << SEQUENCE_BITS) | self.sequence
+
+
+def snowflake_at(moment):
+    """
+        The smallest id created at "moment" (a datetime, naive ones are local time), ids of
+        everything created since then are greater or equal
+    """
+    milliseconds = int(moment.timestamp() * 1000) - DISCORD_EPOCH
+    return max(milliseconds, 0) << (WORKER_BITS + SEQUENCE_BITS)
+
+
+lobby_ids = SnowflakeGenerator()
@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import time
+
+from db_handler import guild_database, stored_guilds
+from metrics import metrics
+
+process_started = time.perf_counter()
+
+
+class Warmup():
+    """
+        Bring guilds up to speed without holding up the gateway: once the bot is ready only the
+        guilds which already have data are warmed (member sync and deadlines), at most
+        "concurrency" at a time. Every other guild, and any guild a command arrives for before
+        its turn, is warmed on its first command; its database and schema are created then.
+
+        The guilds known to have data (stored or warmed) are swept by the Lobbies cog whether
+        their warm-up finished or not, see has_data.
+
+        Readiness is recorded as startup.ready_ms, startup.warm_ms and startup.first_command_ms,
+        all measured from the start of the process.
+    """
+
+    def __init__(self, concurrency=4):
+        self.concurrency = int(concurrency)
+        self.warming = dict() # guild id -> task warming it, done once warm
+        self.stored = set() # ids of the guilds with data in the database
+        self.ready = False
+        self.first_command = False
+
+    def install(self, bot):
+        self.bot = bot
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        bot.add_listener(self.on_guild_remove)
+        bot.add_listener(self.on_shard_ready)
+        bot.before_invoke(self.before_invoke)
+
+    def warm(self, guild):
+        """
+            The task warming guild, started on the first call
+        """
+        task = self.warming.get(guild.id)
+        if task is None:
+            self.stored.add(guild.id) # the warm-up creates its database if need be
+            task = self.warming[guild.id] = self.bot.loop.create_task(self.warm_guild(guild))
+        return task
+
+    def is_warm(self, guild):
+        task = self.warming.get(guild.id)
+        return task is not None and task.done() and not task.cancelled() and task.exception() is None
+
+    def has_data(self, guild):
+        return guild.id in self.stored
+
+    async def warm_guild(self, guild):
+        async with self.semaphore:
+            try:
+                await self.bot.get_cog('MemberSync').sync_guild(guild)
+                await self.bot.get_cog('Lobbies').load_deadlines([guild])
+            except Exception:
+                self.warming.pop(guild.id, None) # try again on the next command
+                raise
+
+    async def warm_stored(self, guilds):
+        """
+            Warm the guilds which have a database (or rows in the shared one) already
+        """
+        db = self.bot.db
+        stored = await self.bot.loop.run_in_executor(db.executor, stored_guilds, db.db_settings, db.storage)
+        if db.storage.get('mode') == 'shared':
+            ids = set(guild.id for guild in stored)
+            guilds = [guild for guild in guilds if guild.id in ids]
+        else:
+            names = set(guild.name for guild in stored)
+            guilds = [guild for guild in guilds if guild_database(db.storage, guild)['db_name'] in names]
+        self.stored.update(guild.id for guild in guilds)
+
+        results = await asyncio.gather(*(self.warm(guild) for guild in guilds), return_exceptions=True)
+        for guild, result in zip(guilds, results):
+            if isinstance(result, Exception):
+                logging.error('Warming %s failed', guild.name, exc_info=result)
+        return len(guilds)
+
+    async def on_ready(self, guilds):
+        """
+            Called on every ready, guilds warmed before are skipped
+        """
+        first = not self.ready
+        self.ready = True
+        if first:
+            metrics.observe('startup.ready_ms', (time.perf_counter() - process_started) * 1000)
+        started = time.perf_counter()
+        warmed = await self.warm_stored(guilds)
+        if first:
+            metrics.observe('startup.warm_ms', (time.perf_counter() - process_started) * 1000)
+        logging.info('Warmed %s of %s guilds in %.1f ms', warmed, len(guilds), (time.perf_counter() - started) * 1000)
+
+    async def before_invoke(self, ctx):
+        """
+            Commands wait for their guild to be warm, which is immediate once it is
+        """
+        if ctx.guild is not None:
+            await asyncio.shield(self.warm(ctx.guild))
+        if not self.first_command:
+            self.first_command = True
+            elapsed = (time.perf_counter() - process_started) * 1000
+            metrics.observe('startup.first_command_ms', elapsed)
+            logging.info('First command %s after %.1f ms', ctx.command.name, elapsed)
+
+    async def on_shard_ready(self, shard_id):
+        """
+            A shard which reconnected after the first ready may bring guilds which are not warm yet
+        """
+        if self.ready:
+            await self.warm_stored(self.bot.shard_guilds.for_shard(shard_id))
+
+    async def on_guild_remove(self, guild):
+        self.warming.pop(guild.id, None)
+        self.stored.discard(guild.id)
+
+    def stats(self):
+        return {
+            'warm': sum(1 for task in self.warming.values() if task.done() and not task.cancelled()),
+            'warming': sum(1 for task in self.warming.values() if not task.done())
+        }
@@ -1,49 +1,183 @@
+import functools
 import re
+import sys
 
-from datetime import datetime
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
 
-class TimeMachine( object ):
+
+class DateError(ValueError):
     """
-        Create a report on a string represending a point in time.
-        Arguments must be formated in such a way that the following timedate filters applicable:
-        
-        %y - Large year
-        %Y - Small year
-        %m - Month
-        %d - Day
-        %H - Hour
-        %M - Minute
-        
-        Special characters such as whitespace, colons etc are allowed
+        A date which cannot be read or is not allowed, the message is meant for the member
     """
-    def __init__(self, datain):
-        """
-            turn the string into an array of integers
-        """
-        self.time_string = re.sub(r'\W+', '', datain)
 
+
+WEEKDAYS = dict(
+    (name, number)
+    for number, day in enumerate(('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday'))
+    for name in (day, day[:3])
+)
+DAYS = {'today': 0, 'tonight': 0, 'tomorrow': 1, 'tmrw': 1}
+UNITS = {'d': 86400, 'h': 3600, 'm': 60}
+
+# "20:00", "20.00", "20h00", "8pm", "8:30 pm"; a bare hour is only a time after a day
+TIME = r'(?P<hour>\d{1,2})(?:[:.h](?P<minute>\d{2}))?\s*(?P<meridiem>am|pm)?'
+STRICT_TIME = r'(?P<hour>\d{1,2})(?:[:.h](?P<minute>\d{2})\s*(?P<meridiem>am|pm)?|\s*(?P<meridiem_only>am|pm))'
+DAY_NAMES = '|'.join(sorted(list(DAYS) + list(WEEKDAYS), key=len, reverse=True))
+
+# tried in order on the lowercased input with whitespace collapsed, the first match wins
+FORMATS = [(kind, re.compile(pattern)) for kind, pattern in (
+    # 2026-10-18 20:00, 2026/10/18t20:00
+    ('date', r'(?P<year>\d{4})[-/.](?P<month>\d{1,2})[-/.](?P<day>\d{1,2})(?: |t| at )' + TIME),
+    # 18.10.2026 20:00, 18/10 8pm (the next 18th of October)
+    ('date', r'(?P<day>\d{1,2})[./](?P<month>\d{1,2})(?:[./](?P<year>\d{4}|\d{2}))?(?: | at )' + TIME),
+    # tomorrow 20:00, friday at 8pm
+    ('day', r'(?P<name>' + DAY_NAMES + r')(?: | at )' + TIME),
+    # 20:00, at 8pm (the next time the clock shows it)
+    ('time', r'(?:at )?' + STRICT_TIME),
+    # +2h, +1d 2h30m, in 90 min, in 2 hours
+    ('offset', r'(?:\+ ?|in )(?P<offset>(?:\d+ ?(?:d|days?|h|hours?|hrs?|m|mins?|minutes?) ?)+)'),
+)]
+# the original format: digits in the order year, month, day, hour, minute with any separators
+COMPACT = re.compile(r'(?P<year>\d{4}|\d{2})(?P<month>\d{2})(?P<day>\d{2})(?P<hour>\d{2})(?P<minute>\d{2})')
+OFFSET_PART = re.compile(r'(\d+) ?([dhm])')
+
+
+def clock(match):
+    """
+        (hour, minute) of a TIME match, None when it is not a time of day
+    """
+    hour, minute = int(match['hour']), int(match['minute'] or 0)
+    meridiem = match['meridiem'] or match.groupdict().get('meridiem_only')
+    if meridiem:
+        if not 1 <= hour <= 12:
+            return None
+        hour = hour % 12 + (12 if meridiem == 'pm' else 0)
+    if hour > 23 or minute > 59:
+        return None
+    return hour, minute
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_date(text):
+    """
+        Turn the text of a date into a plan, a tuple which resolve_date turns into a date
+        given the current time. Plans do not depend on the time, so they are memoized per text:
+
+            ('date', year or None, month, day, hour, minute)
+            ('day', days ahead or None, weekday or None, hour, minute)
+            ('time', hour, minute)
+            ('offset', seconds)
+
+        Returns None if the text is not a date in any of the FORMATS.
+    """
+    normalized = ' '.join(text.lower().split())
+    for kind, pattern in FORMATS if not normalized.isdigit() else ():
+        match = pattern.fullmatch(normalized)
+        if match is None:
+            continue
+        if kind == 'offset':
+            return ('offset', sum(int(amount) * UNITS[unit] for amount, unit in OFFSET_PART.findall(match['offset'])))
+        time = clock(match)
+        if time is None:
+            return None
+        if kind == 'date':
+            year = match['year'] and int(match['year'])
+            if year is not None and year < 100:
+                year += 2000
+            return ('date', year, int(match['month']), int(match['day'])) + time
+        if kind == 'day':
+            return ('day', DAYS.get(match['name']), WEEKDAYS.get(match['name'])) + time
+        return ('time',) + time
+
+    match = COMPACT.fullmatch(re.sub(r'\W+', '', normalized)) # also the only format of bare digits
+    if match is None:
+        return None
+    year = int(match['year'])
+    return ('date', year + 2000 if year < 100 else year, int(match['month']), int(match['day']), int(match['hour']), int(match['minute']))
+
+
+@functools.lru_cache(maxsize=4096)
+def resolve_date(plan, now, zone=None):
+    """
+        The naive server time of a plan of compile_date at "now", a naive server time on a whole
+        minute. Everyone asking for the same date within a minute gets the memoized answer.
+    """
+    if plan[0] == 'offset':
+        return now + timedelta(seconds=plan[1])
+    # days and times are counted on the clock of the guild
+    wall = now.astimezone(zone).replace(tzinfo=None) if zone else now
+    if plan[0] == 'date':
+        _, year, month, day, hour, minute = plan
         try:
-            self.time = datetime.strptime(self.time_string, '%y%m%d%H%M')
+            date = datetime(year or wall.year, month, day, hour, minute)
+            if year is None and date <= wall: # the next time it is that day
+                date = date.replace(year=wall.year + 1)
         except ValueError:
-            self.time = datetime.strptime(self.time_string, '%Y%m%d%H%M')
+            raise DateError('%02d.%02d is not a day of the calendar' % (day, month))
+    else:
+        date = wall.replace(hour=plan[-2], minute=plan[-1], second=0, microsecond=0)
+        if plan[0] == 'time':
+            if date <= wall:
+                date += timedelta(days=1)
+        elif plan[1] is not None:
+            date += timedelta(days=plan[1])
         else:
-            raise ValueError('Invalid format must be: "%y%m%d%H%M" or "%Y%m%d%H%M"')
+            ahead = (plan[2] - wall.weekday()) % 7
+            date += timedelta(days=ahead if ahead or date > wall else 7)
+    if zone:
+        date = date.replace(tzinfo=zone).astimezone().replace(tzinfo=None)
+    return date
+
+
+class TimeMachine():
+    """
+        Read the dates members give to --create. Absolute and relative dates are understood:
 
-    def convert(self):
+            201708222359, 2017-08-22 23:59, 22.08.2017 23:59, 22/08 11:59pm
+            20:00, tomorrow 20:00, friday at 8pm, +2h, +1d 30m, in 90 min
+
+        Dates are read in the "timezone" of the guild ("guilds" maps guild ids to zone names,
+        "timezone" is the default, the time of the server running the bot without one) and are
+        returned as naive datetimes in the time of the server, like every date in the database.
+        Dates in the past or more than "max_lead" seconds ahead are refused, 0 allows any lead.
+    """
+
+    def __init__(self, timezone=None, guilds=None, max_lead=7776000):
+        self.timezone = ZoneInfo(timezone) if timezone else None
+        self.guilds = dict((int(guild_id), ZoneInfo(name)) for guild_id, name in (guilds or dict()).items())
+        self.max_lead = timedelta(seconds=int(max_lead))
+
+    def zone(self, guild_id=None):
         """
-            Return a valid datetime object to the caller
+            The time zone of a guild, None for the time of the server
         """
-        return self.time
+        return self.guilds.get(guild_id, self.timezone)
 
-    def is_in_past(self):
+    def parse(self, text, guild_id=None, now=None):
         """
-            See if a point in time is the past
+            Return the date of text as a naive datetime in server time, raises DateError if it is
+            not a date, lies in the past or too far ahead. "now" defaults to the current time.
         """
-        pass
+        plan = compile_date(text)
+        if plan is None:
+            raise DateError('%s is not a date I know, try e.g. "2026-10-18 20:00", "tomorrow 20:00" or "+2h"' % (text))
+        now = now or datetime.now()
+        date = resolve_date(plan, now.replace(second=0, microsecond=0), self.zone(guild_id))
+        self.validate(text, date, now)
+        return date
+
+    def validate(self, text, date, now):
+        if date < now:
+            raise DateError('%s lies in the past' % (text))
+        if self.max_lead and date - now > self.max_lead:
+            raise DateError('%s is too far ahead, lobbies start within %g days' % (text, self.max_lead.total_seconds() / 86400))
+
 
 if __name__ == '__main__':
-    time = TimeMachine('201708222359')
-    if time.to_datetime():
-        print('The time is valid!')
-    else:
-        print('The time is not valid :(')
+    time_machine = TimeMachine()
+    for text in sys.argv[1:] or ['201708222359', 'tomorrow 20:00', '+2h']:
+        try:
+            print('%s -> %s' % (text, time_machine.parse(text)))
+        except DateError as err:
+            print('%s -> %s' % (text, err))
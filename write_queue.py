@@ -0,0 +1,90 @@
+import asyncio
+import logging
+
+
+class WriteBehindQueue():
+    """
+        Funnel the writes of commands into a queue per guild. A writer coroutine per guild takes
+        up to "max_batch" submissions, or whatever arrived within "max_delay" seconds, and applies
+        them in a single transaction through MyDatabase.apply_writes. Every caller awaits the
+        result of its own submission: the row count of each write, or the exception it raised.
+
+            results = await writes.submit(guild, [('lobby', {...}), ('participant', {...})])
+
+        Writers exit once their queue runs dry, an idle guild costs nothing.
+    """
+
+    def __init__(self, db, max_batch=100, max_delay=0.005):
+        self.db = db
+        self.max_batch = int(max_batch)
+        self.max_delay = max_delay
+        self.queues = dict() # guild id -> asyncio.Queue of (writes, future)
+        self.writers = dict() # guild id -> writer task
+        self.batches = 0
+        self.submissions = 0
+
+    async def submit(self, guild, writes):
+        """
+            Queue a list of (kind, row) writes and await its results.
+            Raises the exception of the submission if it could not be applied.
+        """
+        future = asyncio.get_running_loop().create_future()
+        queue = self.queues.get(guild.id)
+        if queue is None:
+            queue = self.queues[guild.id] = asyncio.Queue()
+        queue.put_nowait((writes, future))
+        if guild.id not in self.writers:
+            self.writers[guild.id] = asyncio.ensure_future(self._writer(guild, queue))
+
+        result = await future
+        if isinstance(result, Exception):
+            raise result
+        self.db.wrote(guild) # the writer runs in the context of whoever started it, not of every submitter
+        return result
+
+    async def _collect(self, queue):
+        batch = [queue.get_nowait()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_delay
+        while len(batch) < self.max_batch:
+            if not queue.empty():
+                batch.append(queue.get_nowait())
+                continue
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _writer(self, guild, queue):
+        try:
+            while not queue.empty():
+                batch = await self._collect(queue)
+                try:
+                    results = await self.db.run(guild, 'apply_writes', [writes for writes, _ in batch])
+                except Exception as err: # the database could not be reached at all
+                    logging.exception('Write batch for %s failed', guild.name)
+                    results = [err] * len(batch)
+
+                self.batches += 1
+                self.submissions += len(batch)
+                logging.debug('Applied %s submissions for %s', len(batch), guild.name)
+                for (_, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+        finally:
+            del self.writers[guild.id]
+            if queue.empty():
+                self.queues.pop(guild.id, None)
+            else: # submitted while this writer was shutting down
+                self.writers[guild.id] = asyncio.ensure_future(self._writer(guild, queue))
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'submissions': self.submissions,
+            'submissions_per_batch': self.submissions / self.batches if self.batches else 0.0
+        }